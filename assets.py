@@ -0,0 +1,145 @@
+# ===================== ARCHIVOS ESTÁTICOS VERSIONADOS =====================
+# Al iniciar, copia app.js y styles.css a STATIC_BUILD_DIR con el hash del
+# contenido en el nombre (app.3f2a9c1b7d4e.js), opcionalmente minificados, y
+# con sus variantes precomprimidas (.gz y .br si está instalado brotli).
+# index.html se reescribe para apuntar a /assets/<nombre con hash>: esos
+# archivos nunca cambian y se sirven con caché de un año (immutable); el HTML
+# se revalida en cada carga, así un despliegue nuevo se ve de inmediato.
+#
+# Se conservan los últimos ASSETS_KEEP_BUILDS builds de cada archivo: durante
+# un reinicio escalonado (o con workers de versiones distintas) una página ya
+# cargada sigue pidiendo el app.<hash>.js anterior, y cualquier worker lo sirve
+# mientras exista en STATIC_BUILD_DIR.
+#
+# Dependencias opcionales: rjsmin / rcssmin (minificado) y brotli.
+import gzip
+import hashlib
+import os
+import re
+from typing import Dict, Optional
+from fastapi import HTTPException, Request
+from fastapi.responses import FileResponse, HTMLResponse, Response
+from middleware import accepted_encodings
+from versions import etag_matches
+
+try:
+    import rjsmin
+except ImportError:
+    rjsmin = None
+try:
+    import rcssmin
+except ImportError:
+    rcssmin = None
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+STATIC_DIR = "static"
+STATIC_BUILD_DIR = os.getenv("STATIC_BUILD_DIR", "static_build")
+ASSETS_MINIFY = os.getenv("ASSETS_MINIFY", "1") != "0"
+ASSETS_KEEP_BUILDS = int(os.getenv("ASSETS_KEEP_BUILDS", "5"))
+ASSET_FILES = ("app.js", "styles.css")
+IMMUTABLE_CACHE = "public, max-age=31536000, immutable"
+
+MEDIA_TYPES = {".js": "application/javascript", ".css": "text/css"}
+# Referencias a los archivos en index.html, con o sin ?v=...
+_REFERENCE = re.compile(r"/static/(%s)(\?v=[^\"']*)?" % "|".join(re.escape(n) for n in ASSET_FILES))
+# Nombre con hash de cualquier build: app.3f2a9c1b7d4e.js -> ("app", ".js")
+_HASHED = re.compile(r"^(%s)\.[0-9a-f]{12}(%s)$" % (
+    "|".join(re.escape(os.path.splitext(n)[0]) for n in ASSET_FILES),
+    "|".join(re.escape(e) for e in MEDIA_TYPES),
+))
+
+# Resultado del último build: index.html reescrito
+_index_html: Optional[str] = None
+_index_etag: Optional[str] = None
+
+
+def _minify(name: str, content: bytes) -> bytes:
+    if not ASSETS_MINIFY:
+        return content
+    minifier = {".js": rjsmin and rjsmin.jsmin, ".css": rcssmin and rcssmin.cssmin}.get(os.path.splitext(name)[1])
+    if not minifier:
+        return content
+    return minifier(content.decode("utf-8-sig")).encode("utf-8")
+
+
+def _write(path: str, content: bytes):
+    """Escritura atómica: varios workers pueden construir a la vez el mismo archivo"""
+    if os.path.exists(path):
+        return
+    tmp = f"{path}.{os.getpid()}.tmp"
+    with open(tmp, "wb") as f:
+        f.write(content)
+    os.replace(tmp, path)
+
+
+def _prune_builds(build_dir: str, keep: int):
+    """Deja los ``keep`` builds más recientes (por fecha de modificación) de cada archivo"""
+    builds: Dict[tuple, list] = {}
+    for entry in os.listdir(build_dir):
+        match = _HASHED.match(entry)
+        if match:
+            builds.setdefault(match.groups(), []).append(entry)
+    for names in builds.values():
+        names.sort(key=lambda n: os.path.getmtime(os.path.join(build_dir, n)), reverse=True)
+        for name in names[keep:]:
+            for suffix in ("", ".gz", ".br"):
+                try:
+                    os.remove(os.path.join(build_dir, name + suffix))
+                except OSError:
+                    pass
+
+
+def build_assets(static_dir: str = STATIC_DIR, build_dir: str = STATIC_BUILD_DIR) -> Dict[str, str]:
+    """Genera los archivos con hash y sus variantes comprimidas. Devuelve {original: url}"""
+    global _index_html, _index_etag
+    os.makedirs(build_dir, exist_ok=True)
+    urls = {}
+    for name in ASSET_FILES:
+        with open(os.path.join(static_dir, name), "rb") as f:
+            content = _minify(name, f.read())
+        stem, ext = os.path.splitext(name)
+        hashed = f"{stem}.{hashlib.sha256(content).hexdigest()[:12]}{ext}"
+        path = os.path.join(build_dir, hashed)
+        _write(path, content)
+        _write(path + ".gz", gzip.compress(content, compresslevel=9, mtime=0))
+        if brotli is not None:
+            _write(path + ".br", brotli.compress(content))
+        os.utime(path)  # el build actual es el más reciente aunque ya existiera
+        urls[name] = f"/assets/{hashed}"
+
+    _prune_builds(build_dir, max(ASSETS_KEEP_BUILDS, 1))
+
+    with open(os.path.join(static_dir, "index.html"), encoding="utf-8") as f:
+        html = _REFERENCE.sub(lambda m: urls[m.group(1)], f.read())
+    _index_html = html
+    _index_etag = f'"{hashlib.sha256(html.encode("utf-8")).hexdigest()[:20]}"'
+    return urls
+
+
+def index_response(request: Request) -> Response:
+    """index.html con las URLs versionadas; siempre se revalida (ETag + no-cache)"""
+    if _index_html is None:
+        return FileResponse(os.path.join(STATIC_DIR, "index.html"), headers={"Cache-Control": "no-cache"})
+    headers = {"ETag": _index_etag, "Cache-Control": "no-cache"}
+    if etag_matches(request, _index_etag):
+        return Response(status_code=304, headers=headers)
+    return HTMLResponse(_index_html, headers=headers)
+
+
+def asset_response(request: Request, filename: str) -> Response:
+    """Sirve un archivo con hash de cualquier build conservado (precomprimido si el navegador lo acepta)"""
+    match = _HASHED.match(filename)
+    path = os.path.join(STATIC_BUILD_DIR, filename)
+    if match is None or not os.path.isfile(path):
+        raise HTTPException(status_code=404, detail="Archivo no encontrado")
+    headers = {"Cache-Control": IMMUTABLE_CACHE, "Vary": "Accept-Encoding"}
+    accepted = accepted_encodings(request.headers.get("accept-encoding", ""))
+    for encoding, suffix in (("br", ".br"), ("gzip", ".gz")):
+        if encoding in accepted and os.path.exists(path + suffix):
+            path += suffix
+            headers["Content-Encoding"] = encoding
+            break
+    return FileResponse(path, media_type=MEDIA_TYPES[match.group(2)], headers=headers)
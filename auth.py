@@ -1,3 +1,7 @@
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager
+from dataclasses import dataclass
 from datetime import datetime, timedelta
 from typing import Optional
 from fastapi import Depends, HTTPException, status
@@ -5,9 +9,9 @@ from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
 from jose import JWTError, jwt
 import bcrypt
 import os
-from sqlalchemy.orm import Session
-from database import get_db
+from database import SessionLocal
 from models import User
+from cache import TTLCache
 
 # Configuración
 SECRET_KEY = os.getenv("SECRET_KEY", "ef85017e3797dd4c61e94d190f3f0cc0")
@@ -17,12 +21,99 @@ ACCESS_TOKEN_EXPIRE_MINUTES = 60 * 24 * 365 * 5  # 5 años
 
 security = HTTPBearer()
 
+# Caché de usuarios autenticados (token -> CurrentUser). Es de cada worker, así que la
+# clave lleva users.auth_version, que se lee en cada petición: un cambio de rol, una
+# aprobación o un borrado hecho en otro worker se nota en la petición siguiente.
+AUTH_CACHE_TTL = float(os.getenv("AUTH_CACHE_TTL", "300"))
+_principal_store = TTLCache(maxsize=4096, ttl=AUTH_CACHE_TTL)
+
+def _principal_key(user_id: int, auth_version: Optional[int], token: str) -> str:
+    return f"user:{user_id}:{auth_version or 0}:{token}"
+
+@dataclass(frozen=True)
+class CurrentUser:
+    """Datos del usuario autenticado disponibles en los endpoints (no ligado a una sesión de BD)"""
+    id: int
+    name: str
+    email: str
+    avatar_color: Optional[str]
+    is_admin: bool
+    is_approved: bool
+    created_at: Optional[datetime]
+
+    @classmethod
+    def from_user(cls, user: User) -> "CurrentUser":
+        return cls(
+            id=user.id,
+            name=user.name,
+            email=user.email,
+            avatar_color=user.avatar_color,
+            is_admin=bool(user.is_admin),
+            is_approved=bool(user.is_approved),
+            created_at=user.created_at,
+        )
+
+def invalidate_user(user: User):
+    """Dejar obsoletos los datos en caché de un usuario en todos los workers (llamar antes
+    del commit que lo modifica; al eliminarlo no hace falta, su fila ya no existe)"""
+    user.auth_version = (user.auth_version or 0) + 1
+
 def verify_password(plain_password: str, hashed_password: str) -> bool:
     return bcrypt.checkpw(plain_password.encode('utf-8'), hashed_password.encode('utf-8'))
 
 def get_password_hash(password: str) -> str:
     return bcrypt.hashpw(password.encode('utf-8'), bcrypt.gensalt()).decode('utf-8')
 
+# ===================== BCRYPT FUERA DEL EVENT LOOP =====================
+# bcrypt tarda decenas de milisegundos por operación; ejecutarlo dentro de un
+# endpoint async congela todas las peticiones y WebSockets del worker. Las
+# versiones async lo mandan a un pool de hilos acotado (bcrypt libera el GIL).
+PASSWORD_HASH_WORKERS = int(os.getenv("PASSWORD_HASH_WORKERS", "2"))
+_hash_executor = ThreadPoolExecutor(max_workers=PASSWORD_HASH_WORKERS, thread_name_prefix="bcrypt")
+
+async def verify_password_async(plain_password: str, hashed_password: str) -> bool:
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(_hash_executor, verify_password, plain_password, hashed_password)
+
+async def get_password_hash_async(password: str) -> str:
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(_hash_executor, get_password_hash, password)
+
+# Admisión de logins: como máximo LOGIN_MAX_CONCURRENT verificaciones en curso y
+# LOGIN_QUEUE_MAX esperando turno; el resto recibe 503 con Retry-After.
+LOGIN_MAX_CONCURRENT = int(os.getenv("LOGIN_MAX_CONCURRENT", str(PASSWORD_HASH_WORKERS * 2)))
+LOGIN_QUEUE_MAX = int(os.getenv("LOGIN_QUEUE_MAX", "50"))
+LOGIN_QUEUE_TIMEOUT = float(os.getenv("LOGIN_QUEUE_TIMEOUT", "5"))
+LOGIN_RETRY_AFTER = 2
+
+_login_semaphore = asyncio.Semaphore(LOGIN_MAX_CONCURRENT)
+_login_waiting = 0
+
+def _login_busy() -> HTTPException:
+    return HTTPException(
+        status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+        detail="Demasiados inicios de sesión simultáneos, intenta de nuevo en unos segundos",
+        headers={"Retry-After": str(LOGIN_RETRY_AFTER)},
+    )
+
+@asynccontextmanager
+async def login_admission():
+    """Turno para procesar un login; si la cola está llena o la espera se agota responde 503"""
+    global _login_waiting
+    if _login_waiting >= LOGIN_QUEUE_MAX:
+        raise _login_busy()
+    _login_waiting += 1
+    try:
+        await asyncio.wait_for(_login_semaphore.acquire(), LOGIN_QUEUE_TIMEOUT)
+    except asyncio.TimeoutError:
+        raise _login_busy()
+    finally:
+        _login_waiting -= 1
+    try:
+        yield
+    finally:
+        _login_semaphore.release()
+
 def create_access_token(data: dict, expires_delta: Optional[timedelta] = None) -> str:
     to_encode = data.copy()
     if expires_delta:
@@ -33,25 +124,45 @@ def create_access_token(data: dict, expires_delta: Optional[timedelta] = None) -
     encoded_jwt = jwt.encode(to_encode, SECRET_KEY, algorithm=ALGORITHM)
     return encoded_jwt
 
-async def get_current_user(
-    credentials: HTTPAuthorizationCredentials = Depends(security),
-    db: Session = Depends(get_db)
-) -> User:
-    credentials_exception = HTTPException(
-        status_code=status.HTTP_401_UNAUTHORIZED,
-        detail="No se pudieron validar las credenciales",
-        headers={"WWW-Authenticate": "Bearer"},
-    )
+def principal_from_token(token: Optional[str]) -> Optional[CurrentUser]:
+    """Usuario de un JWT válido, o None si el token no sirve o el usuario no existe"""
+    if not token:
+        return None
     try:
-        token = credentials.credentials
         payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
-        user_id: str = payload.get("sub")
+        user_id = payload.get("sub")
         if user_id is None:
-            raise credentials_exception
-    except JWTError:
-        raise credentials_exception
+            return None
+        user_id = int(user_id)
+    except (JWTError, ValueError):
+        return None
     
-    user = db.query(User).filter(User.id == int(user_id)).first()
-    if user is None:
-        raise credentials_exception
-    return user
+    db = SessionLocal()
+    try:
+        # Una consulta por clave primaria en cada petición; el usuario completo
+        # solo se carga si su auth_version no está en caché
+        row = db.query(User.auth_version).filter(User.id == user_id).first()
+        if row is None:
+            return None
+        principal = _principal_store.get(_principal_key(user_id, row.auth_version, token))
+        if principal is None:
+            user = db.query(User).filter(User.id == user_id).first()
+            if user is None:
+                return None
+            principal = CurrentUser.from_user(user)
+            _principal_store.set(_principal_key(user_id, user.auth_version, token), principal)
+    finally:
+        db.close()
+    return principal
+
+async def get_current_user(
+    credentials: HTTPAuthorizationCredentials = Depends(security)
+) -> CurrentUser:
+    principal = principal_from_token(credentials.credentials)
+    if principal is None:
+        raise HTTPException(
+            status_code=status.HTTP_401_UNAUTHORIZED,
+            detail="No se pudieron validar las credenciales",
+            headers={"WWW-Authenticate": "Bearer"},
+        )
+    return principal
@@ -0,0 +1,152 @@
+# ===================== CACHÉ EN MEMORIA =====================
+# Caché LRU con tiempo de vida (TTL) para resultados que se consultan muy
+# seguido y cambian poco (estadísticas del dashboard, respuestas por proyecto).
+# TTLCache es local a cada proceso: con varios workers cada uno tiene su propia
+# copia, por eso los TTL deben ser cortos. Las claves son cadenas y la
+# invalidación por grupos se guarda en el mismo almacén (CacheNamespace), así
+# un almacén compartido (Redis, memcached...) puede reemplazar a TTLCache.
+import threading
+import time
+from abc import ABC, abstractmethod
+from collections import OrderedDict
+from typing import Any, Callable, NamedTuple, Optional
+
+
+class CacheBackend(ABC):
+    """Interfaz de almacenamiento para las cachés (claves ``str``).
+    TTLCache es la implementación en memoria; un almacén compartido entre
+    procesos solo necesita implementar estos métodos."""
+
+    @abstractmethod
+    def get(self, key: str, default: Any = None) -> Any:
+        ...
+
+    @abstractmethod
+    def set(self, key: str, value: Any, ttl: Optional[float] = None):
+        ...
+
+    @abstractmethod
+    def delete(self, key: str):
+        ...
+
+    @abstractmethod
+    def clear(self):
+        ...
+
+    def get_or_set(self, key: str, factory: Callable[[], Any], ttl: Optional[float] = None) -> Any:
+        """Devuelve el valor en caché o lo calcula con ``factory`` y lo guarda"""
+        value = self.get(key, _MISSING)
+        if value is _MISSING:
+            value = factory()
+            self.set(key, value, ttl)
+        return value
+
+
+class TTLCache(CacheBackend):
+    """Diccionario acotado (LRU) cuyas entradas expiran a los ``ttl`` segundos"""
+
+    def __init__(self, maxsize: int = 1024, ttl: float = 5.0):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data: "OrderedDict[str, tuple]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key: str, default: Any = None) -> Any:
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None:
+                return default
+            expires_at, value = entry
+            if expires_at < time.monotonic():
+                del self._data[key]
+                return default
+            self._data.move_to_end(key)
+            return value
+
+    def set(self, key: str, value: Any, ttl: Optional[float] = None):
+        expires_at = time.monotonic() + (self.ttl if ttl is None else ttl)
+        with self._lock:
+            self._data[key] = (expires_at, value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def delete(self, key: str):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+
+_MISSING = object()
+
+
+class CacheNamespace:
+    """Grupo de claves que se invalida de una vez sin recorrer el almacén.
+
+    Las claves llevan un sello (``<nombre>:<sello>:<clave>``) guardado en el
+    mismo almacén; ``invalidate()`` lo reemplaza y las entradas anteriores
+    quedan inalcanzables hasta que expiran. Si el sello se pierde (expiró o lo
+    descartó el LRU) se crea uno nuevo: nunca vuelve a un valor anterior.
+    """
+
+    def __init__(self, backend: CacheBackend, name: str):
+        self.backend = backend
+        self.name = name
+        self._stamp_key = f"ns:{name}"
+
+    def _stamp(self) -> int:
+        stamp = self.backend.get(self._stamp_key)
+        if stamp is None:
+            stamp = time.time_ns()
+            self.backend.set(self._stamp_key, stamp)
+        return stamp
+
+    def key(self, key: Any) -> str:
+        return f"{self.name}:{self._stamp()}:{key}"
+
+    def get(self, key: Any, default: Any = None) -> Any:
+        return self.backend.get(self.key(key), default)
+
+    def set(self, key: Any, value: Any, ttl: Optional[float] = None):
+        self.backend.set(self.key(key), value, ttl)
+
+    def get_or_set(self, key: Any, factory: Callable[[], Any], ttl: Optional[float] = None) -> Any:
+        return self.backend.get_or_set(self.key(key), factory, ttl)
+
+    def invalidate(self):
+        self.backend.set(self._stamp_key, time.time_ns())
+
+
+class CachedPayload(NamedTuple):
+    etag: str
+    body: bytes
+
+
+class ResponseCache:
+    """Respuestas JSON ya serializadas por proyecto.
+
+    La clave incluye la data_version del proyecto leída al atender la petición:
+    una escritura (en cualquier worker) sube la versión y las entradas viejas
+    dejan de encontrarse solas, sin invalidar nada. Una respuesta calculada
+    antes de una escritura queda guardada con la versión anterior y nunca se
+    sirve como actual.
+    """
+
+    def __init__(self, backend: CacheBackend):
+        self.backend = backend
+
+    @staticmethod
+    def key(project_id: int, version: int, *parts: Any) -> str:
+        return ":".join(["resp", str(project_id), str(version), *("" if p is None else str(p) for p in parts)])
+
+    def get(self, key: str) -> Optional[CachedPayload]:
+        return self.backend.get(key)
+
+    def set(self, key: str, payload: CachedPayload):
+        self.backend.set(key, payload)
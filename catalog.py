@@ -0,0 +1,217 @@
+# ===================== CATÁLOGO DE PLANTILLAS =====================
+# Las plantillas (etapas, tareas y categorías de supervisión) cambian poco y
+# solo las editan los admins, pero se listan y aplican seguido. El catálogo se
+# guarda en memoria como una foto inmutable (tuplas y dataclasses congeladas)
+# que se reconstruye completa, con una consulta por tabla, cuando un endpoint
+# de plantillas escribe. Los lectores solo toman la referencia actual.
+#
+# Cada worker tiene su propia foto, marcada con la versión de catalog_version
+# con la que se armó. Los endpoints de plantillas suben esa versión en la BD y
+# cada get_catalog la lee (una consulta por clave primaria): si otro proceso
+# cambió las plantillas, la foto se reconstruye en la siguiente lectura.
+import threading
+from dataclasses import dataclass
+from datetime import datetime
+from types import MappingProxyType
+from typing import Mapping, Optional, Tuple
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import Session
+from models import (
+    StageTemplate, StageTemplateItem, TaskTemplate, TaskTemplateItem,
+    SupCategoriaTemplate, SupCategoriaTemplateItem, stage_template_sup_cats, CatalogVersion
+)
+
+
+def _iso(value: Optional[datetime]) -> Optional[str]:
+    return value.isoformat() if value else None
+
+
+@dataclass(frozen=True)
+class StageTemplateItemSnap:
+    id: int
+    name: str
+    description: Optional[str]
+    percentage: float
+    position: int
+
+
+@dataclass(frozen=True)
+class TaskTemplateItemSnap:
+    id: int
+    title: str
+    description: Optional[str]
+    priority: Optional[str]
+    position: int
+    duration_days: Optional[int]
+
+
+@dataclass(frozen=True)
+class SupTemplateItemSnap:
+    id: int
+    actividad: str
+    prioridad: Optional[int]
+    position: int
+
+
+@dataclass(frozen=True)
+class SupTemplateSnap:
+    id: int
+    nombre: str
+    tipo: str
+    descripcion: Optional[str]
+    created_at: Optional[datetime]
+    items: Tuple[SupTemplateItemSnap, ...]
+
+    def to_dict(self) -> dict:
+        return {
+            "id": self.id,
+            "nombre": self.nombre,
+            "tipo": self.tipo,
+            "descripcion": self.descripcion,
+            "created_at": _iso(self.created_at),
+            "items": [{"id": i.id, "actividad": i.actividad, "prioridad": i.prioridad, "position": i.position} for i in self.items],
+        }
+
+
+@dataclass(frozen=True)
+class StageTemplateSnap:
+    id: int
+    name: str
+    description: Optional[str]
+    created_by: Optional[int]
+    created_at: Optional[datetime]
+    stages: Tuple[StageTemplateItemSnap, ...]
+    sup_cat_ids: Tuple[int, ...]
+
+    def to_dict(self) -> dict:
+        return {
+            "id": self.id,
+            "name": self.name,
+            "description": self.description,
+            "created_by": self.created_by,
+            "created_at": _iso(self.created_at),
+            "stages": [{"id": i.id, "name": i.name, "description": i.description, "percentage": i.percentage, "position": i.position} for i in self.stages],
+        }
+
+
+@dataclass(frozen=True)
+class TaskTemplateSnap:
+    id: int
+    name: str
+    description: Optional[str]
+    created_by: Optional[int]
+    created_at: Optional[datetime]
+    tasks: Tuple[TaskTemplateItemSnap, ...]
+
+    def to_dict(self) -> dict:
+        return {
+            "id": self.id,
+            "name": self.name,
+            "description": self.description,
+            "created_by": self.created_by,
+            "created_at": _iso(self.created_at),
+            "tasks": [{"id": i.id, "title": i.title, "description": i.description, "priority": i.priority, "position": i.position, "duration_days": i.duration_days} for i in self.tasks],
+        }
+
+
+@dataclass(frozen=True)
+class TemplateCatalog:
+    """Foto completa de las plantillas, indexada por id (en el orden de los listados)"""
+    stage_templates: Mapping[int, StageTemplateSnap]
+    task_templates: Mapping[int, TaskTemplateSnap]
+    sup_templates: Mapping[int, SupTemplateSnap]
+    version: int
+
+    def stage_template_sup_cats(self, template: StageTemplateSnap) -> Tuple[SupTemplateSnap, ...]:
+        return tuple(self.sup_templates[i] for i in template.sup_cat_ids if i in self.sup_templates)
+
+
+def _group_items(rows, make):
+    """{template_id: (items...)} a partir de filas ya ordenadas por posición"""
+    grouped = {}
+    for row in rows:
+        grouped.setdefault(row.template_id, []).append(make(row))
+    return {tid: tuple(items) for tid, items in grouped.items()}
+
+
+def build_catalog(db: Session, version: int) -> TemplateCatalog:
+    """Lee todas las plantillas con una consulta por tabla (7 en total)"""
+    stage_items = _group_items(
+        db.query(StageTemplateItem).order_by(StageTemplateItem.position, StageTemplateItem.id).all(),
+        lambda i: StageTemplateItemSnap(i.id, i.name, i.description, i.percentage, i.position))
+    task_items = _group_items(
+        db.query(TaskTemplateItem).order_by(TaskTemplateItem.position, TaskTemplateItem.id).all(),
+        lambda i: TaskTemplateItemSnap(i.id, i.title, i.description, i.priority, i.position, i.duration_days))
+    sup_items = _group_items(
+        db.query(SupCategoriaTemplateItem).order_by(SupCategoriaTemplateItem.position, SupCategoriaTemplateItem.id).all(),
+        lambda i: SupTemplateItemSnap(i.id, i.actividad, i.prioridad, i.position))
+
+    links = {}
+    for stage_template_id, sup_cat_id in db.query(
+        stage_template_sup_cats.c.stage_template_id, stage_template_sup_cats.c.sup_cat_template_id
+    ).order_by(stage_template_sup_cats.c.sup_cat_template_id).all():
+        links.setdefault(stage_template_id, []).append(sup_cat_id)
+
+    stage_templates = {
+        t.id: StageTemplateSnap(t.id, t.name, t.description, t.created_by, t.created_at,
+                                stage_items.get(t.id, ()), tuple(links.get(t.id, ())))
+        for t in db.query(StageTemplate).order_by(StageTemplate.id).all()
+    }
+    task_templates = {
+        t.id: TaskTemplateSnap(t.id, t.name, t.description, t.created_by, t.created_at, task_items.get(t.id, ()))
+        for t in db.query(TaskTemplate).order_by(TaskTemplate.id).all()
+    }
+    sup_templates = {
+        t.id: SupTemplateSnap(t.id, t.nombre, t.tipo, t.descripcion, t.created_at, sup_items.get(t.id, ()))
+        for t in db.query(SupCategoriaTemplate).order_by(SupCategoriaTemplate.tipo, SupCategoriaTemplate.nombre, SupCategoriaTemplate.id).all()
+    }
+    return TemplateCatalog(
+        stage_templates=MappingProxyType(stage_templates),
+        task_templates=MappingProxyType(task_templates),
+        sup_templates=MappingProxyType(sup_templates),
+        version=version,
+    )
+
+
+_catalog: Optional[TemplateCatalog] = None
+_lock = threading.Lock()
+
+
+def _stored_version(db: Session) -> int:
+    return db.query(CatalogVersion.version).filter(CatalogVersion.id == 1).scalar() or 0
+
+
+def _rebuild(db: Session, version: int) -> TemplateCatalog:
+    # La versión se lee antes que las plantillas: si cambian en medio, la foto
+    # queda marcada con la versión vieja y se vuelve a armar en la próxima lectura
+    global _catalog
+    with _lock:
+        _catalog = build_catalog(db, version)
+        return _catalog
+
+
+def get_catalog(db: Session) -> TemplateCatalog:
+    """Foto actual del catálogo (la reconstruye si no existe o su versión no es la de la BD)"""
+    version = _stored_version(db)
+    catalog = _catalog
+    if catalog is not None and catalog.version == version:
+        return catalog
+    return _rebuild(db, version)
+
+
+def refresh_catalog(db: Session) -> TemplateCatalog:
+    """Sube la versión del catálogo para todos los workers y reconstruye la foto
+    de este; llamar después de confirmar cambios en plantillas"""
+    bumped = db.query(CatalogVersion).filter(CatalogVersion.id == 1).update(
+        {CatalogVersion.version: CatalogVersion.version + 1}, synchronize_session=False)
+    if not bumped:
+        db.add(CatalogVersion(id=1, version=1))
+    try:
+        db.commit()
+    except IntegrityError:
+        # Otro worker creó la fila al mismo tiempo
+        db.rollback()
+        db.query(CatalogVersion).filter(CatalogVersion.id == 1).update(
+            {CatalogVersion.version: CatalogVersion.version + 1}, synchronize_session=False)
+        db.commit()
+    return _rebuild(db, _stored_version(db))
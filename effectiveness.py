@@ -0,0 +1,173 @@
+# ===================== MOTOR DE EFECTIVIDAD =====================
+# Cálculo de % programado vs % real para tareas, etapas y proyectos.
+#
+# Trabaja sobre columnas planas (listas paralelas) en lugar de objetos ORM:
+# las fechas se convierten a números de día (ordinal) y todo el cálculo se
+# hace en una sola pasada, sin consultas por tarea ni por etapa. Así el mismo
+# código sirve para un proyecto o para cientos a la vez.
+from datetime import date, datetime
+from typing import Dict, Iterable, List, Optional, Sequence
+from sqlalchemy.orm import Session
+from models import Task, Stage
+
+# Columnas que espera el motor (en este orden)
+TASK_COLUMNS = (Task.id, Task.project_id, Task.stage_id, Task.title, Task.status, Task.progress, Task.start_date, Task.due_date)
+STAGE_COLUMNS = (Stage.id, Stage.project_id, Stage.name, Stage.percentage, Stage.position, Stage.start_date, Stage.end_date, Stage.exclude_from_effectiveness)
+
+
+def _to_ordinal(value) -> Optional[int]:
+    """Fecha/datetime -> número de día (None si no hay fecha)"""
+    if value is None:
+        return None
+    if isinstance(value, datetime):
+        value = value.date()
+    return value.toordinal()
+
+
+def scheduled_progress(starts: Sequence[int], ends: Sequence[int], today: int, inclusive: bool = True) -> List[float]:
+    """% programado para cada par (inicio, fin) expresado en ordinales de día.
+
+    - hoy >= fin: 100
+    - hoy >= inicio: días transcurridos (hoy incluido) / días totales
+    - antes del inicio: 0
+    Con ``inclusive`` los días totales incluyen el día de inicio y el de fin
+    (criterio de tareas); sin él se usa la diferencia simple (criterio de etapas).
+    """
+    extra = 1 if inclusive else 0
+    return [
+        100.0 if today >= end
+        else min(100.0, (today - start + 1) / max(1, end - start + extra) * 100) if today >= start
+        else 0.0
+        for start, end in zip(starts, ends)
+    ]
+
+
+def effectiveness_status(scheduled: float, actual: float, effectiveness: float) -> str:
+    if scheduled == 0 and actual == 0:
+        return "en_tiempo"
+    if effectiveness >= 100:
+        return "adelantado"
+    if effectiveness >= 90:
+        return "en_tiempo"
+    return "atrasado"
+
+
+def _mean(values: List[float]) -> float:
+    return sum(values) / len(values) if values else 0.0
+
+
+def compute_effectiveness(task_rows: Iterable[Sequence], stage_rows: Iterable[Sequence], today: Optional[date] = None) -> Dict[int, dict]:
+    """Calcula la efectividad de todos los proyectos presentes en las filas recibidas.
+
+    ``task_rows`` y ``stage_rows`` son tuplas con el orden de TASK_COLUMNS y
+    STAGE_COLUMNS (filas de SQLAlchemy o tuplas armadas a mano). Devuelve
+    ``{project_id: {"metrics", "stages", "tasks", "total_tasks", "completed_tasks"}}``
+    con la misma forma que el endpoint de efectividad por proyecto.
+    """
+    today_ord = (today or date.today()).toordinal()
+    task_rows = list(task_rows)
+    stage_rows = list(stage_rows)
+
+    # --- Columnas planas de tareas ---
+    t_id = [r[0] for r in task_rows]
+    t_project = [r[1] for r in task_rows]
+    t_stage = [r[2] for r in task_rows]
+    t_title = [r[3] for r in task_rows]
+    t_status = [r[4] for r in task_rows]
+    t_progress = [float(r[5] or 0) for r in task_rows]
+    t_start = [_to_ordinal(r[6]) for r in task_rows]
+    t_due = [_to_ordinal(r[7]) for r in task_rows]
+
+    results: Dict[int, dict] = {}
+
+    def project_entry(project_id: int) -> dict:
+        entry = results.get(project_id)
+        if entry is None:
+            entry = results[project_id] = {
+                "stages": [], "tasks": [], "total_tasks": 0, "completed_tasks": 0,
+                "_stage_progress": {},
+            }
+        return entry
+
+    # Tareas con fechas y que no están en reinicio: % programado en una pasada
+    dated = [i for i in range(len(t_id)) if t_start[i] is not None and t_due[i] is not None and t_status[i] != "restart"]
+    task_scheduled = scheduled_progress([t_start[i] for i in dated], [t_due[i] for i in dated], today_ord)
+
+    for i, sched in zip(dated, task_scheduled):
+        effectiveness = (t_progress[i] / sched) * 100 if sched > 0 else 100.0
+        project_entry(t_project[i])["tasks"].append({
+            "id": t_id[i],
+            "title": t_title[i],
+            "scheduled_progress": round(sched, 1),
+            "actual_progress": t_progress[i],
+            "effectiveness": round(effectiveness, 1),
+        })
+
+    # Conteos y progreso real por etapa (todas las tareas salvo reinicio)
+    for i in range(len(t_id)):
+        entry = project_entry(t_project[i])
+        entry["total_tasks"] += 1
+        if t_status[i] == "done":
+            entry["completed_tasks"] += 1
+        if t_stage[i] is not None and t_status[i] != "restart":
+            entry["_stage_progress"].setdefault(t_stage[i], []).append(t_progress[i])
+
+    # --- Etapas ---
+    stage_rows.sort(key=lambda r: (r[1], r[4] or 0, r[0]))
+    with_dates = [r for r in stage_rows if r[5] and r[6]]
+    stage_scheduled = dict(zip(
+        [r[0] for r in with_dates],
+        scheduled_progress([_to_ordinal(r[5]) for r in with_dates], [_to_ordinal(r[6]) for r in with_dates], today_ord, inclusive=False),
+    ))
+
+    for stage_id, project_id, name, percentage, _position, start, end, exclude in stage_rows:
+        entry = project_entry(project_id)
+        entry["stages"].append({
+            "id": stage_id,
+            "name": name,
+            "percentage": percentage,
+            "scheduled_progress": round(stage_scheduled.get(stage_id, 0.0), 1),
+            "actual_progress": round(_mean(entry["_stage_progress"].get(stage_id, [])), 1),
+            "start_date": start.isoformat() if start else None,
+            "end_date": end.isoformat() if end else None,
+            "exclude_from_effectiveness": bool(exclude) or (not start and not end),
+        })
+
+    # --- Métricas globales por proyecto: preferir etapas con fechas ---
+    for entry in results.values():
+        entry.pop("_stage_progress")
+        eligible = [s for s in entry["stages"] if s["start_date"] and s["end_date"] and not s["exclude_from_effectiveness"]]
+        source = eligible or entry["tasks"]
+        scheduled = _mean([s["scheduled_progress"] for s in source])
+        actual = _mean([s["actual_progress"] for s in source])
+        effectiveness = (actual / scheduled) * 100 if scheduled > 0 else 0.0
+
+        entry["metrics"] = {
+            "scheduled_progress": round(scheduled, 1),
+            "actual_progress": round(actual, 1),
+            "effectiveness": round(effectiveness, 1),
+            "status": effectiveness_status(scheduled, actual, effectiveness),
+            "progress_difference": round(actual - scheduled, 1),
+        }
+
+    return results
+
+
+def empty_effectiveness() -> dict:
+    """Resultado para un proyecto sin tareas ni etapas"""
+    return {
+        "metrics": {"scheduled_progress": 0.0, "actual_progress": 0.0, "effectiveness": 0.0,
+                    "status": "en_tiempo", "progress_difference": 0.0},
+        "stages": [], "tasks": [], "total_tasks": 0, "completed_tasks": 0,
+    }
+
+
+def load_effectiveness(db: Session, project_ids: List[int], today: Optional[date] = None) -> Dict[int, dict]:
+    """Carga tareas y etapas de varios proyectos (una consulta por tabla) y calcula su efectividad.
+    Todos los ids pedidos aparecen en el resultado, aunque no tengan tareas."""
+    if not project_ids:
+        return {}
+    task_rows = db.query(*TASK_COLUMNS).filter(Task.project_id.in_(project_ids)).order_by(Task.id).all()
+    stage_rows = db.query(*STAGE_COLUMNS).filter(Stage.project_id.in_(project_ids)).all()
+    results = compute_effectiveness(task_rows, stage_rows, today)
+    return {pid: results.get(pid) or empty_effectiveness() for pid in project_ids}
@@ -2,21 +2,23 @@ from fastapi import FastAPI, WebSocket, WebSocketDisconnect, Depends, HTTPExcept
 from fastapi.staticfiles import StaticFiles
 from fastapi.responses import HTMLResponse, FileResponse, StreamingResponse, Response
 from fastapi.middleware.cors import CORSMiddleware
-from starlette.middleware.base import BaseHTTPMiddleware
-from sqlalchemy.orm import Session
-from sqlalchemy import inspect
-from typing import List, Optional
+from fastapi.encoders import jsonable_encoder
+from pydantic import TypeAdapter, ValidationError
+from sqlalchemy.orm import Session, joinedload, selectinload, load_only
+from sqlalchemy import inspect, select, and_, or_, func, case
+from typing import Dict, List, Optional
+import asyncio
 import json
 import os
 import uuid
 import shutil
 import io
-from datetime import datetime, timedelta
+from datetime import date, datetime, timedelta, timezone
 import cloudinary
 import cloudinary.uploader
 
 from database import engine, get_db, Base, SessionLocal
-from models import Project, Task, User, Activity, TaskProgress, ProjectMember, Stage, TaskHistory, StageTemplate, StageTemplateItem, TaskTemplate, TaskTemplateItem, AdminTeam, task_assignees, Milestone, MilestoneAttachment, SupResumenItem, SupComprasGrupo, SupComprasItem, SupServiciosGrupo, SupServiciosItem, sup_compras_item_grupos, sup_servicios_item_grupos, task_sup_compras_grupos, task_sup_servicios_grupos, SupCategoriaTemplate, SupCategoriaTemplateItem, stage_template_sup_cats
+from models import Project, Task, User, Activity, TaskProgress, ProjectMember, Stage, TaskHistory, StageTemplate, StageTemplateItem, TaskTemplate, TaskTemplateItem, AdminTeam, task_assignees, Milestone, MilestoneAttachment, SupResumenItem, SupComprasGrupo, SupComprasItem, SupServiciosGrupo, SupServiciosItem, sup_compras_item_grupos, sup_servicios_item_grupos, task_sup_compras_grupos, task_sup_servicios_grupos, SupCategoriaTemplate, SupCategoriaTemplateItem, stage_template_sup_cats, EffectivenessSnapshot, ChangeLog
 from schemas import (
     ProjectCreate, ProjectResponse, ProjectUpdate,
     TaskCreate, TaskResponse, TaskUpdate,
@@ -30,8 +32,21 @@ from schemas import (
     SupComprasItemCreate, SupComprasItemUpdate, SupComprasItemResponse,
     SupServiciosGrupoCreate, SupServiciosGrupoUpdate, SupServiciosGrupoResponse,
     SupServiciosItemCreate, SupServiciosItemUpdate, SupServiciosItemResponse,
+    WSAuthMessage, WSClientMessage,
 )
-from auth import get_current_user, create_access_token, verify_password, get_password_hash
+from auth import CurrentUser, get_current_user, create_access_token, get_password_hash, get_password_hash_async, verify_password_async, login_admission, invalidate_user, principal_from_token
+from rollups import get_stage_rollups, stage_progress, get_supervision_rollups, count_if
+from effectiveness import TASK_COLUMNS, STAGE_COLUMNS, compute_effectiveness, empty_effectiveness, load_effectiveness
+from snapshots import snapshot_loop, SNAPSHOT_JOB_ENABLED
+from cache import TTLCache, CacheNamespace, ResponseCache, CachedPayload
+from middleware import NoCacheMiddleware, CompressionMiddleware
+from assets import build_assets, index_response, asset_response
+from realtime import (
+    ConnectionManager, create_broadcast_backend, receive_first_message, reject, PONG_MESSAGE,
+    CLOSE_IDLE, CLOSE_INVALID, CLOSE_LIMIT, CLOSE_UNAUTHORIZED, CLOSE_FORBIDDEN,
+)
+from catalog import get_catalog, refresh_catalog
+from versions import bump_project_versions, get_project_version, make_etag, etag_matches, note_change, changes_since
 
 # ===================== INICIALIZAR BASE DE DATOS =====================
 def init_database():
@@ -132,6 +147,26 @@ def init_database():
                 print("✅ Columna is_active agregada a projects")
             except Exception as e:
                 pass  # Ya existe
+
+            # Agregar columna data_version a projects si no existe (versión para ETag)
+            try:
+                conn.execute(text("""
+                    ALTER TABLE projects ADD COLUMN data_version INT DEFAULT 0
+                """))
+                conn.commit()
+                print("✅ Columna data_version agregada a projects")
+            except Exception as e:
+                pass  # Ya existe
+
+            # Agregar columna auth_version a users si no existe (clave de la caché de sesión)
+            try:
+                conn.execute(text("""
+                    ALTER TABLE users ADD COLUMN auth_version INT DEFAULT 0
+                """))
+                conn.commit()
+                print("✅ Columna auth_version agregada a users")
+            except Exception as e:
+                pass  # Ya existe
             
             # Crear tabla stage_templates
             try:
@@ -563,6 +598,36 @@ def init_database():
         except Exception as e2:
             print(f"⚠️ Tabla stage_template_sup_cats: {e2}")
 
+        # Índice del tablero de tareas (project_id, status, position, id)
+        try:
+            with engine.connect() as conn3:
+                conn3.execute(text("CREATE INDEX ix_tasks_board ON tasks (project_id, status, position, id)"))
+                conn3.commit()
+            print("✅ Índice ix_tasks_board creado")
+        except Exception as e2:
+            pass  # Ya existe
+
+        # Clave única de effectiveness_snapshots (fecha, proyecto, etapa): deja una sola foto por día
+        try:
+            with engine.connect() as conn3:
+                conn3.execute(text("ALTER TABLE effectiveness_snapshots ADD COLUMN stage_key INT NOT NULL DEFAULT 0"))
+                conn3.execute(text("UPDATE effectiveness_snapshots SET stage_key = COALESCE(stage_id, 0)"))
+                conn3.execute(text("""
+                    DELETE FROM effectiveness_snapshots WHERE id NOT IN (
+                        SELECT id FROM (
+                            SELECT MAX(id) AS id FROM effectiveness_snapshots
+                            GROUP BY snapshot_date, project_id, stage_key
+                        ) AS keep_rows
+                    )
+                """))
+                conn3.execute(text(
+                    "CREATE UNIQUE INDEX uq_effectiveness_snapshots_day ON effectiveness_snapshots (snapshot_date, project_id, stage_key)"
+                ))
+                conn3.commit()
+            print("✅ Clave única uq_effectiveness_snapshots_day creada")
+        except Exception as e2:
+            pass  # Ya existe
+
     except Exception as e:
         print(f"⚠️ Error inicializando BD: {e}")
 
@@ -613,17 +678,30 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
-# Middleware para evitar caché en archivos estáticos
-class NoCacheMiddleware(BaseHTTPMiddleware):
-    async def dispatch(self, request: Request, call_next):
-        response = await call_next(request)
-        if request.url.path.startswith("/static"):
-            response.headers["Cache-Control"] = "no-cache, no-store, must-revalidate"
-            response.headers["Pragma"] = "no-cache"
-            response.headers["Expires"] = "0"
-        return response
-
+# Middleware ASGI (ver middleware.py): sin caché para /static sin versionar
+# (los versionados se sirven desde /assets, ver assets.py) y compresión de JSON de la API
 app.add_middleware(NoCacheMiddleware)
+app.add_middleware(CompressionMiddleware)
+
+# Archivos estáticos con hash en el nombre (app.js, styles.css) e index.html reescrito
+@app.on_event("startup")
+async def build_static_assets():
+    try:
+        build_assets()
+    except Exception as e:
+        print(f"⚠️ No se pudieron generar los archivos versionados, se sirve /static: {e}")
+
+# Foto diaria de efectividad (tabla effectiveness_snapshots)
+@app.on_event("startup")
+async def start_snapshot_job():
+    if SNAPSHOT_JOB_ENABLED:
+        app.state.snapshot_task = asyncio.create_task(snapshot_loop())
+
+@app.on_event("shutdown")
+async def stop_snapshot_job():
+    task = getattr(app.state, "snapshot_task", None)
+    if task:
+        task.cancel()
 
 # Crear carpeta uploads si no existe (fallback local)
 UPLOAD_DIR = "uploads"
@@ -653,34 +731,131 @@ app.mount("/static", StaticFiles(directory="static"), name="static")
 app.mount("/uploads", StaticFiles(directory="uploads"), name="uploads")
 
 # ===================== WEBSOCKET MANAGER =====================
-class ConnectionManager:
-    def __init__(self):
-        self.active_connections: dict[str, List[WebSocket]] = {}
-    
-    async def connect(self, websocket: WebSocket, project_id: str):
-        await websocket.accept()
-        if project_id not in self.active_connections:
-            self.active_connections[project_id] = []
-        self.active_connections[project_id].append(websocket)
-    
-    def disconnect(self, websocket: WebSocket, project_id: str):
-        if project_id in self.active_connections:
-            self.active_connections[project_id].remove(websocket)
-    
-    async def broadcast(self, message: dict, project_id: str):
-        if project_id in self.active_connections:
-            for connection in self.active_connections[project_id]:
-                try:
-                    await connection.send_json(message)
-                except:
-                    pass
-
-manager = ConnectionManager()
+# Colas de salida por conexión y difusión sin bloqueo (ver realtime.py). El
+# backend reenvía los mensajes a los clientes conectados a otros workers.
+manager = ConnectionManager(create_broadcast_backend())
+
+@app.on_event("startup")
+async def start_broadcast_backend():
+    await manager.start()
+
+@app.on_event("shutdown")
+async def stop_broadcast_backend():
+    await manager.stop()
+
+# ===================== CACHÉ E INVALIDACIÓN =====================
+DASHBOARD_CACHE_TTL = float(os.getenv("DASHBOARD_CACHE_TTL", "5"))
+dashboard_cache = CacheNamespace(TTLCache(maxsize=1024, ttl=DASHBOARD_CACHE_TTL), "dashboard")  # user_id -> DashboardStats
+# Respuestas de lectura por proyecto; cualquier CacheBackend sirve como almacén.
+# La clave lleva data_version, así ningún worker sirve una respuesta anterior a una escritura.
+RESPONSE_CACHE_TTL = float(os.getenv("RESPONSE_CACHE_TTL", "60"))
+response_cache = ResponseCache(TTLCache(maxsize=2048, ttl=RESPONSE_CACHE_TTL))
+
+def _on_project_write(db: Session, *project_ids: Optional[int]) -> Dict[int, int]:
+    """Llamar después de confirmar cambios en un proyecto o sus datos: el commit ya
+    incrementó data_version de los proyectos tocados (ETag y claves de response_cache);
+    los indicados que no tocó se incrementan aparte. Invalida el dashboard en caché y
+    devuelve las versiones nuevas (para los eventos de WebSocket)."""
+    versions = bump_project_versions(db, project_ids)
+    dashboard_cache.invalidate()
+    return versions
+
+def _on_users_write(db: Session):
+    """Cambios en usuarios: sus nombres y colores aparecen en las respuestas de
+    cualquier proyecto (miembros, responsables, creadores de hitos); el commit ya
+    incrementó la versión de todos los proyectos si cambió alguno de esos campos."""
+    _on_project_write(db)
+
+def _sup_item_project_ids(item) -> set:
+    """Proyectos afectados por un ítem de supervisión (grupo principal y adicionales)"""
+    return {item.grupo.project_id, *[g.project_id for g in item.extra_grupos]}
+
+# ===================== ETAG / 304 =====================
+def _check_etag(request: Request, response: Response, etag: str):
+    """Responde 304 si el cliente ya tiene esta versión; si no, agrega el ETag a la respuesta"""
+    headers = {"ETag": etag, "Cache-Control": "no-cache"}
+    if etag_matches(request, etag):
+        raise HTTPException(status_code=304, headers=headers)
+    response.headers.update(headers)
+
+def project_etag(scope: str):
+    """Dependencia para los GET de datos de un proyecto: ETag derivado de data_version.
+    Si el cliente envía If-None-Match con la versión actual se responde 304 sin ejecutar el endpoint."""
+    def check(project_id: int, request: Request, response: Response, db: Session = Depends(get_db), current_user: CurrentUser = Depends(get_current_user)):
+        version = get_project_version(db, project_id)
+        if version is not None:
+            _check_etag(request, response, make_etag(scope, project_id, version, request.url.query))
+    return check
+
+class CachedView:
+    """Resultado de la dependencia project_response.
+    
+    Si ``hit`` es verdadero el endpoint devuelve ``response()`` sin tocar la base;
+    si no, calcula el resultado y lo pasa por ``store()``, que lo serializa una
+    vez, lo guarda en response_cache y lo devuelve con su ETag.
+    """
+    def __init__(self, key=None, etag=None, adapter=None, payload=None):
+        self.key = key
+        self.etag = etag
+        self.adapter = adapter
+        self.payload = payload
+    
+    @property
+    def hit(self) -> bool:
+        return self.payload is not None
+    
+    def _response(self, payload: CachedPayload) -> Response:
+        return Response(content=payload.body, media_type="application/json",
+                        headers={"ETag": payload.etag, "Cache-Control": "no-cache"})
+    
+    def response(self) -> Response:
+        return self._response(self.payload)
+    
+    def store(self, result):
+        if self.key is None:
+            return result  # proyecto inexistente: sin caché, respuesta normal
+        if self.adapter is not None:
+            body = self.adapter.dump_json(self.adapter.validate_python(result, from_attributes=True))
+        else:
+            body = json.dumps(jsonable_encoder(result), ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+        payload = CachedPayload(self.etag, body)
+        response_cache.set(self.key, payload)
+        return self._response(payload)
+
+def project_response(endpoint: str, model=None, daily: bool = False):
+    """Dependencia de caché para los GET de un proyecto.
+    
+    Siempre lee data_version (una lectura por clave primaria) y con ella arma el
+    ETag y la clave: proyecto, versión, endpoint, alcance del usuario
+    (admin/miembro) y query string; con ``daily`` también la fecha (resultados
+    que dependen del día, p. ej. efectividad). Responde 304 si el cliente ya
+    tiene esa versión, el cuerpo guardado si hay acierto, y si no deja que el
+    endpoint calcule el resultado.
+    """
+    adapter = TypeAdapter(model) if model is not None else None
+    def resolve(project_id: int, request: Request, db: Session = Depends(get_db), current_user: CurrentUser = Depends(get_current_user)) -> CachedView:
+        version = get_project_version(db, project_id)
+        if version is None:
+            return CachedView()
+        day = date.today().isoformat() if daily else None
+        etag = make_etag(endpoint, project_id, version, request.url.query, day)
+        if etag_matches(request, etag):
+            raise HTTPException(status_code=304, headers={"ETag": etag, "Cache-Control": "no-cache"})
+        key = response_cache.key(project_id, version, endpoint, "admin" if current_user.is_admin else "member", request.url.query, day)
+        payload = response_cache.get(key)
+        if payload is not None:
+            return CachedView(payload=payload)
+        return CachedView(key, etag, adapter)
+    return resolve
 
 # ===================== RUTAS PRINCIPALES =====================
 @app.get("/", response_class=HTMLResponse)
-async def root():
-    return FileResponse("static/index.html")
+async def root(request: Request):
+    return index_response(request)
+
+@app.get("/assets/{filename}")
+async def get_asset(filename: str, request: Request):
+    return asset_response(request, filename)
 
 # ===================== AUTENTICACIÓN =====================
 @app.post("/api/auth/register", response_model=UserResponse)
@@ -693,7 +868,7 @@ async def register(user: UserCreate, db: Session = Depends(get_db)):
     user_count = db.query(User).count()
     is_first_user = user_count == 0
     
-    hashed_password = get_password_hash(user.password)
+    hashed_password = await get_password_hash_async(user.password)
     new_user = User(
         name=user.name,
         email=user.email,
@@ -709,9 +884,10 @@ async def register(user: UserCreate, db: Session = Depends(get_db)):
 
 @app.post("/api/auth/login")
 async def login(user: UserLogin, db: Session = Depends(get_db)):
-    db_user = db.query(User).filter(User.email == user.email).first()
-    if not db_user or not verify_password(user.password, db_user.password_hash):
-        raise HTTPException(status_code=401, detail="Credenciales inválidas")
+    async with login_admission():
+        db_user = db.query(User).filter(User.email == user.email).first()
+        if not db_user or not await verify_password_async(user.password, db_user.password_hash):
+            raise HTTPException(status_code=401, detail="Credenciales inválidas")
     
     # Verificar si está aprobado
     if not db_user.is_approved:
@@ -721,12 +897,12 @@ async def login(user: UserLogin, db: Session = Depends(get_db)):
     return {"access_token": token, "token_type": "bearer", "user": UserResponse.model_validate(db_user)}
 
 @app.get("/api/auth/me", response_model=UserResponse)
-async def get_me(current_user: User = Depends(get_current_user)):
+async def get_me(current_user: CurrentUser = Depends(get_current_user)):
     return current_user
 
 # ===================== ADMINISTRACIÓN DE USUARIOS =====================
 @app.get("/api/admin/pending-users", response_model=List[PendingUserResponse])
-async def get_pending_users(db: Session = Depends(get_db), current_user: User = Depends(get_current_user)):
+async def get_pending_users(db: Session = Depends(get_db), current_user: CurrentUser = Depends(get_current_user)):
     if not current_user.is_admin:
         raise HTTPException(status_code=403, detail="Solo administradores pueden ver usuarios pendientes")
     
@@ -734,7 +910,7 @@ async def get_pending_users(db: Session = Depends(get_db), current_user: User =
     return pending
 
 @app.get("/api/admin/all-users", response_model=List[UserResponse])
-async def get_all_users(db: Session = Depends(get_db), current_user: User = Depends(get_current_user)):
+async def get_all_users(db: Session = Depends(get_db), current_user: CurrentUser = Depends(get_current_user)):
     if not current_user.is_admin:
         raise HTTPException(status_code=403, detail="Solo administradores pueden ver usuarios")
     
@@ -742,7 +918,7 @@ async def get_all_users(db: Session = Depends(get_db), current_user: User = Depe
     return users
 
 @app.put("/api/admin/users/{user_id}/approve")
-async def approve_user(user_id: int, approval: UserApproval, db: Session = Depends(get_db), current_user: User = Depends(get_current_user)):
+async def approve_user(user_id: int, approval: UserApproval, db: Session = Depends(get_db), current_user: CurrentUser = Depends(get_current_user)):
     if not current_user.is_admin:
         raise HTTPException(status_code=403, detail="Solo administradores pueden aprobar usuarios")
     
@@ -752,6 +928,7 @@ async def approve_user(user_id: int, approval: UserApproval, db: Session = Depen
     
     if approval.approved:
         user.is_approved = True
+        invalidate_user(user)
         db.commit()
         return {"message": f"Usuario {user.name} aprobado correctamente"}
     else:
@@ -761,7 +938,7 @@ async def approve_user(user_id: int, approval: UserApproval, db: Session = Depen
         return {"message": f"Usuario {user.name} rechazado y eliminado"}
 
 @app.put("/api/admin/users/{user_id}/make-admin")
-async def make_admin(user_id: int, db: Session = Depends(get_db), current_user: User = Depends(get_current_user)):
+async def make_admin(user_id: int, db: Session = Depends(get_db), current_user: CurrentUser = Depends(get_current_user)):
     if not current_user.is_admin:
         raise HTTPException(status_code=403, detail="Solo administradores pueden promover usuarios")
     
@@ -771,11 +948,12 @@ async def make_admin(user_id: int, db: Session = Depends(get_db), current_user:
     
     user.is_admin = True
     user.is_approved = True
+    invalidate_user(user)
     db.commit()
     return {"message": f"Usuario {user.name} es ahora administrador"}
 
 @app.put("/api/admin/users/{user_id}/remove-admin")
-async def remove_admin(user_id: int, db: Session = Depends(get_db), current_user: User = Depends(get_current_user)):
+async def remove_admin(user_id: int, db: Session = Depends(get_db), current_user: CurrentUser = Depends(get_current_user)):
     if not current_user.is_admin:
         raise HTTPException(status_code=403, detail="Solo administradores pueden modificar roles")
     
@@ -787,11 +965,12 @@ async def remove_admin(user_id: int, db: Session = Depends(get_db), current_user
         raise HTTPException(status_code=404, detail="Usuario no encontrado")
     
     user.is_admin = False
+    invalidate_user(user)
     db.commit()
     return {"message": f"Usuario {user.name} ya no es administrador"}
 
 @app.put("/api/admin/users/{user_id}")
-async def update_user(user_id: int, user_data: UserUpdate, db: Session = Depends(get_db), current_user: User = Depends(get_current_user)):
+async def update_user(user_id: int, user_data: UserUpdate, db: Session = Depends(get_db), current_user: CurrentUser = Depends(get_current_user)):
     if not current_user.is_admin:
         raise HTTPException(status_code=403, detail="Solo administradores pueden editar usuarios")
     
@@ -812,16 +991,18 @@ async def update_user(user_id: int, user_data: UserUpdate, db: Session = Depends
             raise HTTPException(status_code=400, detail="Este email ya está en uso")
         user.email = user_data.email
     if user_data.password:
-        user.password = get_password_hash(user_data.password)
+        user.password_hash = await get_password_hash_async(user_data.password)
     if user_data.is_admin is not None:
         user.is_admin = user_data.is_admin
     
+    invalidate_user(user)
     db.commit()
     db.refresh(user)
+    _on_users_write(db)
     return {"message": "Usuario actualizado correctamente"}
 
 @app.delete("/api/admin/users/{user_id}")
-async def delete_user(user_id: int, db: Session = Depends(get_db), current_user: User = Depends(get_current_user)):
+async def delete_user(user_id: int, db: Session = Depends(get_db), current_user: CurrentUser = Depends(get_current_user)):
     if not current_user.is_admin:
         raise HTTPException(status_code=403, detail="Solo administradores pueden eliminar usuarios")
     
@@ -834,102 +1015,114 @@ async def delete_user(user_id: int, db: Session = Depends(get_db), current_user:
     
     db.delete(user)
     db.commit()
+    _on_users_write(db)
     return {"message": f"Usuario {user.name} eliminado"}
 
 # ===================== PROYECTOS =====================
+# Campos disponibles en el listado de proyectos (para selección parcial con ?fields=)
+PROJECT_LIST_FIELDS = (
+    "id", "name", "description", "color", "image_url", "owner_id", "start_date", "end_date",
+    "is_active", "square_meters", "coordinator_id", "leader_id", "supervisor_id", "typology",
+    "work_modality", "perm_estudio_suelo", "perm_levantamiento_topografico", "perm_variables_urbanas",
+    "coordinator", "leader", "supervisor", "created_at", "updated_at", "members",
+)
+PROJECT_ROLE_FIELDS = ("coordinator", "leader", "supervisor")
+
+def _parse_project_fields(fields: Optional[str]) -> tuple:
+    """Valida el parámetro ?fields= y devuelve la tupla de campos a incluir"""
+    if not fields:
+        return PROJECT_LIST_FIELDS
+    requested = [f.strip() for f in fields.split(",") if f.strip()]
+    invalid = [f for f in requested if f not in PROJECT_LIST_FIELDS]
+    if invalid:
+        raise HTTPException(status_code=400, detail=f"Campos no válidos: {', '.join(invalid)}")
+    # Mantener el orden canónico y siempre incluir el id
+    return tuple(f for f in PROJECT_LIST_FIELDS if f in requested or f == "id")
+
+def _role_user_dict(user: Optional[User]) -> Optional[dict]:
+    return {"id": user.id, "name": user.name, "avatar_color": user.avatar_color} if user else None
+
+def _project_to_dict(project: Project, fields: tuple = PROJECT_LIST_FIELDS) -> dict:
+    """Proyección de un proyecto a dict. Solo toca relaciones si el campo fue solicitado."""
+    data = {}
+    for field in fields:
+        if field == "members":
+            data["members"] = [
+                {"id": pm.user.id, "name": pm.user.name, "email": pm.user.email, "avatar_color": pm.user.avatar_color}
+                for pm in project.members if pm.user
+            ]
+        elif field in PROJECT_ROLE_FIELDS:
+            data[field] = _role_user_dict(getattr(project, field))
+        else:
+            data[field] = getattr(project, field, None)
+    return data
+
+def _accessible_project_ids(db: Session, user: CurrentUser) -> Optional[List[int]]:
+    """Ids de proyectos visibles para el usuario (miembro, dueño o líder).
+    Devuelve None para administradores, que ven todos los proyectos."""
+    if user.is_admin:
+        return None
+    rows = db.execute(
+        select(ProjectMember.project_id).where(ProjectMember.user_id == user.id)
+        .union(select(Project.id).where((Project.owner_id == user.id) | (Project.leader_id == user.id)))
+    ).all()
+    return [r[0] for r in rows]
+
 @app.get("/api/projects")
-async def get_projects(db: Session = Depends(get_db), current_user: User = Depends(get_current_user)):
+async def get_projects(request: Request, response: Response, fields: Optional[str] = None, db: Session = Depends(get_db), current_user: CurrentUser = Depends(get_current_user)):
+    """Listado de proyectos con miembros y roles en un número fijo de consultas.
+    
+    - 1 consulta para los proyectos (coordinador, líder y supervisor vía JOIN)
+    - 1 consulta para todos los miembros con su usuario (selectin)
+    Con ?fields=id,name,color,is_active solo se cargan las columnas pedidas.
+    El ETag sale de los (id, data_version) visibles: si no cambió se responde 304.
+    """
+    selected = _parse_project_fields(fields)
+    query = _projects_query(db, current_user)
+    
+    versions = query.with_entities(Project.id, Project.data_version).order_by(Project.id).all()
+    etag = make_etag("projects", current_user.id, current_user.is_admin, ",".join(selected),
+                     *[f"{pid}:{version or 0}" for pid, version in versions])
+    _check_etag(request, response, etag)
+    return _list_projects(db, query, selected)
+
+def _projects_query(db: Session, user: CurrentUser):
+    query = db.query(Project)
+    # Usuarios normales solo ven proyectos donde son miembros (subconsulta, sin ida y vuelta extra)
+    if not user.is_admin:
+        member_project_ids = select(ProjectMember.project_id).where(ProjectMember.user_id == user.id)
+        query = query.filter(Project.id.in_(member_project_ids))
+    return query
+
+def _list_projects(db: Session, query, selected: tuple) -> list:
+    """Proyectos de ``query`` como diccionarios con los campos pedidos"""
     try:
-        # Admins ven todos los proyectos
-        if current_user.is_admin:
-            projects = db.query(Project).all()
-        else:
-            # Usuarios normales solo ven proyectos donde son miembros
-            try:
-                member_project_ids = db.query(ProjectMember.project_id).filter(
-                    ProjectMember.user_id == current_user.id
-                ).all()
-                project_ids = [p[0] for p in member_project_ids]
-                projects = db.query(Project).filter(Project.id.in_(project_ids)).all() if project_ids else []
-            except Exception:
-                # Si falla, mostrar todos los proyectos
-                projects = db.query(Project).all()
+        options = []
+        scalar_fields = [f for f in selected if f not in PROJECT_ROLE_FIELDS and f != "members"]
+        if selected != PROJECT_LIST_FIELDS:
+            options.append(load_only(*[getattr(Project, f) for f in scalar_fields]))
+        for role in PROJECT_ROLE_FIELDS:
+            if role in selected:
+                options.append(joinedload(getattr(Project, role)))
+        if "members" in selected:
+            options.append(selectinload(Project.members).joinedload(ProjectMember.user))
         
-        # Convertir a respuesta con miembros
-        result = []
-        for project in projects:
-            try:
-                members = [
-                    ProjectMemberResponse(
-                        id=pm.user.id,
-                        name=pm.user.name,
-                        email=pm.user.email,
-                        avatar_color=pm.user.avatar_color
-                    ) for pm in project.members if pm.user
-                ]
-            except Exception:
-                members = []
-            
-            result.append({
-                "id": project.id,
-                "name": project.name,
-                "description": project.description,
-                "color": project.color,
-                "image_url": getattr(project, 'image_url', None),
-                "owner_id": project.owner_id,
-                "start_date": project.start_date,
-                "end_date": project.end_date,
-                "is_active": project.is_active,
-                "square_meters": getattr(project, 'square_meters', None),
-                "coordinator_id": getattr(project, 'coordinator_id', None),
-                "leader_id": getattr(project, 'leader_id', None),
-                "supervisor_id": getattr(project, 'supervisor_id', None),
-                "typology": getattr(project, 'typology', None),
-                "work_modality": getattr(project, 'work_modality', None),
-                "perm_estudio_suelo": getattr(project, 'perm_estudio_suelo', False),
-                "perm_levantamiento_topografico": getattr(project, 'perm_levantamiento_topografico', False),
-                "perm_variables_urbanas": getattr(project, 'perm_variables_urbanas', False),
-                "coordinator": {"id": project.coordinator.id, "name": project.coordinator.name, "avatar_color": project.coordinator.avatar_color} if getattr(project, 'coordinator', None) else None,
-                "leader": {"id": project.leader.id, "name": project.leader.name, "avatar_color": project.leader.avatar_color} if getattr(project, 'leader', None) else None,
-                "supervisor": {"id": project.supervisor.id, "name": project.supervisor.name, "avatar_color": project.supervisor.avatar_color} if getattr(project, 'supervisor', None) else None,
-                "created_at": project.created_at,
-                "updated_at": project.updated_at,
-                "members": members
-            })
-        return result
+        projects = query.options(*options).order_by(Project.id).all()
+        return [_project_to_dict(project, selected) for project in projects]
     except Exception as e:
         print(f"Error en get_projects: {e}")
+        db.rollback()
         # Fallback sin miembros
         projects = db.query(Project).all()
+        fallback_fields = tuple(f for f in selected if f not in PROJECT_ROLE_FIELDS and f != "members")
         return [{
-            "id": p.id,
-            "name": p.name,
-            "description": p.description,
-            "color": p.color,
-            "image_url": getattr(p, 'image_url', None),
-            "owner_id": p.owner_id,
-            "start_date": p.start_date,
-            "end_date": p.end_date,
-            "is_active": p.is_active,
-            "square_meters": getattr(p, 'square_meters', None),
-            "coordinator_id": getattr(p, 'coordinator_id', None),
-            "leader_id": getattr(p, 'leader_id', None),
-            "supervisor_id": getattr(p, 'supervisor_id', None),
-            "typology": getattr(p, 'typology', None),
-            "work_modality": getattr(p, 'work_modality', None),
-            "perm_estudio_suelo": getattr(p, 'perm_estudio_suelo', False),
-            "perm_levantamiento_topografico": getattr(p, 'perm_levantamiento_topografico', False),
-            "perm_variables_urbanas": getattr(p, 'perm_variables_urbanas', False),
-            "coordinator": None,
-            "leader": None,
-            "supervisor": None,
-            "created_at": p.created_at,
-            "updated_at": p.updated_at,
-            "members": []
+            **_project_to_dict(p, fallback_fields),
+            **{role: None for role in PROJECT_ROLE_FIELDS if role in selected},
+            **({"members": []} if "members" in selected else {})
         } for p in projects]
 
 @app.post("/api/projects")
-async def create_project(project: ProjectCreate, db: Session = Depends(get_db), current_user: User = Depends(get_current_user)):
+async def create_project(project: ProjectCreate, db: Session = Depends(get_db), current_user: CurrentUser = Depends(get_current_user)):
     # Solo admins pueden crear proyectos
     if not current_user.is_admin:
         raise HTTPException(status_code=403, detail="Solo administradores pueden crear proyectos")
@@ -988,6 +1181,7 @@ async def create_project(project: ProjectCreate, db: Session = Depends(get_db),
     )
     db.add(activity)
     db.commit()
+    _on_project_write(db, new_project.id)
     
     return {
         "id": new_project.id,
@@ -1017,7 +1211,7 @@ async def create_project(project: ProjectCreate, db: Session = Depends(get_db),
     }
 
 @app.put("/api/projects/{project_id}")
-async def update_project(project_id: int, project: ProjectUpdate, db: Session = Depends(get_db), current_user: User = Depends(get_current_user)):
+async def update_project(project_id: int, project: ProjectUpdate, db: Session = Depends(get_db), current_user: CurrentUser = Depends(get_current_user)):
     # Solo admins pueden editar proyectos
     if not current_user.is_admin:
         raise HTTPException(status_code=403, detail="Solo administradores pueden editar proyectos")
@@ -1043,6 +1237,7 @@ async def update_project(project_id: int, project: ProjectUpdate, db: Session =
     
     db.commit()
     db.refresh(db_project)
+    _on_project_write(db, project_id)
     
     # Preparar respuesta con miembros
     members = [
@@ -1078,7 +1273,7 @@ async def update_project(project_id: int, project: ProjectUpdate, db: Session =
     }
 
 @app.delete("/api/projects/{project_id}")
-async def delete_project(project_id: int, db: Session = Depends(get_db), current_user: User = Depends(get_current_user)):
+async def delete_project(project_id: int, db: Session = Depends(get_db), current_user: CurrentUser = Depends(get_current_user)):
     db_project = db.query(Project).filter(Project.id == project_id).first()
     if not db_project:
         raise HTTPException(status_code=404, detail="Proyecto no encontrado")
@@ -1088,8 +1283,11 @@ async def delete_project(project_id: int, db: Session = Depends(get_db), current
     if not current_user.is_admin and not is_coordinator:
         raise HTTPException(status_code=403, detail="Solo administradores o coordinadores pueden eliminar proyectos")
 
+    db.query(EffectivenessSnapshot).filter(EffectivenessSnapshot.project_id == project_id).delete(synchronize_session=False)
+    db.query(ChangeLog).filter(ChangeLog.project_id == project_id).delete(synchronize_session=False)
     db.delete(db_project)
     db.commit()
+    _on_project_write(db, project_id)
     return {"message": "Proyecto eliminado"}
 
 @app.post("/api/projects/{project_id}/upload-image")
@@ -1097,7 +1295,7 @@ async def upload_project_image(
     project_id: int,
     file: UploadFile = File(...),
     db: Session = Depends(get_db),
-    current_user: User = Depends(get_current_user)
+    current_user: CurrentUser = Depends(get_current_user)
 ):
     """Subir imagen para un proyecto"""
     if not current_user.is_admin:
@@ -1163,6 +1361,7 @@ async def upload_project_image(
         db_project.image_url = f"/uploads/{unique_filename}"
     
     db.commit()
+    _on_project_write(db, project_id)
     
     return {"image_url": db_project.image_url, "message": "Imagen subida exitosamente"}
 
@@ -1170,7 +1369,7 @@ async def upload_project_image(
 async def delete_project_image(
     project_id: int,
     db: Session = Depends(get_db),
-    current_user: User = Depends(get_current_user)
+    current_user: CurrentUser = Depends(get_current_user)
 ):
     """Eliminar imagen de un proyecto"""
     if not current_user.is_admin:
@@ -1203,41 +1402,42 @@ async def delete_project_image(
         
         db_project.image_url = None
         db.commit()
+        _on_project_write(db, project_id)
     
     return {"message": "Imagen eliminada"}
 
 # ===================== ETAPAS =====================
 @app.get("/api/projects/{project_id}/stages", response_model=List[StageResponse])
-async def get_stages(project_id: int, db: Session = Depends(get_db), current_user: User = Depends(get_current_user)):
+async def get_stages(project_id: int, db: Session = Depends(get_db), current_user: CurrentUser = Depends(get_current_user),
+                     view: CachedView = Depends(project_response("stages", List[StageResponse]))):
     """Obtener todas las etapas de un proyecto"""
+    if view.hit:
+        return view.response()
+    return view.store(_load_stages(db, project_id))
+
+def _load_stages(db: Session, project_id: int) -> List[dict]:
     stages = db.query(Stage).filter(Stage.project_id == project_id).order_by(Stage.position).all()
     
-    # Calcular progreso de cada etapa basado en sus tareas
-    result = []
-    for stage in stages:
-        stage_tasks = db.query(Task).filter(Task.stage_id == stage.id, Task.status != "restart").all()
-        if stage_tasks:
-            avg_progress = sum(t.progress for t in stage_tasks) / len(stage_tasks)
-        else:
-            avg_progress = 0
-        
-        result.append({
-            "id": stage.id,
-            "project_id": stage.project_id,
-            "name": stage.name,
-            "description": stage.description,
-            "percentage": stage.percentage,
-            "position": stage.position,
-            "start_date": stage.start_date,
-            "end_date": stage.end_date,
-            "created_at": stage.created_at,
-            "progress": round(avg_progress, 1)
-        })
-    
-    return result
+    # Calcular progreso de cada etapa basado en sus tareas (una sola consulta agregada)
+    rollups = get_stage_rollups(db, project_id)
+    return [_stage_to_dict(stage, stage_progress(rollups, stage.id)) for stage in stages]
+
+def _stage_to_dict(stage: Stage, avg_progress: float) -> dict:
+    return {
+        "id": stage.id,
+        "project_id": stage.project_id,
+        "name": stage.name,
+        "description": stage.description,
+        "percentage": stage.percentage,
+        "position": stage.position,
+        "start_date": stage.start_date,
+        "end_date": stage.end_date,
+        "created_at": stage.created_at,
+        "progress": round(avg_progress, 1)
+    }
 
 @app.post("/api/projects/{project_id}/stages", response_model=StageResponse)
-async def create_stage(project_id: int, stage: StageCreate, db: Session = Depends(get_db), current_user: User = Depends(get_current_user)):
+async def create_stage(project_id: int, stage: StageCreate, db: Session = Depends(get_db), current_user: CurrentUser = Depends(get_current_user)):
     """Crear una nueva etapa en un proyecto"""
     if not current_user.is_admin:
         raise HTTPException(status_code=403, detail="Solo administradores pueden crear etapas")
@@ -1274,6 +1474,7 @@ async def create_stage(project_id: int, stage: StageCreate, db: Session = Depend
     db.add(new_stage)
     db.commit()
     db.refresh(new_stage)
+    _on_project_write(db, project_id)
     
     return {
         "id": new_stage.id,
@@ -1289,7 +1490,7 @@ async def create_stage(project_id: int, stage: StageCreate, db: Session = Depend
     }
 
 @app.put("/api/stages/{stage_id}", response_model=StageResponse)
-async def update_stage(stage_id: int, stage: StageUpdate, db: Session = Depends(get_db), current_user: User = Depends(get_current_user)):
+async def update_stage(stage_id: int, stage: StageUpdate, db: Session = Depends(get_db), current_user: CurrentUser = Depends(get_current_user)):
     """Actualizar una etapa"""
     if not current_user.is_admin:
         raise HTTPException(status_code=403, detail="Solo administradores pueden editar etapas")
@@ -1318,10 +1519,10 @@ async def update_stage(stage_id: int, stage: StageUpdate, db: Session = Depends(
     
     db.commit()
     db.refresh(db_stage)
+    _on_project_write(db, db_stage.project_id)
     
     # Calcular progreso
-    stage_tasks = db.query(Task).filter(Task.stage_id == stage_id, Task.status != "restart").all()
-    progress = sum(t.progress for t in stage_tasks) / len(stage_tasks) if stage_tasks else 0
+    progress = stage_progress(get_stage_rollups(db, db_stage.project_id, [stage_id]), stage_id)
     
     return {
         "id": db_stage.id,
@@ -1337,7 +1538,7 @@ async def update_stage(stage_id: int, stage: StageUpdate, db: Session = Depends(
     }
 
 @app.delete("/api/stages/{stage_id}")
-async def delete_stage(stage_id: int, db: Session = Depends(get_db), current_user: User = Depends(get_current_user)):
+async def delete_stage(stage_id: int, db: Session = Depends(get_db), current_user: CurrentUser = Depends(get_current_user)):
     """Eliminar una etapa"""
     if not current_user.is_admin:
         raise HTTPException(status_code=403, detail="Solo administradores pueden eliminar etapas")
@@ -1346,17 +1547,34 @@ async def delete_stage(stage_id: int, db: Session = Depends(get_db), current_use
     if not db_stage:
         raise HTTPException(status_code=404, detail="Etapa no encontrada")
     
-    # Desasociar tareas de esta etapa
+    # Desasociar tareas de esta etapa (actualización masiva: se anota en change_log a mano)
+    for (task_id,) in db.query(Task.id).filter(Task.stage_id == stage_id).all():
+        note_change(db, "task", task_id, db_stage.project_id)
     db.query(Task).filter(Task.stage_id == stage_id).update({"stage_id": None})
+    db.query(EffectivenessSnapshot).filter(EffectivenessSnapshot.stage_id == stage_id).delete(synchronize_session=False)
     
+    project_id = db_stage.project_id
     db.delete(db_stage)
     db.commit()
+    _on_project_write(db, project_id)
     return {"message": "Etapa eliminada"}
 
 # ===================== HITOS (MILESTONES) =====================
 @app.get("/api/projects/{project_id}/milestones")
-async def get_milestones(project_id: int, db: Session = Depends(get_db), current_user: User = Depends(get_current_user)):
-    milestones_list = db.query(Milestone).filter(Milestone.project_id == project_id).order_by(Milestone.date).all()
+async def get_milestones(project_id: int, db: Session = Depends(get_db), current_user: CurrentUser = Depends(get_current_user),
+                         view: CachedView = Depends(project_response("milestones"))):
+    if view.hit:
+        return view.response()
+    return view.store(_load_milestones(db, project_id))
+
+def _load_milestones(db: Session, project_id: int, ids: Optional[List[int]] = None) -> List[dict]:
+    """Hitos del proyecto (o solo ``ids``) con sus adjuntos y creador (adjuntos en una consulta aparte, creador por JOIN)"""
+    query = db.query(Milestone).options(
+        selectinload(Milestone.attachments), joinedload(Milestone.creator)
+    ).filter(Milestone.project_id == project_id)
+    if ids is not None:
+        query = query.filter(Milestone.id.in_(ids))
+    milestones_list = query.order_by(Milestone.date).all()
     result = []
     for m in milestones_list:
         attachments = [
@@ -1376,7 +1594,7 @@ async def get_milestones(project_id: int, db: Session = Depends(get_db), current
     return result
 
 @app.post("/api/projects/{project_id}/milestones")
-async def create_milestone(project_id: int, milestone: MilestoneCreate, db: Session = Depends(get_db), current_user: User = Depends(get_current_user)):
+async def create_milestone(project_id: int, milestone: MilestoneCreate, db: Session = Depends(get_db), current_user: CurrentUser = Depends(get_current_user)):
     if not current_user.is_admin:
         raise HTTPException(status_code=403, detail="Solo administradores pueden crear hitos")
 
@@ -1403,6 +1621,7 @@ async def create_milestone(project_id: int, milestone: MilestoneCreate, db: Sess
     )
     db.add(activity)
     db.commit()
+    _on_project_write(db, project_id)
 
     return {
         "id": new_milestone.id, "project_id": new_milestone.project_id,
@@ -1417,7 +1636,7 @@ async def create_milestone(project_id: int, milestone: MilestoneCreate, db: Sess
     }
 
 @app.put("/api/milestones/{milestone_id}")
-async def update_milestone(milestone_id: int, milestone: MilestoneUpdate, db: Session = Depends(get_db), current_user: User = Depends(get_current_user)):
+async def update_milestone(milestone_id: int, milestone: MilestoneUpdate, db: Session = Depends(get_db), current_user: CurrentUser = Depends(get_current_user)):
     if not current_user.is_admin:
         raise HTTPException(status_code=403, detail="Solo administradores pueden editar hitos")
 
@@ -1431,6 +1650,7 @@ async def update_milestone(milestone_id: int, milestone: MilestoneUpdate, db: Se
 
     db.commit()
     db.refresh(db_milestone)
+    _on_project_write(db, db_milestone.project_id)
 
     attachments = [
         {"id": a.id, "milestone_id": a.milestone_id, "file_url": a.file_url,
@@ -1451,7 +1671,7 @@ async def update_milestone(milestone_id: int, milestone: MilestoneUpdate, db: Se
     }
 
 @app.delete("/api/milestones/{milestone_id}")
-async def delete_milestone(milestone_id: int, db: Session = Depends(get_db), current_user: User = Depends(get_current_user)):
+async def delete_milestone(milestone_id: int, db: Session = Depends(get_db), current_user: CurrentUser = Depends(get_current_user)):
     if not current_user.is_admin:
         raise HTTPException(status_code=403, detail="Solo administradores pueden eliminar hitos")
 
@@ -1475,12 +1695,14 @@ async def delete_milestone(milestone_id: int, db: Session = Depends(get_db), cur
             except Exception:
                 pass
 
+    project_id = db_milestone.project_id
     db.delete(db_milestone)
     db.commit()
+    _on_project_write(db, project_id)
     return {"message": "Hito eliminado"}
 
 @app.post("/api/milestones/{milestone_id}/attachments")
-async def upload_milestone_attachment(milestone_id: int, file: UploadFile = File(...), db: Session = Depends(get_db), current_user: User = Depends(get_current_user)):
+async def upload_milestone_attachment(milestone_id: int, file: UploadFile = File(...), db: Session = Depends(get_db), current_user: CurrentUser = Depends(get_current_user)):
     db_milestone = db.query(Milestone).filter(Milestone.id == milestone_id).first()
     if not db_milestone:
         raise HTTPException(status_code=404, detail="Hito no encontrado")
@@ -1524,6 +1746,7 @@ async def upload_milestone_attachment(milestone_id: int, file: UploadFile = File
     db.add(attachment)
     db.commit()
     db.refresh(attachment)
+    _on_project_write(db, db_milestone.project_id)
 
     return {
         "id": attachment.id, "milestone_id": attachment.milestone_id,
@@ -1533,7 +1756,7 @@ async def upload_milestone_attachment(milestone_id: int, file: UploadFile = File
     }
 
 @app.delete("/api/milestones/{milestone_id}/attachments/{attachment_id}")
-async def delete_milestone_attachment(milestone_id: int, attachment_id: int, db: Session = Depends(get_db), current_user: User = Depends(get_current_user)):
+async def delete_milestone_attachment(milestone_id: int, attachment_id: int, db: Session = Depends(get_db), current_user: CurrentUser = Depends(get_current_user)):
     if not current_user.is_admin:
         raise HTTPException(status_code=403, detail="Solo administradores pueden eliminar adjuntos")
 
@@ -1558,142 +1781,260 @@ async def delete_milestone_attachment(milestone_id: int, attachment_id: int, db:
         except Exception:
             pass
 
+    project_id = attachment.milestone.project_id
     db.delete(attachment)
     db.commit()
+    _on_project_write(db, project_id)
     return {"message": "Adjunto eliminado"}
 
 # ===================== EFECTIVIDAD =====================
 @app.get("/api/projects/{project_id}/effectiveness")
-async def get_project_effectiveness(project_id: int, db: Session = Depends(get_db), current_user: User = Depends(get_current_user)):
+async def get_project_effectiveness(project_id: int, db: Session = Depends(get_db), current_user: CurrentUser = Depends(get_current_user),
+                                    view: CachedView = Depends(project_response("effectiveness", daily=True))):
     """Calcular métrica de efectividad del proyecto"""
+    if view.hit:
+        return view.response()
     project = db.query(Project).filter(Project.id == project_id).first()
     if not project:
         raise HTTPException(status_code=404, detail="Proyecto no encontrado")
     
+    result = load_effectiveness(db, [project_id])[project_id]
+    return view.store({
+        "project_id": project_id,
+        "project_name": project.name,
+        "metrics": result["metrics"],
+        "stages": result["stages"],
+        "tasks": result["tasks"]
+    })
+
+# ===================== SNAPSHOT DEL PROYECTO =====================
+@app.get("/api/projects/{project_id}/snapshot")
+async def get_project_snapshot(project_id: int, db: Session = Depends(get_db), current_user: CurrentUser = Depends(get_current_user),
+                               view: CachedView = Depends(project_response("snapshot", daily=True))):
+    """Todo lo que se muestra al abrir un proyecto en una sola respuesta.
+    
+    Tareas y etapas se leen una sola vez; el progreso por etapa y la efectividad
+    se calculan en memoria sobre esas filas. ``version`` es el data_version del
+    proyecto leído antes que los datos (los datos son al menos de esa versión).
+    """
+    if view.hit:
+        return view.response()
+    project = db.query(Project.id, Project.name, Project.data_version).filter(Project.id == project_id).first()
+    if not project:
+        raise HTTPException(status_code=404, detail="Proyecto no encontrado")
+    
+    tasks = db.query(Task).filter(Task.project_id == project_id).order_by(Task.position).all()
     stages = db.query(Stage).filter(Stage.project_id == project_id).order_by(Stage.position).all()
-    today = datetime.now()
-    today = today.replace(hour=23, minute=59, second=59)  # Fin del día de hoy
-    
-    scheduled_progress = 0.0
-    actual_progress = 0.0
-    stage_details = []
-    task_details = []
-    
-    # Calcular efectividad basada en todas las tareas del proyecto
-    all_tasks = db.query(Task).filter(Task.project_id == project_id).all()
-    tasks_with_dates = [t for t in all_tasks if t.start_date and t.due_date and t.status != "restart"]
-    
-    for task in tasks_with_dates:
-        task_scheduled = 0.0
-        start_date = task.start_date.replace(hour=0, minute=0, second=0)
-        end_date = task.due_date.replace(hour=23, minute=59, second=59)
-        
-        if today >= end_date:
-            task_scheduled = 100.0  # Ya debería estar completa
-        elif today >= start_date:
-            # Calcular días totales de la tarea (incluye día inicio y fin)
-            total_days = (end_date - start_date).days + 1
-            total_days = max(1, total_days)
-            # Días transcurridos desde el inicio hasta hoy
-            elapsed_days = (today - start_date).days + 1  # +1 porque hoy cuenta
-            task_scheduled = min(100.0, (elapsed_days / total_days) * 100)
-        # else: task_scheduled = 0 (aún no ha comenzado)
-        
-        # Efectividad de la tarea
-        if task_scheduled > 0:
-            task_effectiveness = (task.progress / task_scheduled) * 100
-        else:
-            task_effectiveness = 100.0 if task.progress == 0 else 100.0  # Adelantado si tiene progreso antes de empezar
-        
-        task_details.append({
-            "id": task.id,
-            "title": task.title,
-            "scheduled_progress": round(task_scheduled, 1),
-            "actual_progress": task.progress,
-            "effectiveness": round(task_effectiveness, 1)
-        })
     
-    # Si hay etapas, también calcular por etapas (excluyendo las que no tienen fechas)
-    for stage in stages:
-        stage_scheduled = 0.0
-        # Verificar si la etapa debe excluirse del cálculo de efectividad
-        exclude_from_calc = stage.exclude_from_effectiveness or (not stage.start_date and not stage.end_date)
-        
-        if stage.start_date and stage.end_date:
-            stage_start = stage.start_date.replace(hour=0, minute=0, second=0)
-            stage_end = stage.end_date.replace(hour=23, minute=59, second=59)
-            
-            if today >= stage_end:
-                stage_scheduled = 100.0
-            elif today >= stage_start:
-                total_days = max(1, (stage_end - stage_start).days)
-                elapsed_days = (today - stage_start).days + 1
-                stage_scheduled = min(100.0, (elapsed_days / total_days) * 100)
-        
-        stage_tasks = db.query(Task).filter(Task.stage_id == stage.id, Task.status != "restart").all()
-        if stage_tasks:
-            stage_actual = sum(t.progress for t in stage_tasks) / len(stage_tasks)
-        else:
-            stage_actual = 0.0
-        
-        stage_details.append({
-            "id": stage.id,
-            "name": stage.name,
-            "percentage": stage.percentage,
-            "scheduled_progress": round(stage_scheduled, 1),
-            "actual_progress": round(stage_actual, 1),
-            "start_date": stage.start_date.isoformat() if stage.start_date else None,
-            "end_date": stage.end_date.isoformat() if stage.end_date else None,
-            "exclude_from_effectiveness": exclude_from_calc
-        })
-
-    # Calcular promedio global: preferir etapas con fechas
-    eligible_stages = [s for s in stage_details if s["start_date"] and s["end_date"] and not s["exclude_from_effectiveness"]]
-    if eligible_stages:
-        scheduled_progress = sum(s["scheduled_progress"] for s in eligible_stages) / len(eligible_stages)
-        actual_progress = sum(s["actual_progress"] for s in eligible_stages) / len(eligible_stages)
-    elif tasks_with_dates:
-        scheduled_progress = sum(t["scheduled_progress"] for t in task_details) / len(task_details)
-        actual_progress = sum(t["actual_progress"] for t in task_details) / len(task_details)
-    
-    # Calcular efectividad global
-    if scheduled_progress > 0:
-        effectiveness = (actual_progress / scheduled_progress) * 100
-    else:
-        effectiveness = 0.0
-    
-    # Determinar estado
-    if scheduled_progress == 0 and actual_progress == 0:
-        status = "en_tiempo"
-    elif effectiveness >= 100:
-        status = "adelantado"
-    elif effectiveness >= 90:
-        status = "en_tiempo"
-    else:
-        status = "atrasado"
+    # Progreso por etapa: promedio de sus tareas sin contar las de reinicio (igual que get_stage_rollups)
+    stage_tasks_progress = {}
+    for t in tasks:
+        if t.stage_id is not None and t.status != "restart":
+            stage_tasks_progress.setdefault(t.stage_id, []).append(float(t.progress or 0))
     
-    # Calcular diferencia de porcentaje
-    progress_difference = actual_progress - scheduled_progress
+    task_rows = [tuple(getattr(t, column.key) for column in TASK_COLUMNS) for t in sorted(tasks, key=lambda t: t.id)]
+    stage_rows = [tuple(getattr(s, column.key) for column in STAGE_COLUMNS) for s in stages]
+    effectiveness = compute_effectiveness(task_rows, stage_rows).get(project_id) or empty_effectiveness()
     
-    return {
+    return view.store({
         "project_id": project_id,
-        "project_name": project.name,
-        "metrics": {
-            "scheduled_progress": round(scheduled_progress, 1),
-            "actual_progress": round(actual_progress, 1),
-            "effectiveness": round(effectiveness, 1),
-            "status": status,
-            "progress_difference": round(progress_difference, 1)
+        "version": project.data_version or 0,
+        "tasks": _tasks_to_responses(db, tasks),
+        "stages": [
+            StageResponse.model_validate(_stage_to_dict(
+                s, sum(stage_tasks_progress[s.id]) / len(stage_tasks_progress[s.id]) if s.id in stage_tasks_progress else 0.0
+            ))
+            for s in stages
+        ],
+        "milestones": _load_milestones(db, project_id),
+        "effectiveness": {
+            "project_id": project_id,
+            "project_name": project.name,
+            "metrics": effectiveness["metrics"],
+            "stages": effectiveness["stages"],
+            "tasks": effectiveness["tasks"]
+        },
+        "supervision": {
+            "resumen": [SupResumenItemResponse.model_validate(i) for i in
+                        db.query(SupResumenItem).filter(SupResumenItem.project_id == project_id).order_by(SupResumenItem.position).all()],
+            "compras": [SupComprasGrupoResponse.model_validate(g) for g in
+                        _load_sup_grupos(db, project_id, SupComprasGrupo, SupComprasItem, sup_compras_item_grupos)],
+            "servicios": [SupServiciosGrupoResponse.model_validate(g) for g in
+                          _load_sup_grupos(db, project_id, SupServiciosGrupo, SupServiciosItem, sup_servicios_item_grupos)],
         },
-        "stages": stage_details,
-        "tasks": task_details
+    })
+
+# ===================== CAMBIOS DESDE UNA VERSIÓN =====================
+def _parse_since(since: str):
+    """?since= acepta una versión (entero) o una fecha ISO; devuelve (versión, fecha UTC sin zona)"""
+    if since.isdigit():
+        return int(since), None
+    try:
+        moment = datetime.fromisoformat(since.replace("Z", "+00:00"))
+    except ValueError:
+        raise HTTPException(status_code=400, detail="since debe ser una versión o una fecha ISO")
+    if moment.tzinfo is not None:
+        moment = moment.astimezone(timezone.utc).replace(tzinfo=None)
+    return None, moment
+
+@app.get("/api/projects/{project_id}/changes")
+async def get_project_changes(project_id: int, since: str, db: Session = Depends(get_db), current_user: CurrentUser = Depends(get_current_user)):
+    """Tareas, etapas, hitos y supervisión que cambiaron desde una versión (o fecha).
+    
+    Lee change_log para saber qué cambió y trae solo esas filas de sus tablas.
+    Los borrados llegan como ``deleted: [{"type", "id"}]``. Las etapas, compras y
+    servicios se devuelven completos cuando algo suyo cambió (el progreso de las
+    etapas depende de las tareas); si no cambiaron vienen en null.
+    Con ``full_reload`` el registro ya no cubre ese punto y hay que recargar todo.
+    """
+    project = db.query(Project.id, Project.data_version).filter(Project.id == project_id).first()
+    if not project:
+        raise HTTPException(status_code=404, detail="Proyecto no encontrado")
+    version = project.data_version or 0
+    since_version, since_time = _parse_since(since)
+    
+    entries = None if since_version is not None and since_version > version else \
+        changes_since(db, project_id, version=since_version, since=since_time)
+    if entries is None:
+        return {"project_id": project_id, "version": version, "full_reload": True}
+    
+    latest = {}
+    for entry in entries:
+        latest[(entry.entity_type, entry.entity_id)] = entry.action
+        version = max(version, entry.version)
+    upserted = {}
+    for (entity_type, entity_id), action in latest.items():
+        if action == "upsert":
+            upserted.setdefault(entity_type, []).append(entity_id)
+    changed_types = {entity_type for entity_type, _ in latest}
+    
+    task_ids = upserted.get("task")
+    tasks = db.query(Task).filter(Task.project_id == project_id, Task.id.in_(task_ids)).order_by(Task.position).all() if task_ids else []
+    resumen_ids = upserted.get("sup_resumen")
+    resumen = db.query(SupResumenItem).filter(
+        SupResumenItem.project_id == project_id, SupResumenItem.id.in_(resumen_ids)
+    ).order_by(SupResumenItem.position).all() if resumen_ids else []
+    
+    return {
+        "project_id": project_id,
+        "version": version,
+        "full_reload": False,
+        "tasks": _tasks_to_responses(db, tasks),
+        "stages": [StageResponse.model_validate(s) for s in _load_stages(db, project_id)]
+                  if changed_types & {"task", "stage"} else None,
+        "milestones": _load_milestones(db, project_id, upserted["milestone"]) if upserted.get("milestone") else [],
+        "sup_resumen": [SupResumenItemResponse.model_validate(i) for i in resumen],
+        "sup_compras": [SupComprasGrupoResponse.model_validate(g) for g in
+                        _load_sup_grupos(db, project_id, SupComprasGrupo, SupComprasItem, sup_compras_item_grupos)]
+                       if changed_types & {"sup_compras_grupo", "sup_compras_item"} else None,
+        "sup_servicios": [SupServiciosGrupoResponse.model_validate(g) for g in
+                          _load_sup_grupos(db, project_id, SupServiciosGrupo, SupServiciosItem, sup_servicios_item_grupos)]
+                         if changed_types & {"sup_servicios_grupo", "sup_servicios_item"} else None,
+        "deleted": [{"type": entity_type, "id": entity_id}
+                    for (entity_type, entity_id), action in latest.items() if action == "delete"],
     }
 
+@app.get("/api/projects/{project_id}/effectiveness/trend")
+async def get_effectiveness_trend(
+    project_id: int,
+    start: Optional[date] = None,
+    end: Optional[date] = None,
+    include_stages: bool = False,
+    db: Session = Depends(get_db),
+    current_user: CurrentUser = Depends(get_current_user)
+):
+    """Tendencia diaria de efectividad leída de effectiveness_snapshots (por defecto últimos 30 días)"""
+    project = db.query(Project.id).filter(Project.id == project_id).first()
+    if not project:
+        raise HTTPException(status_code=404, detail="Proyecto no encontrado")
+    
+    end = end or date.today()
+    start = start or end - timedelta(days=30)
+    if start > end:
+        raise HTTPException(status_code=400, detail="La fecha inicial debe ser anterior a la final")
+    
+    query = db.query(
+        EffectivenessSnapshot.snapshot_date, EffectivenessSnapshot.stage_id,
+        EffectivenessSnapshot.scheduled_progress, EffectivenessSnapshot.actual_progress,
+        EffectivenessSnapshot.effectiveness, EffectivenessSnapshot.status,
+        EffectivenessSnapshot.total_tasks, EffectivenessSnapshot.completed_tasks
+    ).filter(
+        EffectivenessSnapshot.project_id == project_id,
+        EffectivenessSnapshot.snapshot_date >= start,
+        EffectivenessSnapshot.snapshot_date <= end
+    )
+    if not include_stages:
+        query = query.filter(EffectivenessSnapshot.stage_id.is_(None))
+    
+    points = []
+    stages = {}
+    for row in query.order_by(EffectivenessSnapshot.snapshot_date).all():
+        point = {
+            "date": row.snapshot_date.isoformat(),
+            "scheduled_progress": row.scheduled_progress,
+            "actual_progress": row.actual_progress,
+            "effectiveness": row.effectiveness
+        }
+        if row.stage_id is None:
+            point.update(status=row.status, total_tasks=row.total_tasks, completed_tasks=row.completed_tasks)
+            points.append(point)
+        else:
+            stages.setdefault(row.stage_id, []).append(point)
+    
+    response = {"project_id": project_id, "start": start.isoformat(), "end": end.isoformat(), "points": points}
+    if include_stages:
+        response["stages"] = [{"stage_id": stage_id, "points": pts} for stage_id, pts in stages.items()]
+    return response
+
+@app.get("/api/effectiveness")
+async def get_portfolio_effectiveness(project_ids: Optional[str] = None, details: bool = False, db: Session = Depends(get_db), current_user: CurrentUser = Depends(get_current_user)):
+    """Efectividad de varios proyectos en una sola respuesta (?project_ids=1,2,3).
+    Sin project_ids devuelve todos los proyectos visibles para el usuario.
+    Con details=true incluye el desglose por etapas y tareas."""
+    try:
+        requested = [int(x) for x in project_ids.split(",") if x.strip()] if project_ids else None
+    except ValueError:
+        raise HTTPException(status_code=400, detail="project_ids debe ser una lista de enteros separados por coma")
+    
+    query = db.query(Project.id, Project.name)
+    accessible = _accessible_project_ids(db, current_user)
+    if accessible is not None:
+        query = query.filter(Project.id.in_(accessible))
+    if requested is not None:
+        query = query.filter(Project.id.in_(requested))
+    projects = query.order_by(Project.id).all()
+    
+    results = load_effectiveness(db, [p.id for p in projects])
+    response = []
+    for p in projects:
+        item = {"project_id": p.id, "project_name": p.name, "metrics": results[p.id]["metrics"]}
+        if details:
+            item["stages"] = results[p.id]["stages"]
+            item["tasks"] = results[p.id]["tasks"]
+        response.append(item)
+    return response
+
 # ===================== TAREAS =====================
-@app.get("/api/projects/{project_id}/tasks", response_model=List[TaskResponse])
-async def get_tasks(project_id: int, db: Session = Depends(get_db), current_user: User = Depends(get_current_user)):
-    tasks = db.query(Task).filter(Task.project_id == project_id).order_by(Task.position).all()
-    # Convertir a TaskResponse con assignee_ids y sup grupos
+def _task_association_ids(db: Session, task_ids: List[int]):
+    """Ids de asignados y grupos de supervisión de varias tareas (una consulta por tabla de asociación)"""
+    result = {"assignee_ids": {}, "sup_compras_grupo_ids": {}, "sup_servicios_grupo_ids": {}}
+    if not task_ids:
+        return result
+    for key, table, column in (
+        ("assignee_ids", task_assignees, task_assignees.c.user_id),
+        ("sup_compras_grupo_ids", task_sup_compras_grupos, task_sup_compras_grupos.c.grupo_id),
+        ("sup_servicios_grupo_ids", task_sup_servicios_grupos, task_sup_servicios_grupos.c.grupo_id),
+    ):
+        rows = db.execute(
+            select(table.c.task_id, column).where(table.c.task_id.in_(task_ids)).order_by(table.c.task_id, column)
+        ).all()
+        for task_id, related_id in rows:
+            result[key].setdefault(task_id, []).append(related_id)
+    return result
+
+def _tasks_to_responses(db: Session, tasks: List[Task]) -> List[TaskResponse]:
+    """Convertir tareas a TaskResponse sin cargar relaciones tarea por tarea"""
+    ids = _task_association_ids(db, [t.id for t in tasks])
     return [
         TaskResponse(
             id=t.id,
@@ -1703,9 +2044,9 @@ async def get_tasks(project_id: int, db: Session = Depends(get_db), current_user
             priority=t.priority,
             project_id=t.project_id,
             stage_id=t.stage_id,
-            assignee_ids=[u.id for u in t.assignees],
-            sup_compras_grupo_ids=[g.id for g in t.sup_compras_grupos],
-            sup_servicios_grupo_ids=[g.id for g in t.sup_servicios_grupos],
+            assignee_ids=ids["assignee_ids"].get(t.id, []),
+            sup_compras_grupo_ids=ids["sup_compras_grupo_ids"].get(t.id, []),
+            sup_servicios_grupo_ids=ids["sup_servicios_grupo_ids"].get(t.id, []),
             position=t.position,
             start_date=t.start_date,
             due_date=t.due_date,
@@ -1715,8 +2056,90 @@ async def get_tasks(project_id: int, db: Session = Depends(get_db), current_user
         ) for t in tasks
     ]
 
+@app.get("/api/projects/{project_id}/tasks", response_model=List[TaskResponse])
+async def get_tasks(project_id: int, db: Session = Depends(get_db), current_user: CurrentUser = Depends(get_current_user),
+                    view: CachedView = Depends(project_response("tasks", List[TaskResponse]))):
+    if view.hit:
+        return view.response()
+    tasks = db.query(Task).filter(Task.project_id == project_id).order_by(Task.position).all()
+    return view.store(_tasks_to_responses(db, tasks))
+
+BOARD_PAGE_MAX = 500
+
+def _board_cursor(task: Task) -> str:
+    """Cursor del tablero: "status,position,id" de la última tarea recibida (vacío = NULL)"""
+    status_value = "" if task.status is None else task.status
+    position = "" if task.position is None else task.position
+    return f"{status_value},{position},{task.id}"
+
+def _parse_board_cursor(cursor: str):
+    try:
+        status_value, position, task_id = cursor.rsplit(",", 2)
+        return status_value or None, int(position) if position else None, int(task_id)
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Cursor no válido")
+
+def _board_after(status_value: Optional[str], position: Optional[int], task_id: int):
+    """Tareas posteriores al cursor en el orden (status, position, id) de ix_tasks_board.
+    SQLite y MySQL ordenan NULL primero; se compara con IS NULL sobre las columnas
+    tal cual (sin coalesce) para que el índice siga sirviendo."""
+    if position is None:
+        same_status = or_(Task.position.isnot(None), and_(Task.position.is_(None), Task.id > task_id))
+    else:
+        same_status = or_(Task.position > position, and_(Task.position == position, Task.id > task_id))
+    if status_value is None:
+        return or_(Task.status.isnot(None), and_(Task.status.is_(None), same_status))
+    return or_(Task.status > status_value, and_(Task.status == status_value, same_status))
+
+@app.get("/api/projects/{project_id}/tasks/board", dependencies=[Depends(project_etag("board"))])
+async def get_task_board(
+    project_id: int,
+    status: Optional[str] = None,
+    stage_id: Optional[int] = None,
+    assignee_id: Optional[int] = None,
+    after: Optional[str] = None,
+    limit: int = 100,
+    db: Session = Depends(get_db),
+    current_user: CurrentUser = Depends(get_current_user)
+):
+    """Tareas del tablero paginadas por cursor sobre (status, position, id).
+    Permite cargar cada columna por separado (?status=todo) y seguir con ?after=<next_cursor>."""
+    limit = max(1, min(limit, BOARD_PAGE_MAX))
+    query = db.query(Task).filter(Task.project_id == project_id)
+    if status:
+        query = query.filter(Task.status == status)
+    if stage_id is not None:
+        query = query.filter(Task.stage_id == stage_id)
+    if assignee_id is not None:
+        query = query.filter(Task.id.in_(
+            select(task_assignees.c.task_id).where(task_assignees.c.user_id == assignee_id)
+        ))
+    if after:
+        query = query.filter(_board_after(*_parse_board_cursor(after)))
+    
+    tasks = query.order_by(Task.status, Task.position, Task.id).limit(limit + 1).all()
+    has_more = len(tasks) > limit
+    tasks = tasks[:limit]
+    next_cursor = _board_cursor(tasks[-1]) if has_more else None
+    return {"tasks": _tasks_to_responses(db, tasks), "next_cursor": next_cursor}
+
+# Columnas de la tarea que viajan como delta en los eventos task_updated
+TASK_EVENT_FIELDS = ("title", "description", "status", "priority", "stage_id", "position", "start_date", "due_date", "progress")
+
+def _task_state(db_task: Task) -> dict:
+    return {field: getattr(db_task, field) for field in TASK_EVENT_FIELDS}
+
+def _task_changes(before: dict, db_task: Task, **extra) -> dict:
+    """Delta de una tarea para el WebSocket: columnas que cambiaron desde ``before``,
+    más ``extra`` (listas de ids modificadas) y updated_at"""
+    after = _task_state(db_task)
+    changes = {field: value for field, value in after.items() if before[field] != value}
+    changes.update(extra)
+    changes["updated_at"] = db_task.updated_at
+    return jsonable_encoder(changes)
+
 @app.post("/api/projects/{project_id}/tasks", response_model=TaskResponse)
-async def create_task(project_id: int, task: TaskCreate, db: Session = Depends(get_db), current_user: User = Depends(get_current_user)):
+async def create_task(project_id: int, task: TaskCreate, db: Session = Depends(get_db), current_user: CurrentUser = Depends(get_current_user)):
     # Verificar si es admin o líder del proyecto
     project = db.query(Project).filter(Project.id == project_id).first()
     if not project:
@@ -1805,16 +2228,18 @@ async def create_task(project_id: int, task: TaskCreate, db: Session = Depends(g
         updated_at=new_task.updated_at
     )
     
-    # Broadcast a todos los conectados
-    await manager.broadcast({
+    versions = _on_project_write(db, project_id)
+    
+    # Evento para los conectados al proyecto (se agrupa con los de la misma ráfaga)
+    manager.publish_event(str(project_id), {
         "type": "task_created",
         "task": task_response.model_dump(mode='json')
-    }, str(project_id))
+    }, versions.get(project_id))
     
     return task_response
 
 @app.put("/api/tasks/{task_id}", response_model=TaskResponse)
-async def update_task(task_id: int, task: TaskUpdate, db: Session = Depends(get_db), current_user: User = Depends(get_current_user)):
+async def update_task(task_id: int, task: TaskUpdate, db: Session = Depends(get_db), current_user: CurrentUser = Depends(get_current_user)):
     db_task = db.query(Task).filter(Task.id == task_id).first()
     if not db_task:
         raise HTTPException(status_code=404, detail="Tarea no encontrada")
@@ -1843,7 +2268,8 @@ async def update_task(task_id: int, task: TaskUpdate, db: Session = Depends(get_
         if not update_fields.issubset(allowed_fields):
             raise HTTPException(status_code=403, detail="Solo puedes actualizar estado, descripción, progreso y etapa de tus tareas")
     
-    # Guardar valores anteriores para el historial
+    # Guardar valores anteriores para el historial y el delta del WebSocket
+    before = _task_state(db_task)
     old_assignee_ids = [u.id for u in db_task.assignees]
     old_values = {
         'status': db_task.status,
@@ -1908,6 +2334,7 @@ async def update_task(task_id: int, task: TaskUpdate, db: Session = Depends(get_
     db.refresh(db_task)
 
     # Si se marcó como reinicio, crear una copia para rehacer la tarea
+    new_task_response = None
     if current_user.is_admin and old_status != "restart" and db_task.status == "restart":
         last_task = db.query(Task).filter(
             Task.project_id == db_task.project_id,
@@ -1945,7 +2372,7 @@ async def update_task(task_id: int, task: TaskUpdate, db: Session = Depends(get_
         db.add(activity_new)
         db.commit()
 
-        # Broadcast de la nueva tarea
+        # Respuesta de la nueva tarea (se difunde junto con la actualización)
         new_task_response = TaskResponse(
             id=new_task.id,
             title=new_task.title,
@@ -1962,10 +2389,6 @@ async def update_task(task_id: int, task: TaskUpdate, db: Session = Depends(get_
             created_at=new_task.created_at,
             updated_at=new_task.updated_at
         )
-        await manager.broadcast({
-            "type": "task_created",
-            "task": new_task_response.model_dump(mode='json')
-        }, str(db_task.project_id))
     
     # Registrar historial de cambios
     field_labels = {
@@ -2122,16 +2545,30 @@ async def update_task(task_id: int, task: TaskUpdate, db: Session = Depends(get_
         updated_at=db_task.updated_at
     )
     
-    # Broadcast
-    await manager.broadcast({
+    versions = _on_project_write(db, db_task.project_id)
+    
+    # Solo los campos que cambiaron (las listas de ids si el cliente las envió)
+    changed_lists = {
+        key: getattr(task_response, key)
+        for key in ('assignee_ids', 'sup_compras_grupo_ids', 'sup_servicios_grupo_ids')
+        if getattr(task, key) is not None
+    }
+    version = versions.get(db_task.project_id)
+    manager.publish_event(str(db_task.project_id), {
         "type": "task_updated",
-        "task": task_response.model_dump(mode='json')
-    }, str(db_task.project_id))
+        "task_id": db_task.id,
+        "changes": _task_changes(before, db_task, **changed_lists)
+    }, version)
+    if new_task_response is not None:
+        manager.publish_event(str(db_task.project_id), {
+            "type": "task_created",
+            "task": new_task_response.model_dump(mode='json')
+        }, version)
     
     return task_response
 
 @app.delete("/api/tasks/{task_id}")
-async def delete_task(task_id: int, db: Session = Depends(get_db), current_user: User = Depends(get_current_user)):
+async def delete_task(task_id: int, db: Session = Depends(get_db), current_user: CurrentUser = Depends(get_current_user)):
     # Solo admins pueden eliminar tareas
     if not current_user.is_admin:
         raise HTTPException(status_code=403, detail="Solo administradores pueden eliminar tareas")
@@ -2143,45 +2580,70 @@ async def delete_task(task_id: int, db: Session = Depends(get_db), current_user:
     project_id = db_task.project_id
     db.delete(db_task)
     db.commit()
+    versions = _on_project_write(db, project_id)
     
-    await manager.broadcast({
+    manager.publish_event(str(project_id), {
         "type": "task_deleted",
         "task_id": task_id
-    }, str(project_id))
+    }, versions.get(project_id))
     
     return {"message": "Tarea eliminada"}
 
 # ===================== HISTORIAL DE CAMBIOS DE TAREA =====================
+HISTORY_PAGE_MAX = 200
+
+def _history_page(query, model, before: Optional[str], limit: int, response: Response):
+    """Página de un historial ordenado por (created_at, id) descendente.
+    ``before`` es el cursor "created_at,id" del último registro recibido; si quedan
+    más registros se devuelve el siguiente cursor en la cabecera X-Next-Cursor."""
+    limit = max(1, min(limit, HISTORY_PAGE_MAX))
+    if before:
+        try:
+            created_at, entry_id = before.rsplit(",", 1)
+            created_at, entry_id = datetime.fromisoformat(created_at), int(entry_id)
+        except ValueError:
+            raise HTTPException(status_code=400, detail="Cursor no válido")
+        query = query.filter(or_(
+            model.created_at < created_at,
+            and_(model.created_at == created_at, model.id < entry_id)
+        ))
+    rows = query.order_by(model.created_at.desc(), model.id.desc()).limit(limit + 1).all()
+    if len(rows) > limit:
+        rows = rows[:limit]
+        last = rows[-1][0]
+        response.headers["X-Next-Cursor"] = f"{last.created_at.isoformat()},{last.id}"
+    return rows
+
 @app.get("/api/tasks/{task_id}/history")
-async def get_task_history(task_id: int, db: Session = Depends(get_db), current_user: User = Depends(get_current_user)):
-    """Obtener el historial de cambios de una tarea"""
-    db_task = db.query(Task).filter(Task.id == task_id).first()
+async def get_task_history(task_id: int, response: Response, before: Optional[str] = None, limit: int = 50, db: Session = Depends(get_db), current_user: CurrentUser = Depends(get_current_user)):
+    """Obtener el historial de cambios de una tarea (paginado con ?before=<cursor>&limit=)"""
+    db_task = db.query(Task.id).filter(Task.id == task_id).first()
     if not db_task:
         raise HTTPException(status_code=404, detail="Tarea no encontrada")
     
-    # Obtener historial ordenado por fecha descendente
-    history = db.query(TaskHistory).filter(TaskHistory.task_id == task_id).order_by(TaskHistory.created_at.desc()).all()
+    # Historial ordenado por fecha descendente, con el usuario en la misma consulta
+    query = db.query(TaskHistory, User.name, User.avatar_color).outerjoin(
+        User, User.id == TaskHistory.user_id
+    ).filter(TaskHistory.task_id == task_id)
     
-    result = []
-    for entry in history:
-        user = db.query(User).filter(User.id == entry.user_id).first()
-        result.append({
+    return [
+        {
             "id": entry.id,
             "task_id": entry.task_id,
             "user_id": entry.user_id,
-            "user_name": user.name if user else "Usuario desconocido",
-            "user_avatar_color": user.avatar_color if user else "#6366f1",
+            "user_name": user_name if user_name is not None else "Usuario desconocido",
+            "user_avatar_color": user_avatar_color if user_name is not None else "#6366f1",
             "field_name": entry.field_name,
             "old_value": entry.old_value,
             "new_value": entry.new_value,
             "created_at": entry.created_at.isoformat()
-        })
-    
-    return result
+        }
+        for entry, user_name, user_avatar_color in _history_page(query, TaskHistory, before, limit, response)
+    ]
 
 # ===================== REGISTRO DE AVANCES =====================
 @app.post("/api/tasks/{task_id}/progress", response_model=TaskProgressResponse)
-async def register_progress(task_id: int, progress_data: TaskProgressCreate, db: Session = Depends(get_db), current_user: User = Depends(get_current_user)):
+async def register_progress(task_id: int, progress_data: TaskProgressCreate, db: Session = Depends(get_db), current_user: CurrentUser = Depends(get_current_user)):
     """Registrar avance con comentario en una tarea"""
     db_task = db.query(Task).filter(Task.id == task_id).first()
     if not db_task:
@@ -2206,6 +2668,7 @@ async def register_progress(task_id: int, progress_data: TaskProgressCreate, db:
         raise HTTPException(status_code=400, detail="El progreso debe estar entre 0 y 100")
     
     # Guardar el progreso anterior
+    before = _task_state(db_task)
     previous_progress = db_task.progress or 0
     
     # Crear registro de historial
@@ -2246,12 +2709,14 @@ async def register_progress(task_id: int, progress_data: TaskProgressCreate, db:
     
     db.commit()
     db.refresh(progress_record)
+    versions = _on_project_write(db, db_task.project_id)
     
-    # Broadcast
-    await manager.broadcast({
+    # Solo progreso/estado y updated_at
+    manager.publish_event(str(db_task.project_id), {
         "type": "task_updated",
-        "task": TaskResponse.model_validate(db_task).model_dump(mode='json')
-    }, str(db_task.project_id))
+        "task_id": db_task.id,
+        "changes": _task_changes(before, db_task)
+    }, versions.get(db_task.project_id))
     
     return TaskProgressResponse(
         id=progress_record.id,
@@ -2265,55 +2730,65 @@ async def register_progress(task_id: int, progress_data: TaskProgressCreate, db:
     )
 
 @app.get("/api/tasks/{task_id}/progress", response_model=List[TaskProgressResponse])
-async def get_progress_history(task_id: int, db: Session = Depends(get_db), current_user: User = Depends(get_current_user)):
-    """Obtener historial de avances de una tarea"""
-    db_task = db.query(Task).filter(Task.id == task_id).first()
+async def get_progress_history(task_id: int, response: Response, before: Optional[str] = None, limit: int = 50, db: Session = Depends(get_db), current_user: CurrentUser = Depends(get_current_user)):
+    """Obtener historial de avances de una tarea (paginado con ?before=<cursor>&limit=)"""
+    db_task = db.query(Task.id).filter(Task.id == task_id).first()
     if not db_task:
         raise HTTPException(status_code=404, detail="Tarea no encontrada")
     
-    progress_records = db.query(TaskProgress).filter(
-        TaskProgress.task_id == task_id
-    ).order_by(TaskProgress.created_at.desc()).all()
+    query = db.query(TaskProgress, User.name).outerjoin(
+        User, User.id == TaskProgress.user_id
+    ).filter(TaskProgress.task_id == task_id)
     
-    result = []
-    for record in progress_records:
-        user = db.query(User).filter(User.id == record.user_id).first()
-        result.append(TaskProgressResponse(
+    return [
+        TaskProgressResponse(
             id=record.id,
             task_id=record.task_id,
             user_id=record.user_id,
-            user_name=user.name if user else "Usuario eliminado",
+            user_name=user_name if user_name is not None else "Usuario eliminado",
             previous_progress=record.previous_progress,
             new_progress=record.new_progress,
             comment=record.comment,
             created_at=record.created_at
-        ))
-    
-    return result
+        )
+        for record, user_name in _history_page(query, TaskProgress, before, limit, response)
+    ]
 
 # ===================== DASHBOARD =====================
 @app.get("/api/dashboard/stats", response_model=DashboardStats)
-async def get_dashboard_stats(db: Session = Depends(get_db), current_user: User = Depends(get_current_user)):
-    total_projects = db.query(Project).count()
-    active_projects = db.query(Project).filter(Project.is_active == True).count()
-    inactive_projects = db.query(Project).filter(Project.is_active == False).count()
-    total_tasks = db.query(Task).count()
-    completed_tasks = db.query(Task).filter(Task.status == "done").count()
-    in_progress_tasks = db.query(Task).filter(Task.status == "in_progress").count()
-    review_tasks = db.query(Task).filter(Task.status == "review").count()
-    restart_tasks = db.query(Task).filter(Task.status == "restart").count()
-    pending_tasks = db.query(Task).filter(Task.status == "todo").count()
-    
-    # Tareas por prioridad
-    high_priority = db.query(Task).filter(Task.priority == "high").count()
-    medium_priority = db.query(Task).filter(Task.priority == "medium").count()
-    low_priority = db.query(Task).filter(Task.priority == "low").count()
-    
-    # Tareas vencidas
-    overdue_tasks = db.query(Task).filter(
-        Task.due_date < datetime.now(),
-        Task.status != "done"
-    ).count()
+async def get_dashboard_stats(db: Session = Depends(get_db), current_user: CurrentUser = Depends(get_current_user)):
+    """Estadísticas del dashboard sobre los proyectos visibles para el usuario.
+    Una consulta agregada por tabla; el resultado se guarda unos segundos por usuario."""
+    return dashboard_cache.get_or_set(current_user.id, lambda: _compute_dashboard_stats(db, current_user))
+
+def _compute_dashboard_stats(db: Session, user: CurrentUser) -> DashboardStats:
+    accessible = _accessible_project_ids(db, user)
+    
+    project_query = db.query(
+        func.count(Project.id),
+        count_if(Project.is_active == True),
+        count_if(Project.is_active == False)
+    )
+    task_query = db.query(
+        func.count(Task.id),
+        count_if(Task.status == "done"),
+        count_if(Task.status == "in_progress"),
+        count_if(Task.status == "review"),
+        count_if(Task.status == "restart"),
+        count_if(Task.status == "todo"),
+        count_if(Task.priority == "high"),
+        count_if(Task.priority == "medium"),
+        count_if(Task.priority == "low"),
+        # Tareas vencidas
+        count_if(and_(Task.due_date < datetime.now(), Task.status != "done"))
+    )
+    if accessible is not None:
+        project_query = project_query.filter(Project.id.in_(accessible))
+        task_query = task_query.filter(Task.project_id.in_(accessible))
+    
+    total_projects, active_projects, inactive_projects = project_query.one()
+    (total_tasks, completed_tasks, in_progress_tasks, review_tasks, restart_tasks, pending_tasks,
+     high_priority, medium_priority, low_priority, overdue_tasks) = task_query.one()
     
     return DashboardStats(
         total_projects=total_projects,
@@ -2334,22 +2809,21 @@ async def get_dashboard_stats(db: Session = Depends(get_db), current_user: User
     )
 
 @app.get("/api/activities", response_model=List[ActivityResponse])
-async def get_activities(limit: int = 20, db: Session = Depends(get_db), current_user: User = Depends(get_current_user)):
+async def get_activities(limit: int = 20, db: Session = Depends(get_db), current_user: CurrentUser = Depends(get_current_user)):
     activities = db.query(Activity).order_by(Activity.created_at.desc()).limit(limit).all()
     return activities
 
 @app.get("/api/users", response_model=List[UserResponse])
-async def get_users(db: Session = Depends(get_db), current_user: User = Depends(get_current_user)):
+async def get_users(db: Session = Depends(get_db), current_user: CurrentUser = Depends(get_current_user)):
     users = db.query(User).all()
     return users
 
 @app.get("/api/team-summary")
-async def get_team_summary(include_inactive: bool = False, db: Session = Depends(get_db), current_user: User = Depends(get_current_user)):
+async def get_team_summary(include_inactive: bool = False, db: Session = Depends(get_db), current_user: CurrentUser = Depends(get_current_user)):
     """Devuelve resumen de equipo en una sola consulta: usuarios con sus proyectos y conteo de tareas."""
-    from sqlalchemy import func, case
-    
-    all_users = db.query(User).all()
-    
+    return _team_summary(db, db.query(User).all(), include_inactive)
+
+def _team_summary(db: Session, all_users: List[User], include_inactive: bool = False) -> list:
     # Obtener proyectos filtrados
     proj_query = db.query(Project)
     if not include_inactive:
@@ -2399,6 +2873,25 @@ async def get_team_summary(include_inactive: bool = False, db: Session = Depends
     
     return result
 
+# ===================== CARGA INICIAL =====================
+@app.get("/api/bootstrap")
+async def get_bootstrap(activities_limit: int = 10, db: Session = Depends(get_db), current_user: CurrentUser = Depends(get_current_user)):
+    """Todo lo que necesita la primera pantalla en una sola respuesta y una sola sesión:
+    usuario actual, proyectos, usuarios, estadísticas, actividad reciente y resumen de equipo.
+    La lista de usuarios se lee una vez y se comparte con el resumen de equipo."""
+    all_users = db.query(User).all()
+    return {
+        "me": UserResponse.model_validate(current_user),
+        "projects": _list_projects(db, _projects_query(db, current_user), PROJECT_LIST_FIELDS),
+        "users": [UserResponse.model_validate(u) for u in all_users],
+        "dashboard": dashboard_cache.get_or_set(current_user.id, lambda: _compute_dashboard_stats(db, current_user)),
+        "activities": [
+            ActivityResponse.model_validate(a)
+            for a in db.query(Activity).order_by(Activity.created_at.desc()).limit(activities_limit).all()
+        ],
+        "team_summary": _team_summary(db, all_users),
+    }
+
 # ===================== REPORTES PDF =====================
 try:
     from reports import generate_project_report, generate_general_report
@@ -2453,7 +2946,7 @@ async def debug_tables(db: Session = Depends(get_db)):
     }
 
 @app.get("/api/reports/debug")
-async def debug_report(db: Session = Depends(get_db), current_user: User = Depends(get_current_user)):
+async def debug_report(db: Session = Depends(get_db), current_user: CurrentUser = Depends(get_current_user)):
     """Debug: ver datos que se enviarían al reporte"""
     try:
         if current_user.is_admin:
@@ -2498,7 +2991,7 @@ async def debug_report(db: Session = Depends(get_db), current_user: User = Depen
         return {"status": "error", "error": str(e), "traceback": traceback.format_exc()}
 
 @app.get("/api/reports/project/{project_id}")
-async def download_project_report(project_id: int, db: Session = Depends(get_db), current_user: User = Depends(get_current_user)):
+async def download_project_report(project_id: int, db: Session = Depends(get_db), current_user: CurrentUser = Depends(get_current_user)):
     """Descargar reporte PDF de un proyecto específico"""
     if not REPORTLAB_AVAILABLE:
         raise HTTPException(status_code=500, detail=f"ReportLab no disponible: {REPORTLAB_ERROR}")
@@ -2512,74 +3005,10 @@ async def download_project_report(project_id: int, db: Session = Depends(get_db)
         # Obtener tareas del proyecto
         tasks = db.query(Task).filter(Task.project_id == project_id).all()
         
-        # Calcular efectividad
-        effectiveness_data = None
-        if project.start_date and project.end_date:
-            today = datetime.now().date()
-            # Convertir a date si son datetime
-            start = project.start_date.date() if hasattr(project.start_date, 'date') else project.start_date
-            end = project.end_date.date() if hasattr(project.end_date, 'date') else project.end_date
-            
-            total_days = (end - start).days
-            elapsed_days = (today - start).days
-            
-            if total_days > 0:
-                scheduled_progress = min(100, max(0, round((elapsed_days / total_days) * 100, 1)))
-            else:
-                scheduled_progress = 100 if today >= end else 0
-            
-            # Progreso real (promedio de tareas)
-            if tasks:
-                actual_progress = round(sum(t.progress or 0 for t in tasks) / len(tasks), 1)
-            else:
-                actual_progress = 0
-            
-            # Calcular efectividad
-            if scheduled_progress > 0:
-                effectiveness = round((actual_progress / scheduled_progress) * 100, 1)
-            else:
-                effectiveness = 100 if actual_progress > 0 else 0
-            
-            # Determinar estado
-            if effectiveness >= 100:
-                status = "adelantado"
-            elif effectiveness >= 90:
-                status = "en_tiempo"
-            else:
-                status = "atrasado"
-            
-            effectiveness_data = {
-                "metrics": {
-                    "scheduled_progress": scheduled_progress,
-                    "actual_progress": actual_progress,
-                    "effectiveness": effectiveness,
-                    "status": status
-                }
-            }
-        
-        # Obtener etapas
-        stages_db = db.query(Stage).filter(Stage.project_id == project_id).order_by(Stage.position).all()
-        stages = []
-        
-        for stage in stages_db:
-            stage_tasks = [t for t in tasks if t.stage_id == stage.id]
-            if stage_tasks:
-                stage_progress = round(sum(t.progress or 0 for t in stage_tasks) / len(stage_tasks), 1)
-            else:
-                stage_progress = 0
-            
-            # Calcular progreso programado para la etapa
-            if effectiveness_data:
-                stage_scheduled = effectiveness_data['metrics']['scheduled_progress']
-            else:
-                stage_scheduled = 0
-            
-            stages.append({
-                "name": stage.name,
-                "percentage": stage.percentage,
-                "scheduled_progress": stage_scheduled,
-                "actual_progress": stage_progress
-            })
+        # Efectividad y etapas con el mismo motor que el endpoint de efectividad
+        result = load_effectiveness(db, [project_id])[project_id]
+        effectiveness_data = {"metrics": result["metrics"]}
+        stages = result["stages"]
         
         # Generar PDF
         pdf_buffer = generate_project_report(project, tasks, effectiveness_data, stages)
@@ -2600,7 +3029,7 @@ async def download_project_report(project_id: int, db: Session = Depends(get_db)
         raise HTTPException(status_code=500, detail=f"Error generando reporte: {str(e)}")
 
 @app.get("/api/reports/general")
-async def download_general_report(db: Session = Depends(get_db), current_user: User = Depends(get_current_user)):
+async def download_general_report(db: Session = Depends(get_db), current_user: CurrentUser = Depends(get_current_user)):
     """Descargar reporte PDF general de todos los proyectos"""
     
     if not REPORTLAB_AVAILABLE:
@@ -2622,44 +3051,11 @@ async def download_general_report(db: Session = Depends(get_db), current_user: U
             raise HTTPException(status_code=404, detail="No hay proyectos para generar el reporte")
         
         projects_data = []
+        results = load_effectiveness(db, [p.id for p in projects])
         
         for project in projects:
-            tasks = db.query(Task).filter(Task.project_id == project.id).all()
-            total_tasks = len(tasks)
-            completed_tasks = len([t for t in tasks if t.status == "done"])
-            
-            # Calcular efectividad
-            scheduled_progress = 0
-            actual_progress = 0
-            effectiveness = 100
-            status = "en_tiempo"
-            
-            if project.start_date and project.end_date:
-                today = datetime.now().date()
-                # Convertir a date si son datetime
-                start = project.start_date.date() if hasattr(project.start_date, 'date') else project.start_date
-                end = project.end_date.date() if hasattr(project.end_date, 'date') else project.end_date
-                
-                total_days = (end - start).days
-                elapsed_days = (today - start).days
-                
-                if total_days > 0:
-                    scheduled_progress = min(100, max(0, round((elapsed_days / total_days) * 100, 1)))
-                else:
-                    scheduled_progress = 100 if today >= end else 0
-                
-                if tasks:
-                    actual_progress = round(sum(t.progress or 0 for t in tasks) / len(tasks), 1)
-                
-                if scheduled_progress > 0:
-                    effectiveness = round((actual_progress / scheduled_progress) * 100, 1)
-                
-                if effectiveness >= 100:
-                    status = "adelantado"
-                elif effectiveness >= 90:
-                    status = "en_tiempo"
-                else:
-                    status = "atrasado"
+            result = results[project.id]
+            metrics = result["metrics"]
             
             projects_data.append({
                 "id": project.id,
@@ -2667,12 +3063,12 @@ async def download_general_report(db: Session = Depends(get_db), current_user: U
                 "description": project.description or "",
                 "start_date": project.start_date.strftime("%d/%m/%Y") if project.start_date else "No definida",
                 "end_date": project.end_date.strftime("%d/%m/%Y") if project.end_date else "No definida",
-                "total_tasks": total_tasks,
-                "completed_tasks": completed_tasks,
-                "scheduled_progress": scheduled_progress,
-                "actual_progress": actual_progress,
-                "effectiveness": effectiveness,
-                "status": status
+                "total_tasks": result["total_tasks"],
+                "completed_tasks": result["completed_tasks"],
+                "scheduled_progress": metrics["scheduled_progress"],
+                "actual_progress": metrics["actual_progress"],
+                "effectiveness": metrics["effectiveness"],
+                "status": metrics["status"]
             })
         
         # Generar PDF
@@ -2693,24 +3089,12 @@ async def download_general_report(db: Session = Depends(get_db), current_user: U
 
 # ===================== PLANTILLAS DE ETAPAS =====================
 @app.get("/api/templates/stages")
-async def get_stage_templates(db: Session = Depends(get_db), current_user: User = Depends(get_current_user)):
-    """Obtener todas las plantillas de etapas"""
-    templates = db.query(StageTemplate).all()
-    result = []
-    for template in templates:
-        items = db.query(StageTemplateItem).filter(StageTemplateItem.template_id == template.id).order_by(StageTemplateItem.position).all()
-        result.append({
-            "id": template.id,
-            "name": template.name,
-            "description": template.description,
-            "created_by": template.created_by,
-            "created_at": template.created_at.isoformat() if template.created_at else None,
-            "stages": [{"id": i.id, "name": i.name, "description": i.description, "percentage": i.percentage, "position": i.position} for i in items]
-        })
-    return result
+async def get_stage_templates(db: Session = Depends(get_db), current_user: CurrentUser = Depends(get_current_user)):
+    """Obtener todas las plantillas de etapas (desde el catálogo en memoria)"""
+    return [t.to_dict() for t in get_catalog(db).stage_templates.values()]
 
 @app.post("/api/templates/stages")
-async def create_stage_template(data: dict, db: Session = Depends(get_db), current_user: User = Depends(get_current_user)):
+async def create_stage_template(data: dict, db: Session = Depends(get_db), current_user: CurrentUser = Depends(get_current_user)):
     """Crear plantilla de etapas - Solo admins"""
     if not current_user.is_admin:
         raise HTTPException(status_code=403, detail="Solo administradores pueden crear plantillas")
@@ -2735,11 +3119,12 @@ async def create_stage_template(data: dict, db: Session = Depends(get_db), curre
         )
         db.add(item)
     db.commit()
+    refresh_catalog(db)
     
     return {"id": template.id, "message": "Plantilla creada exitosamente"}
 
 @app.delete("/api/templates/stages/{template_id}")
-async def delete_stage_template(template_id: int, db: Session = Depends(get_db), current_user: User = Depends(get_current_user)):
+async def delete_stage_template(template_id: int, db: Session = Depends(get_db), current_user: CurrentUser = Depends(get_current_user)):
     """Eliminar plantilla de etapas - Solo admins"""
     if not current_user.is_admin:
         raise HTTPException(status_code=403, detail="Solo administradores pueden eliminar plantillas")
@@ -2750,10 +3135,11 @@ async def delete_stage_template(template_id: int, db: Session = Depends(get_db),
     
     db.delete(template)
     db.commit()
+    refresh_catalog(db)
     return {"message": "Plantilla eliminada"}
 
 @app.post("/api/projects/{project_id}/apply-stage-template/{template_id}")
-async def apply_stage_template(project_id: int, template_id: int, db: Session = Depends(get_db), current_user: User = Depends(get_current_user)):
+async def apply_stage_template(project_id: int, template_id: int, db: Session = Depends(get_db), current_user: CurrentUser = Depends(get_current_user)):
     """Aplicar plantilla de etapas a un proyecto"""
     if not current_user.is_admin:
         raise HTTPException(status_code=403, detail="Solo administradores pueden aplicar plantillas")
@@ -2762,11 +3148,11 @@ async def apply_stage_template(project_id: int, template_id: int, db: Session =
     if not project:
         raise HTTPException(status_code=404, detail="Proyecto no encontrado")
     
-    template = db.query(StageTemplate).filter(StageTemplate.id == template_id).first()
+    template = get_catalog(db).stage_templates.get(template_id)
     if not template:
         raise HTTPException(status_code=404, detail="Plantilla no encontrada")
     
-    items = db.query(StageTemplateItem).filter(StageTemplateItem.template_id == template_id).order_by(StageTemplateItem.position).all()
+    items = template.stages
     
     # Obtener la última posición de etapas existentes
     last_stage = db.query(Stage).filter(Stage.project_id == project_id).order_by(Stage.position.desc()).first()
@@ -2786,28 +3172,17 @@ async def apply_stage_template(project_id: int, template_id: int, db: Session =
         db.refresh(stage)
         created_stages.append({"id": stage.id, "name": stage.name})
     
+    _on_project_write(db, project_id)
     return {"message": f"Se crearon {len(created_stages)} etapas", "stages": created_stages}
 
 # ===================== PLANTILLAS DE TAREAS =====================
 @app.get("/api/templates/tasks")
-async def get_task_templates(db: Session = Depends(get_db), current_user: User = Depends(get_current_user)):
-    """Obtener todas las plantillas de tareas"""
-    templates = db.query(TaskTemplate).all()
-    result = []
-    for template in templates:
-        items = db.query(TaskTemplateItem).filter(TaskTemplateItem.template_id == template.id).order_by(TaskTemplateItem.position).all()
-        result.append({
-            "id": template.id,
-            "name": template.name,
-            "description": template.description,
-            "created_by": template.created_by,
-            "created_at": template.created_at.isoformat() if template.created_at else None,
-            "tasks": [{"id": i.id, "title": i.title, "description": i.description, "priority": i.priority, "position": i.position, "duration_days": i.duration_days} for i in items]
-        })
-    return result
+async def get_task_templates(db: Session = Depends(get_db), current_user: CurrentUser = Depends(get_current_user)):
+    """Obtener todas las plantillas de tareas (desde el catálogo en memoria)"""
+    return [t.to_dict() for t in get_catalog(db).task_templates.values()]
 
 @app.post("/api/templates/tasks")
-async def create_task_template(data: dict, db: Session = Depends(get_db), current_user: User = Depends(get_current_user)):
+async def create_task_template(data: dict, db: Session = Depends(get_db), current_user: CurrentUser = Depends(get_current_user)):
     """Crear plantilla de tareas - Solo admins"""
     if not current_user.is_admin:
         raise HTTPException(status_code=403, detail="Solo administradores pueden crear plantillas")
@@ -2833,11 +3208,12 @@ async def create_task_template(data: dict, db: Session = Depends(get_db), curren
         )
         db.add(item)
     db.commit()
+    refresh_catalog(db)
     
     return {"id": template.id, "message": "Plantilla creada exitosamente"}
 
 @app.delete("/api/templates/tasks/{template_id}")
-async def delete_task_template(template_id: int, db: Session = Depends(get_db), current_user: User = Depends(get_current_user)):
+async def delete_task_template(template_id: int, db: Session = Depends(get_db), current_user: CurrentUser = Depends(get_current_user)):
     """Eliminar plantilla de tareas - Solo admins"""
     if not current_user.is_admin:
         raise HTTPException(status_code=403, detail="Solo administradores pueden eliminar plantillas")
@@ -2848,10 +3224,11 @@ async def delete_task_template(template_id: int, db: Session = Depends(get_db),
     
     db.delete(template)
     db.commit()
+    refresh_catalog(db)
     return {"message": "Plantilla eliminada"}
 
 @app.post("/api/projects/{project_id}/apply-task-template/{template_id}")
-async def apply_task_template(project_id: int, template_id: int, stage_id: Optional[int] = None, db: Session = Depends(get_db), current_user: User = Depends(get_current_user)):
+async def apply_task_template(project_id: int, template_id: int, stage_id: Optional[int] = None, db: Session = Depends(get_db), current_user: CurrentUser = Depends(get_current_user)):
     """Aplicar plantilla de tareas a un proyecto"""
     # Permitir admin y líderes del proyecto
     project_check = db.query(Project).filter(Project.id == project_id).first()
@@ -2862,11 +3239,11 @@ async def apply_task_template(project_id: int, template_id: int, stage_id: Optio
     if not project:
         raise HTTPException(status_code=404, detail="Proyecto no encontrado")
     
-    template = db.query(TaskTemplate).filter(TaskTemplate.id == template_id).first()
+    template = get_catalog(db).task_templates.get(template_id)
     if not template:
         raise HTTPException(status_code=404, detail="Plantilla no encontrada")
     
-    items = db.query(TaskTemplateItem).filter(TaskTemplateItem.template_id == template_id).order_by(TaskTemplateItem.position).all()
+    items = template.tasks
     
     # Obtener la última posición
     last_task = db.query(Task).filter(Task.project_id == project_id).order_by(Task.position.desc()).first()
@@ -2898,28 +3275,18 @@ async def apply_task_template(project_id: int, template_id: int, stage_id: Optio
         
         current_start = end_date + timedelta(days=1)  # Siguiente tarea empieza al día siguiente
     
+    _on_project_write(db, project_id)
     return {"message": f"Se crearon {len(created_tasks)} tareas", "tasks": created_tasks}
 
 # ===================== PLANTILLAS DE SUPERVISIÓN =====================
 
-def _sup_cat_template_to_dict(t: SupCategoriaTemplate) -> dict:
-    return {
-        "id": t.id,
-        "nombre": t.nombre,
-        "tipo": t.tipo,
-        "descripcion": t.descripcion,
-        "created_at": t.created_at.isoformat() if t.created_at else None,
-        "items": [{"id": i.id, "actividad": i.actividad, "prioridad": i.prioridad, "position": i.position} for i in t.items],
-    }
-
 @app.get("/api/templates/supervision")
-def get_sup_templates(db: Session = Depends(get_db), current_user: User = Depends(get_current_user)):
+def get_sup_templates(db: Session = Depends(get_db), current_user: CurrentUser = Depends(get_current_user)):
     """Listar todas las plantillas de categorías de supervisión (compras + servicios)."""
-    templates = db.query(SupCategoriaTemplate).order_by(SupCategoriaTemplate.tipo, SupCategoriaTemplate.nombre).all()
-    return [_sup_cat_template_to_dict(t) for t in templates]
+    return [t.to_dict() for t in get_catalog(db).sup_templates.values()]
 
 @app.post("/api/templates/supervision")
-def create_sup_template(data: dict, db: Session = Depends(get_db), current_user: User = Depends(get_current_user)):
+def create_sup_template(data: dict, db: Session = Depends(get_db), current_user: CurrentUser = Depends(get_current_user)):
     """Crear plantilla de categoría de supervisión. Solo admins."""
     if not current_user.is_admin:
         raise HTTPException(status_code=403, detail="Solo administradores pueden crear plantillas")
@@ -2938,11 +3305,10 @@ def create_sup_template(data: dict, db: Session = Depends(get_db), current_user:
         if actividad:
             db.add(SupCategoriaTemplateItem(template_id=t.id, actividad=actividad, prioridad=item.get("prioridad", 3), position=idx))
     db.commit()
-    db.refresh(t)
-    return _sup_cat_template_to_dict(t)
+    return refresh_catalog(db).sup_templates[t.id].to_dict()
 
 @app.put("/api/templates/supervision/{template_id}")
-def update_sup_template(template_id: int, data: dict, db: Session = Depends(get_db), current_user: User = Depends(get_current_user)):
+def update_sup_template(template_id: int, data: dict, db: Session = Depends(get_db), current_user: CurrentUser = Depends(get_current_user)):
     """Actualizar plantilla de supervisión."""
     if not current_user.is_admin:
         raise HTTPException(status_code=403, detail="Solo administradores pueden editar plantillas")
@@ -2963,11 +3329,10 @@ def update_sup_template(template_id: int, data: dict, db: Session = Depends(get_
             if actividad:
                 db.add(SupCategoriaTemplateItem(template_id=t.id, actividad=actividad, prioridad=item.get("prioridad", 3), position=idx))
     db.commit()
-    db.refresh(t)
-    return _sup_cat_template_to_dict(t)
+    return refresh_catalog(db).sup_templates[t.id].to_dict()
 
 @app.delete("/api/templates/supervision/{template_id}")
-def delete_sup_template(template_id: int, db: Session = Depends(get_db), current_user: User = Depends(get_current_user)):
+def delete_sup_template(template_id: int, db: Session = Depends(get_db), current_user: CurrentUser = Depends(get_current_user)):
     """Eliminar plantilla de supervisión."""
     if not current_user.is_admin:
         raise HTTPException(status_code=403, detail="Solo administradores pueden eliminar plantillas")
@@ -2976,15 +3341,16 @@ def delete_sup_template(template_id: int, db: Session = Depends(get_db), current
         raise HTTPException(status_code=404, detail="Plantilla no encontrada")
     db.delete(t)
     db.commit()
+    refresh_catalog(db)
     return {"message": "Plantilla eliminada"}
 
 @app.post("/api/projects/{project_id}/apply-sup-template/{template_id}")
-def apply_sup_template(project_id: int, template_id: int, db: Session = Depends(get_db), current_user: User = Depends(get_current_user)):
+def apply_sup_template(project_id: int, template_id: int, db: Session = Depends(get_db), current_user: CurrentUser = Depends(get_current_user)):
     """Aplica una plantilla de supervisión a un proyecto creando el grupo y sus actividades."""
     project = db.query(Project).filter(Project.id == project_id).first()
     if not project:
         raise HTTPException(status_code=404, detail="Proyecto no encontrado")
-    t = db.query(SupCategoriaTemplate).filter(SupCategoriaTemplate.id == template_id).first()
+    t = get_catalog(db).sup_templates.get(template_id)
     if not t:
         raise HTTPException(status_code=404, detail="Plantilla no encontrada")
 
@@ -2997,6 +3363,8 @@ def apply_sup_template(project_id: int, template_id: int, db: Session = Depends(
         for idx, item in enumerate(t.items):
             db.add(SupComprasItem(grupo_id=grupo.id, actividad=item.actividad, prioridad=item.prioridad, position=idx))
         db.commit()
+        _publish_sup_event(_on_project_write(db, project_id), "sup_compras_grupo", "created", grupo.id,
+                           SupComprasGrupoResponse.model_validate(grupo).model_dump(mode='json'))
         return {"message": f"Grupo '{t.nombre}' creado en Compras", "grupo_id": grupo.id, "tipo": "COMPRAS"}
     else:
         pos = db.query(SupServiciosGrupo).filter(SupServiciosGrupo.project_id == project_id).count()
@@ -3007,18 +3375,21 @@ def apply_sup_template(project_id: int, template_id: int, db: Session = Depends(
         for idx, item in enumerate(t.items):
             db.add(SupServiciosItem(grupo_id=grupo.id, actividad=item.actividad, prioridad=item.prioridad, position=idx))
         db.commit()
+        _publish_sup_event(_on_project_write(db, project_id), "sup_servicios_grupo", "created", grupo.id,
+                           SupServiciosGrupoResponse.model_validate(grupo).model_dump(mode='json'))
         return {"message": f"Grupo '{t.nombre}' creado en Servicios", "grupo_id": grupo.id, "tipo": "SERVICIOS"}
 
 # Vinculación stage_template ↔ sup_categoria_templates
 @app.get("/api/templates/stages/{template_id}/sup-cats")
-def get_stage_template_sup_cats(template_id: int, db: Session = Depends(get_db), current_user: User = Depends(get_current_user)):
-    t = db.query(StageTemplate).filter(StageTemplate.id == template_id).first()
+def get_stage_template_sup_cats(template_id: int, db: Session = Depends(get_db), current_user: CurrentUser = Depends(get_current_user)):
+    catalog = get_catalog(db)
+    t = catalog.stage_templates.get(template_id)
     if not t:
         raise HTTPException(status_code=404, detail="Plantilla no encontrada")
-    return [_sup_cat_template_to_dict(s) for s in t.sup_cat_templates]
+    return [s.to_dict() for s in catalog.stage_template_sup_cats(t)]
 
 @app.put("/api/templates/stages/{template_id}/sup-cats")
-def set_stage_template_sup_cats(template_id: int, data: dict, db: Session = Depends(get_db), current_user: User = Depends(get_current_user)):
+def set_stage_template_sup_cats(template_id: int, data: dict, db: Session = Depends(get_db), current_user: CurrentUser = Depends(get_current_user)):
     """Establece las plantillas de supervisión vinculadas a una plantilla de etapas."""
     if not current_user.is_admin:
         raise HTTPException(status_code=403, detail="Solo administradores")
@@ -3029,6 +3400,7 @@ def set_stage_template_sup_cats(template_id: int, data: dict, db: Session = Depe
     sup_cats = db.query(SupCategoriaTemplate).filter(SupCategoriaTemplate.id.in_(ids)).all() if ids else []
     t.sup_cat_templates = sup_cats
     db.commit()
+    refresh_catalog(db)
     return {"message": "Vinculación actualizada", "count": len(sup_cats)}
 
 # ===================== REPORTE PDF: TAREAS PENDIENTES POR USUARIO =====================
@@ -3038,7 +3410,7 @@ def report_pending_tasks_pdf(
     project_id: Optional[int] = None,
     user_id: Optional[int] = None,
     db: Session = Depends(get_db),
-    current_user: User = Depends(get_current_user)
+    current_user: CurrentUser = Depends(get_current_user)
 ):
     """Genera un PDF con las tareas pendientes agrupadas por usuario asignado."""
     from io import BytesIO
@@ -3357,81 +3729,79 @@ def report_pending_tasks_pdf(
                              headers={"Content-Disposition": f"attachment; filename={filename}"})
 
 # ===================== EQUIPOS DE ADMIN =====================
+def _admin_team_members(db: Session, admin_ids: List[int]) -> dict:
+    """Miembros (con sus proyectos) de los equipos de varios admins: {admin_id: [miembro, ...]}.
+    Cuatro consultas en total (relaciones, usuarios, membresías y proyectos), sin importar el tamaño de los equipos."""
+    teams = {admin_id: [] for admin_id in admin_ids}
+    if not admin_ids:
+        return teams
+    
+    relations = db.query(AdminTeam).filter(AdminTeam.admin_id.in_(admin_ids)).order_by(AdminTeam.id).all()
+    member_ids = list({r.member_id for r in relations})
+    if not member_ids:
+        return teams
+    
+    users = {u.id: u for u in db.query(User).filter(User.id.in_(member_ids)).all()}
+    
+    project_ids_by_user = {}
+    for user_id, project_id in db.query(ProjectMember.user_id, ProjectMember.project_id).filter(ProjectMember.user_id.in_(member_ids)).all():
+        project_ids_by_user.setdefault(user_id, set()).add(project_id)
+    
+    all_project_ids = set().union(*project_ids_by_user.values()) if project_ids_by_user else set()
+    projects = {
+        p.id: {"id": p.id, "name": p.name, "color": p.color, "is_active": p.is_active}
+        for p in db.query(Project.id, Project.name, Project.color, Project.is_active).filter(Project.id.in_(all_project_ids)).all()
+    } if all_project_ids else {}
+    
+    for relation in relations:
+        member = users.get(relation.member_id)
+        if not member:
+            continue
+        teams[relation.admin_id].append({
+            "id": member.id,
+            "name": member.name,
+            "email": member.email,
+            "avatar_color": member.avatar_color,
+            "added_at": relation.added_at.isoformat() if relation.added_at else None,
+            "projects": [projects[pid] for pid in sorted(project_ids_by_user.get(member.id, ())) if pid in projects]
+        })
+    return teams
+
 @app.get("/api/admin/teams")
-async def get_admin_teams(db: Session = Depends(get_db), current_user: User = Depends(get_current_user)):
+async def get_admin_teams(db: Session = Depends(get_db), current_user: CurrentUser = Depends(get_current_user)):
     """Obtener equipos de todos los admins"""
     if not current_user.is_admin:
         raise HTTPException(status_code=403, detail="Solo administradores pueden ver equipos")
     
     admins = db.query(User).filter(User.is_admin == True).all()
-    result = []
+    teams = _admin_team_members(db, [admin.id for admin in admins])
     
-    for admin in admins:
-        team_relations = db.query(AdminTeam).filter(AdminTeam.admin_id == admin.id).all()
-        members = []
-        for relation in team_relations:
-            member = db.query(User).filter(User.id == relation.member_id).first()
-            if member:
-                member_project_ids = db.query(ProjectMember.project_id).filter(ProjectMember.user_id == member.id).all()
-                project_ids = [p[0] for p in member_project_ids]
-                member_projects = db.query(Project).filter(Project.id.in_(project_ids)).all() if project_ids else []
-                members.append({
-                    "id": member.id,
-                    "name": member.name,
-                    "email": member.email,
-                    "avatar_color": member.avatar_color,
-                    "added_at": relation.added_at.isoformat() if relation.added_at else None,
-                    "projects": [
-                        {"id": p.id, "name": p.name, "color": p.color, "is_active": p.is_active}
-                        for p in member_projects
-                    ]
-                })
-        
-        result.append({
+    return [
+        {
             "admin_id": admin.id,
             "admin_name": admin.name,
             "admin_email": admin.email,
             "avatar_color": admin.avatar_color,
-            "team": members
-        })
-    
-    return result
+            "team": teams[admin.id]
+        }
+        for admin in admins
+    ]
 
 @app.get("/api/admin/{admin_id}/team")
-async def get_admin_team(admin_id: int, db: Session = Depends(get_db), current_user: User = Depends(get_current_user)):
+async def get_admin_team(admin_id: int, db: Session = Depends(get_db), current_user: CurrentUser = Depends(get_current_user)):
     """Obtener equipo de un admin específico"""
     admin = db.query(User).filter(User.id == admin_id, User.is_admin == True).first()
     if not admin:
         raise HTTPException(status_code=404, detail="Administrador no encontrado")
     
-    team_relations = db.query(AdminTeam).filter(AdminTeam.admin_id == admin_id).all()
-    members = []
-    for relation in team_relations:
-        member = db.query(User).filter(User.id == relation.member_id).first()
-        if member:
-            member_project_ids = db.query(ProjectMember.project_id).filter(ProjectMember.user_id == member.id).all()
-            project_ids = [p[0] for p in member_project_ids]
-            member_projects = db.query(Project).filter(Project.id.in_(project_ids)).all() if project_ids else []
-            members.append({
-                "id": member.id,
-                "name": member.name,
-                "email": member.email,
-                "avatar_color": member.avatar_color,
-                "added_at": relation.added_at.isoformat() if relation.added_at else None,
-                "projects": [
-                    {"id": p.id, "name": p.name, "color": p.color, "is_active": p.is_active}
-                    for p in member_projects
-                ]
-            })
-    
     return {
         "admin_id": admin.id,
         "admin_name": admin.name,
-        "team": members
+        "team": _admin_team_members(db, [admin_id])[admin_id]
     }
 
 @app.post("/api/admin/{admin_id}/team/{member_id}")
-async def add_team_member(admin_id: int, member_id: int, db: Session = Depends(get_db), current_user: User = Depends(get_current_user)):
+async def add_team_member(admin_id: int, member_id: int, db: Session = Depends(get_db), current_user: CurrentUser = Depends(get_current_user)):
     """Agregar miembro al equipo de un admin"""
     if not current_user.is_admin:
         raise HTTPException(status_code=403, detail="Solo administradores pueden gestionar equipos")
@@ -3456,7 +3826,7 @@ async def add_team_member(admin_id: int, member_id: int, db: Session = Depends(g
     return {"message": f"{member.name} agregado al equipo de {admin.name}"}
 
 @app.delete("/api/admin/{admin_id}/team/{member_id}")
-async def remove_team_member(admin_id: int, member_id: int, db: Session = Depends(get_db), current_user: User = Depends(get_current_user)):
+async def remove_team_member(admin_id: int, member_id: int, db: Session = Depends(get_db), current_user: CurrentUser = Depends(get_current_user)):
     """Remover miembro del equipo de un admin"""
     if not current_user.is_admin:
         raise HTTPException(status_code=403, detail="Solo administradores pueden gestionar equipos")
@@ -3471,16 +3841,70 @@ async def remove_team_member(admin_id: int, member_id: int, db: Session = Depend
     return {"message": "Miembro removido del equipo"}
 
 # ===================== WEBSOCKET =====================
+@app.get("/api/ws/stats")
+async def get_ws_stats(current_user: CurrentUser = Depends(get_current_user)):
+    """Conexiones WebSocket activas y profundidad de colas por proyecto (de este worker)"""
+    if not current_user.is_admin:
+        raise HTTPException(status_code=403, detail="Solo administradores pueden ver las conexiones")
+    return manager.stats()
+
+def _can_access_project(user: CurrentUser, project_id: str) -> bool:
+    """El proyecto existe y el usuario es miembro, dueño o líder (o administrador)"""
+    try:
+        pid = int(project_id)
+    except ValueError:
+        return False
+    db = SessionLocal()
+    try:
+        if db.query(Project.id).filter(Project.id == pid).first() is None:
+            return False
+        accessible = _accessible_project_ids(db, user)
+        return accessible is None or pid in accessible
+    finally:
+        db.close()
+
 @app.websocket("/ws/{project_id}")
 async def websocket_endpoint(websocket: WebSocket, project_id: str):
-    await manager.connect(websocket, project_id)
+    """Canal de eventos del proyecto. El primer mensaje debe ser el JWT
+    (WSAuthMessage) y el usuario necesita acceso al proyecto; después el
+    cliente solo puede mandar ping/pong (WSClientMessage)."""
+    message = await receive_first_message(websocket)
+    if message is None:
+        await reject(websocket, CLOSE_IDLE)
+        return
+    token = None
+    if message.get("text") is not None:  # un frame binario o una desconexión no traen token
+        try:
+            token = WSAuthMessage.model_validate_json(message["text"]).token
+        except ValidationError:
+            pass
+    user = principal_from_token(token)
+    if user is None:
+        await reject(websocket, CLOSE_UNAUTHORIZED)
+        return
+    if not _can_access_project(user, project_id):
+        await reject(websocket, CLOSE_FORBIDDEN)
+        return
+    connection = await manager.connect(websocket, project_id, user.id)
+    if connection is None:
+        return
     try:
         while True:
-            data = await websocket.receive_json()
-            # Rebroadcast a todos los demás
-            await manager.broadcast(data, project_id)
+            text = await websocket.receive_text()
+            if not connection.touch():
+                manager.disconnect(connection, code=CLOSE_LIMIT)
+                break
+            try:
+                message = WSClientMessage.model_validate_json(text)
+            except ValidationError:
+                manager.disconnect(connection, code=CLOSE_INVALID)
+                break
+            if message.type == "ping":
+                connection.offer(PONG_MESSAGE)
     except WebSocketDisconnect:
-        manager.disconnect(websocket, project_id)
+        pass
+    finally:
+        manager.disconnect(connection)
 
 if __name__ == "__main__":
     import uvicorn
@@ -3494,155 +3918,183 @@ if __name__ == "__main__":
 # --- Resumen global (todos los proyectos) ---
 
 @app.get("/api/supervision/global/resumen")
-def get_sup_global_resumen(db: Session = Depends(get_db), current_user: User = Depends(get_current_user)):
+def get_sup_global_resumen(db: Session = Depends(get_db), current_user: CurrentUser = Depends(get_current_user)):
     """Devuelve un resumen agregado por proyecto de todos los grupos de supervisión."""
     # Obtener proyectos a los que tiene acceso el usuario
-    if current_user.is_admin:
-        projects = db.query(Project).filter(Project.is_active == True).all()
-    else:
-        member_project_ids = [m.project_id for m in db.query(ProjectMember).filter(ProjectMember.user_id == current_user.id).all()]
-        owned_ids = [p.id for p in db.query(Project).filter(Project.owner_id == current_user.id).all()]
-        leader_ids = [p.id for p in db.query(Project).filter(Project.leader_id == current_user.id).all()]
-        all_ids = list(set(member_project_ids + owned_ids + leader_ids))
-        projects = db.query(Project).filter(Project.id.in_(all_ids), Project.is_active == True).all()
+    query = db.query(Project.id, Project.name, Project.color).filter(Project.is_active == True)
+    accessible = _accessible_project_ids(db, current_user)
+    if accessible is not None:
+        query = query.filter(Project.id.in_(accessible))
+    projects = query.order_by(Project.id).all()
+
+    rollups = get_supervision_rollups(db, [p.id for p in projects])
 
     result = []
     for project in projects:
-        compras_grupos = db.query(SupComprasGrupo).filter(SupComprasGrupo.project_id == project.id).all()
-        servicios_grupos = db.query(SupServiciosGrupo).filter(SupServiciosGrupo.project_id == project.id).all()
-
-        total_grupos = len(compras_grupos) + len(servicios_grupos)
-        if total_grupos == 0:
+        rollup = rollups.get(project.id)
+        if not rollup:
             continue  # Omitir proyectos sin supervisión
 
-        all_compras_items = db.query(SupComprasItem).filter(
-            SupComprasItem.grupo_id.in_([g.id for g in compras_grupos])
-        ).all() if compras_grupos else []
-        all_servicios_items = db.query(SupServiciosItem).filter(
-            SupServiciosItem.grupo_id.in_([g.id for g in servicios_grupos])
-        ).all() if servicios_grupos else []
-
-        all_items_count = len(all_compras_items) + len(all_servicios_items)
-
-        compras_aprobados = sum(1 for i in all_compras_items if (i.status_compra or '').upper() == 'APROBADO')
-        servicios_aprobados = sum(1 for i in all_servicios_items if (i.status or '').upper() == 'APROBADO')
-        compras_pendientes = sum(1 for i in all_compras_items if (i.status_compra or '').upper() == 'PENDIENTE')
-        servicios_pendientes = sum(1 for i in all_servicios_items if (i.status or '').upper() in ('PENDIENTE', 'POR COTIZAR'))
-
-        # Avance promedio (avance_proyecto si hay tarea, si no avance de checkboxes)
-        def item_avance(item):
-            if hasattr(item, 'procura'):  # compras: 5 checks
-                checks = [item.procura, item.contratado, item.fabricado, item.despacho, item.recepcion]
-            else:  # servicios: 4 checks
-                checks = [item.solicitud, item.contratado, item.fabricado, item.instalado]
-            return round(sum(1 for c in checks if c) / len(checks) * 100)
-
-        all_avances = [item_avance(i) for i in all_compras_items + all_servicios_items]
-        avg_avance = round(sum(all_avances) / len(all_avances)) if all_avances else 0
-
-        # Fecha límite más próxima
-        fechas = sorted(filter(None, [i.fecha_limite for i in all_compras_items + all_servicios_items]))
-        fecha_proxima = fechas[0] if fechas else None
+        # Avance promedio de checkboxes de todos los ítems
+        avg_avance = round(rollup["avance_sum"] / rollup["total_items"]) if rollup["total_items"] else 0
 
         result.append({
             "project_id": project.id,
             "project_name": project.name,
             "project_color": project.color or "#6366f1",
-            "total_grupos": total_grupos,
-            "compras_grupos": len(compras_grupos),
-            "servicios_grupos": len(servicios_grupos),
-            "total_items": all_items_count,
-            "aprobados": compras_aprobados + servicios_aprobados,
-            "pendientes": compras_pendientes + servicios_pendientes,
+            "total_grupos": rollup["compras_grupos"] + rollup["servicios_grupos"],
+            "compras_grupos": rollup["compras_grupos"],
+            "servicios_grupos": rollup["servicios_grupos"],
+            "total_items": rollup["total_items"],
+            "aprobados": rollup["aprobados"],
+            "pendientes": rollup["pendientes"],
             "avg_avance": avg_avance,
-            "fecha_proxima": fecha_proxima,
+            "fecha_proxima": rollup["fecha_proxima"],
         })
 
     # Ordenar por avance ascendente (más atrasados primero)
     result.sort(key=lambda x: x["avg_avance"])
     return result
 
+# --- Eventos en tiempo real ---
+
+def _publish_sup_event(versions: Dict[int, int], entity: str, action: str, entity_id: int, data: Optional[dict] = None):
+    """Evento ``sup_*`` (created/updated/deleted) para cada proyecto escrito, con su versión.
+    Los endpoints de supervisión son síncronos, por eso publish_event_threadsafe."""
+    if action == "created":
+        event = {"type": f"{entity}_created", entity: data}
+    elif action == "updated":
+        event = {"type": f"{entity}_updated", f"{entity}_id": entity_id, "changes": data}
+    else:
+        event = {"type": f"{entity}_deleted", f"{entity}_id": entity_id}
+    for project_id, version in versions.items():
+        manager.publish_event_threadsafe(str(project_id), event, version)
+
 # --- Resumen por proyecto ---
 
 @app.get("/api/supervision/{project_id}/resumen", response_model=List[SupResumenItemResponse])
-def get_sup_resumen(project_id: int, db: Session = Depends(get_db), current_user: User = Depends(get_current_user)):
-    return db.query(SupResumenItem).filter(SupResumenItem.project_id == project_id).order_by(SupResumenItem.position).all()
+def get_sup_resumen(project_id: int, db: Session = Depends(get_db), current_user: CurrentUser = Depends(get_current_user),
+                    view: CachedView = Depends(project_response("sup_resumen", List[SupResumenItemResponse]))):
+    if view.hit:
+        return view.response()
+    return view.store(db.query(SupResumenItem).filter(SupResumenItem.project_id == project_id).order_by(SupResumenItem.position).all())
 
 @app.post("/api/supervision/{project_id}/resumen", response_model=SupResumenItemResponse)
-def create_sup_resumen(project_id: int, item: SupResumenItemCreate, db: Session = Depends(get_db), current_user: User = Depends(get_current_user)):
+def create_sup_resumen(project_id: int, item: SupResumenItemCreate, db: Session = Depends(get_db), current_user: CurrentUser = Depends(get_current_user)):
     db_item = SupResumenItem(**item.dict(), project_id=project_id)
     db.add(db_item)
     db.commit()
     db.refresh(db_item)
-    return db_item
+    response = SupResumenItemResponse.model_validate(db_item)
+    _publish_sup_event(_on_project_write(db, project_id), "sup_resumen", "created", db_item.id, response.model_dump(mode='json'))
+    return response
 
 @app.put("/api/supervision/resumen/{item_id}", response_model=SupResumenItemResponse)
-def update_sup_resumen(item_id: int, data: SupResumenItemUpdate, db: Session = Depends(get_db), current_user: User = Depends(get_current_user)):
+def update_sup_resumen(item_id: int, data: SupResumenItemUpdate, db: Session = Depends(get_db), current_user: CurrentUser = Depends(get_current_user)):
     item = db.query(SupResumenItem).filter(SupResumenItem.id == item_id).first()
     if not item:
         raise HTTPException(status_code=404, detail="Item no encontrado")
-    for k, v in data.dict(exclude_unset=True).items():
+    changes = data.dict(exclude_unset=True)
+    for k, v in changes.items():
         setattr(item, k, v)
     db.commit()
     db.refresh(item)
-    return item
+    response = SupResumenItemResponse.model_validate(item)
+    _publish_sup_event(_on_project_write(db, item.project_id), "sup_resumen", "updated", item.id,
+                       response.model_dump(mode='json', include=set(changes)))
+    return response
 
 @app.delete("/api/supervision/resumen/{item_id}")
-def delete_sup_resumen(item_id: int, db: Session = Depends(get_db), current_user: User = Depends(get_current_user)):
+def delete_sup_resumen(item_id: int, db: Session = Depends(get_db), current_user: CurrentUser = Depends(get_current_user)):
     item = db.query(SupResumenItem).filter(SupResumenItem.id == item_id).first()
     if not item:
         raise HTTPException(status_code=404, detail="Item no encontrado")
+    project_id = item.project_id
     db.delete(item)
     db.commit()
+    _publish_sup_event(_on_project_write(db, project_id), "sup_resumen", "deleted", item_id)
     return {"ok": True}
 
-# --- Compras e Importaciones (grupos) ---
+def _load_sup_grupos(db: Session, project_id: int, Grupo, Item, item_grupos):
+    """Grupos de supervisión de un proyecto con sus ítems (propios + de grupos adicionales).
+
+    Número fijo de consultas sin importar la cantidad de grupos: grupos, ítems
+    (por grupo principal o por pertenencia adicional) y extra_grupos de esos ítems.
+    La lista combinada queda en ``grupo._merged_items`` para el esquema de respuesta.
+    """
+    grupos = db.query(Grupo).filter(Grupo.project_id == project_id).order_by(Grupo.position).all()
+    if not grupos:
+        return grupos
+    grupo_ids = [g.id for g in grupos]
+
+    items = db.query(Item).options(selectinload(Item.extra_grupos)).filter(or_(
+        Item.grupo_id.in_(grupo_ids),
+        Item.id.in_(select(item_grupos.c.item_id).where(item_grupos.c.grupo_id.in_(grupo_ids)))
+    )).order_by(Item.position, Item.id).all()
+
+    primary = {gid: [] for gid in grupo_ids}
+    extra = {gid: [] for gid in grupo_ids}
+    for item in items:
+        if item.grupo_id in primary:
+            primary[item.grupo_id].append(item)
+    for item in sorted(items, key=lambda i: i.id):
+        for g in item.extra_grupos:
+            if g.id in extra and g.id != item.grupo_id:
+                extra[g.id].append(item)
 
-@app.get("/api/supervision/{project_id}/compras", response_model=List[SupComprasGrupoResponse])
-def get_sup_compras(project_id: int, db: Session = Depends(get_db), current_user: User = Depends(get_current_user)):
-    grupos = db.query(SupComprasGrupo).filter(SupComprasGrupo.project_id == project_id).order_by(SupComprasGrupo.position).all()
     for grupo in grupos:
-        primary_ids = {item.id for item in grupo.items}
-        extra_items = db.query(SupComprasItem).join(
-            sup_compras_item_grupos,
-            (sup_compras_item_grupos.c.item_id == SupComprasItem.id) &
-            (sup_compras_item_grupos.c.grupo_id == grupo.id)
-        ).filter(SupComprasItem.id.notin_(primary_ids)).all()
-        grupo._merged_items = list(grupo.items) + extra_items
+        grupo._merged_items = primary[grupo.id] + extra[grupo.id]
     return grupos
 
+# --- Compras e Importaciones (grupos) ---
+
+@app.get("/api/supervision/{project_id}/compras", response_model=List[SupComprasGrupoResponse])
+def get_sup_compras(project_id: int, db: Session = Depends(get_db), current_user: CurrentUser = Depends(get_current_user),
+                   view: CachedView = Depends(project_response("sup_compras", List[SupComprasGrupoResponse]))):
+    if view.hit:
+        return view.response()
+    return view.store(_load_sup_grupos(db, project_id, SupComprasGrupo, SupComprasItem, sup_compras_item_grupos))
+
 @app.post("/api/supervision/{project_id}/compras/grupo", response_model=SupComprasGrupoResponse)
-def create_sup_compras_grupo(project_id: int, grupo: SupComprasGrupoCreate, db: Session = Depends(get_db), current_user: User = Depends(get_current_user)):
+def create_sup_compras_grupo(project_id: int, grupo: SupComprasGrupoCreate, db: Session = Depends(get_db), current_user: CurrentUser = Depends(get_current_user)):
     db_grupo = SupComprasGrupo(**grupo.dict(), project_id=project_id)
     db.add(db_grupo)
     db.commit()
     db.refresh(db_grupo)
-    return db_grupo
+    response = SupComprasGrupoResponse.model_validate(db_grupo)
+    _publish_sup_event(_on_project_write(db, project_id), "sup_compras_grupo", "created", db_grupo.id, response.model_dump(mode='json'))
+    return response
 
 @app.put("/api/supervision/compras/grupo/{grupo_id}", response_model=SupComprasGrupoResponse)
-def update_sup_compras_grupo(grupo_id: int, data: SupComprasGrupoUpdate, db: Session = Depends(get_db), current_user: User = Depends(get_current_user)):
+def update_sup_compras_grupo(grupo_id: int, data: SupComprasGrupoUpdate, db: Session = Depends(get_db), current_user: CurrentUser = Depends(get_current_user)):
     grupo = db.query(SupComprasGrupo).filter(SupComprasGrupo.id == grupo_id).first()
     if not grupo:
         raise HTTPException(status_code=404, detail="Grupo no encontrado")
-    for k, v in data.dict(exclude_unset=True).items():
+    changes = data.dict(exclude_unset=True)
+    for k, v in changes.items():
         setattr(grupo, k, v)
     db.commit()
     db.refresh(grupo)
-    return grupo
+    response = SupComprasGrupoResponse.model_validate(grupo)
+    _publish_sup_event(_on_project_write(db, grupo.project_id), "sup_compras_grupo", "updated", grupo.id,
+                       response.model_dump(mode='json', include=set(changes)))
+    return response
 
 @app.delete("/api/supervision/compras/grupo/{grupo_id}")
-def delete_sup_compras_grupo(grupo_id: int, db: Session = Depends(get_db), current_user: User = Depends(get_current_user)):
+def delete_sup_compras_grupo(grupo_id: int, db: Session = Depends(get_db), current_user: CurrentUser = Depends(get_current_user)):
     grupo = db.query(SupComprasGrupo).filter(SupComprasGrupo.id == grupo_id).first()
     if not grupo:
         raise HTTPException(status_code=404, detail="Grupo no encontrado")
+    project_id = grupo.project_id
     db.delete(grupo)
     db.commit()
+    _publish_sup_event(_on_project_write(db, project_id), "sup_compras_grupo", "deleted", grupo_id)
     return {"ok": True}
 
 # --- Compras e Importaciones (items) ---
 
 @app.post("/api/supervision/compras/grupo/{grupo_id}/item", response_model=SupComprasItemResponse)
-def create_sup_compras_item(grupo_id: int, item: SupComprasItemCreate, db: Session = Depends(get_db), current_user: User = Depends(get_current_user)):
+def create_sup_compras_item(grupo_id: int, item: SupComprasItemCreate, db: Session = Depends(get_db), current_user: CurrentUser = Depends(get_current_user)):
     extra_ids = item.extra_grupo_ids or []
     item_data = item.dict(exclude={'extra_grupo_ids'})
     # Si se vincula a una tarea, el avance_proyecto = task.progress (no editable)
@@ -3661,13 +4113,17 @@ def create_sup_compras_item(grupo_id: int, item: SupComprasItemCreate, db: Sessi
         db_item.extra_grupos = extra_grupos
     db.commit()
     db.refresh(db_item)
-    return db_item
+    response = SupComprasItemResponse.model_validate(db_item)
+    _publish_sup_event(_on_project_write(db, *_sup_item_project_ids(db_item)), "sup_compras_item", "created", db_item.id,
+                       response.model_dump(mode='json'))
+    return response
 
 @app.put("/api/supervision/compras/item/{item_id}", response_model=SupComprasItemResponse)
-def update_sup_compras_item(item_id: int, data: SupComprasItemUpdate, db: Session = Depends(get_db), current_user: User = Depends(get_current_user)):
+def update_sup_compras_item(item_id: int, data: SupComprasItemUpdate, db: Session = Depends(get_db), current_user: CurrentUser = Depends(get_current_user)):
     item = db.query(SupComprasItem).filter(SupComprasItem.id == item_id).first()
     if not item:
         raise HTTPException(status_code=404, detail="Item no encontrado")
+    project_ids = _sup_item_project_ids(item)
     update_data = data.dict(exclude_unset=True, exclude={'extra_grupo_ids', 'task_id'})
     # Si task_id viene en el payload, actualizar el vínculo
     if 'task_id' in data.dict(exclude_unset=True):
@@ -3689,64 +4145,71 @@ def update_sup_compras_item(item_id: int, data: SupComprasItemUpdate, db: Sessio
         item.extra_grupos = extra_grupos
     db.commit()
     db.refresh(item)
-    return item
+    response = SupComprasItemResponse.model_validate(item)
+    _publish_sup_event(_on_project_write(db, *project_ids, *_sup_item_project_ids(item)), "sup_compras_item", "updated", item.id,
+                       response.model_dump(mode='json'))
+    return response
 
 @app.delete("/api/supervision/compras/item/{item_id}")
-def delete_sup_compras_item(item_id: int, db: Session = Depends(get_db), current_user: User = Depends(get_current_user)):
+def delete_sup_compras_item(item_id: int, db: Session = Depends(get_db), current_user: CurrentUser = Depends(get_current_user)):
     item = db.query(SupComprasItem).filter(SupComprasItem.id == item_id).first()
     if not item:
         raise HTTPException(status_code=404, detail="Item no encontrado")
+    project_ids = _sup_item_project_ids(item)
     db.delete(item)
     db.commit()
+    _publish_sup_event(_on_project_write(db, *project_ids), "sup_compras_item", "deleted", item_id)
     return {"ok": True}
 
 # --- Contrataciones de Servicios (grupos) ---
 
 @app.get("/api/supervision/{project_id}/servicios", response_model=List[SupServiciosGrupoResponse])
-def get_sup_servicios(project_id: int, db: Session = Depends(get_db), current_user: User = Depends(get_current_user)):
-    grupos = db.query(SupServiciosGrupo).filter(SupServiciosGrupo.project_id == project_id).order_by(SupServiciosGrupo.position).all()
-    for grupo in grupos:
-        primary_ids = {item.id for item in grupo.items}
-        extra_items = db.query(SupServiciosItem).join(
-            sup_servicios_item_grupos,
-            (sup_servicios_item_grupos.c.item_id == SupServiciosItem.id) &
-            (sup_servicios_item_grupos.c.grupo_id == grupo.id)
-        ).filter(SupServiciosItem.id.notin_(primary_ids)).all()
-        grupo._merged_items = list(grupo.items) + extra_items
-    return grupos
+def get_sup_servicios(project_id: int, db: Session = Depends(get_db), current_user: CurrentUser = Depends(get_current_user),
+                   view: CachedView = Depends(project_response("sup_servicios", List[SupServiciosGrupoResponse]))):
+    if view.hit:
+        return view.response()
+    return view.store(_load_sup_grupos(db, project_id, SupServiciosGrupo, SupServiciosItem, sup_servicios_item_grupos))
 
 @app.post("/api/supervision/{project_id}/servicios/grupo", response_model=SupServiciosGrupoResponse)
-def create_sup_servicios_grupo(project_id: int, grupo: SupServiciosGrupoCreate, db: Session = Depends(get_db), current_user: User = Depends(get_current_user)):
+def create_sup_servicios_grupo(project_id: int, grupo: SupServiciosGrupoCreate, db: Session = Depends(get_db), current_user: CurrentUser = Depends(get_current_user)):
     db_grupo = SupServiciosGrupo(**grupo.dict(), project_id=project_id)
     db.add(db_grupo)
     db.commit()
     db.refresh(db_grupo)
-    return db_grupo
+    response = SupServiciosGrupoResponse.model_validate(db_grupo)
+    _publish_sup_event(_on_project_write(db, project_id), "sup_servicios_grupo", "created", db_grupo.id, response.model_dump(mode='json'))
+    return response
 
 @app.put("/api/supervision/servicios/grupo/{grupo_id}", response_model=SupServiciosGrupoResponse)
-def update_sup_servicios_grupo(grupo_id: int, data: SupServiciosGrupoUpdate, db: Session = Depends(get_db), current_user: User = Depends(get_current_user)):
+def update_sup_servicios_grupo(grupo_id: int, data: SupServiciosGrupoUpdate, db: Session = Depends(get_db), current_user: CurrentUser = Depends(get_current_user)):
     grupo = db.query(SupServiciosGrupo).filter(SupServiciosGrupo.id == grupo_id).first()
     if not grupo:
         raise HTTPException(status_code=404, detail="Grupo no encontrado")
-    for k, v in data.dict(exclude_unset=True).items():
+    changes = data.dict(exclude_unset=True)
+    for k, v in changes.items():
         setattr(grupo, k, v)
     db.commit()
     db.refresh(grupo)
-    return grupo
+    response = SupServiciosGrupoResponse.model_validate(grupo)
+    _publish_sup_event(_on_project_write(db, grupo.project_id), "sup_servicios_grupo", "updated", grupo.id,
+                       response.model_dump(mode='json', include=set(changes)))
+    return response
 
 @app.delete("/api/supervision/servicios/grupo/{grupo_id}")
-def delete_sup_servicios_grupo(grupo_id: int, db: Session = Depends(get_db), current_user: User = Depends(get_current_user)):
+def delete_sup_servicios_grupo(grupo_id: int, db: Session = Depends(get_db), current_user: CurrentUser = Depends(get_current_user)):
     grupo = db.query(SupServiciosGrupo).filter(SupServiciosGrupo.id == grupo_id).first()
     if not grupo:
         raise HTTPException(status_code=404, detail="Grupo no encontrado")
+    project_id = grupo.project_id
     db.delete(grupo)
     db.commit()
+    _publish_sup_event(_on_project_write(db, project_id), "sup_servicios_grupo", "deleted", grupo_id)
     return {"ok": True}
 
 # --- Contrataciones de Servicios (items) ---
 
 @app.post("/api/supervision/servicios/grupo/{grupo_id}/item", response_model=SupServiciosItemResponse)
-def create_sup_servicios_item(grupo_id: int, item: SupServiciosItemCreate, db: Session = Depends(get_db), current_user: User = Depends(get_current_user)):
+def create_sup_servicios_item(grupo_id: int, item: SupServiciosItemCreate, db: Session = Depends(get_db), current_user: CurrentUser = Depends(get_current_user)):
     extra_ids = item.extra_grupo_ids or []
     item_data = item.dict(exclude={'extra_grupo_ids'})
     # Si se vincula a una tarea, el avance_proyecto = task.progress (no editable)
@@ -3765,13 +4228,17 @@ def create_sup_servicios_item(grupo_id: int, item: SupServiciosItemCreate, db: S
         db_item.extra_grupos = extra_grupos
     db.commit()
     db.refresh(db_item)
-    return db_item
+    response = SupServiciosItemResponse.model_validate(db_item)
+    _publish_sup_event(_on_project_write(db, *_sup_item_project_ids(db_item)), "sup_servicios_item", "created", db_item.id,
+                       response.model_dump(mode='json'))
+    return response
 
 @app.put("/api/supervision/servicios/item/{item_id}", response_model=SupServiciosItemResponse)
-def update_sup_servicios_item(item_id: int, data: SupServiciosItemUpdate, db: Session = Depends(get_db), current_user: User = Depends(get_current_user)):
+def update_sup_servicios_item(item_id: int, data: SupServiciosItemUpdate, db: Session = Depends(get_db), current_user: CurrentUser = Depends(get_current_user)):
     item = db.query(SupServiciosItem).filter(SupServiciosItem.id == item_id).first()
     if not item:
         raise HTTPException(status_code=404, detail="Item no encontrado")
+    project_ids = _sup_item_project_ids(item)
     update_data = data.dict(exclude_unset=True, exclude={'extra_grupo_ids', 'task_id'})
     # Si task_id viene en el payload, actualizar el vínculo
     if 'task_id' in data.dict(exclude_unset=True):
@@ -3793,13 +4260,18 @@ def update_sup_servicios_item(item_id: int, data: SupServiciosItemUpdate, db: Se
         item.extra_grupos = extra_grupos
     db.commit()
     db.refresh(item)
-    return item
+    response = SupServiciosItemResponse.model_validate(item)
+    _publish_sup_event(_on_project_write(db, *project_ids, *_sup_item_project_ids(item)), "sup_servicios_item", "updated", item.id,
+                       response.model_dump(mode='json'))
+    return response
 
 @app.delete("/api/supervision/servicios/item/{item_id}")
-def delete_sup_servicios_item(item_id: int, db: Session = Depends(get_db), current_user: User = Depends(get_current_user)):
+def delete_sup_servicios_item(item_id: int, db: Session = Depends(get_db), current_user: CurrentUser = Depends(get_current_user)):
     item = db.query(SupServiciosItem).filter(SupServiciosItem.id == item_id).first()
     if not item:
         raise HTTPException(status_code=404, detail="Item no encontrado")
+    project_ids = _sup_item_project_ids(item)
     db.delete(item)
     db.commit()
+    _publish_sup_event(_on_project_write(db, *project_ids), "sup_servicios_item", "deleted", item_id)
     return {"ok": True}
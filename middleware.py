@@ -0,0 +1,138 @@
+# ===================== MIDDLEWARE ASGI =====================
+# Middleware escritos directamente sobre ASGI (sin BaseHTTPMiddleware): no
+# crean una tarea extra por petición ni acumulan en memoria las respuestas
+# en streaming (reportes PDF); solo tocan los mensajes que necesitan.
+import gzip
+import os
+from typing import List, Set, Tuple
+from starlette.datastructures import Headers, MutableHeaders
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+# Respuestas JSON más chicas que esto no se comprimen (no vale la pena)
+COMPRESS_MIN_SIZE = int(os.getenv("COMPRESS_MIN_SIZE", "1024"))
+GZIP_LEVEL = int(os.getenv("GZIP_LEVEL", "6"))
+
+
+class NoCacheMiddleware:
+    """Evita caché en /static (archivos sin versionar; los versionados van por /assets)"""
+
+    def __init__(self, app: ASGIApp, prefix: str = "/static"):
+        self.app = app
+        self.prefix = prefix
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send):
+        if scope["type"] != "http" or not scope["path"].startswith(self.prefix):
+            await self.app(scope, receive, send)
+            return
+
+        async def send_no_cache(message: Message):
+            if message["type"] == "http.response.start":
+                headers = MutableHeaders(scope=message)
+                headers["Cache-Control"] = "no-cache, no-store, must-revalidate"
+                headers["Pragma"] = "no-cache"
+                headers["Expires"] = "0"
+            await send(message)
+
+        await self.app(scope, receive, send_no_cache)
+
+
+def accepted_encodings(accept_encoding: str) -> Set[str]:
+    """Codificaciones aceptadas según Accept-Encoding (las con q=0 quedan fuera)"""
+    accepted = set()
+    for part in accept_encoding.split(","):
+        token, *params = [p.strip() for p in part.split(";")]
+        quality = 1.0
+        for param in params:
+            name, _, value = param.partition("=")
+            if name.strip().lower() == "q":
+                try:
+                    quality = float(value)
+                except ValueError:
+                    quality = 0.0
+        if token and quality > 0:
+            accepted.add(token.lower())
+    return accepted
+
+
+def _choose_encoding(accept_encoding: str) -> str:
+    """br si el cliente lo acepta y brotli está instalado; si no gzip; "" si ninguno"""
+    accepted = accepted_encodings(accept_encoding)
+    if brotli is not None and "br" in accepted:
+        return "br"
+    if "gzip" in accepted:
+        return "gzip"
+    return ""
+
+
+def _compress(body: bytes, encoding: str) -> bytes:
+    if encoding == "br":
+        return brotli.compress(body, quality=4)
+    return gzip.compress(body, compresslevel=GZIP_LEVEL)
+
+
+class CompressionMiddleware:
+    """Comprime (br/gzip) las respuestas JSON de la API mayores a ``min_size``.
+
+    Solo se comprimen respuestas que llegan en un único mensaje de cuerpo (las
+    JSON normales); las respuestas en streaming, sin cuerpo (304) o que ya
+    vienen comprimidas pasan tal cual, sin acumularse en memoria.
+    """
+
+    def __init__(self, app: ASGIApp, prefix: str = "/api", min_size: int = COMPRESS_MIN_SIZE):
+        self.app = app
+        self.prefix = prefix
+        self.min_size = min_size
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send):
+        if scope["type"] != "http" or not scope["path"].startswith(self.prefix):
+            await self.app(scope, receive, send)
+            return
+        encoding = _choose_encoding(Headers(scope=scope).get("accept-encoding", ""))
+        if not encoding:
+            await self.app(scope, receive, send)
+            return
+
+        start: List[Message] = []  # mensaje http.response.start retenido hasta ver el cuerpo
+        passthrough = False
+
+        async def send_compressed(message: Message):
+            nonlocal passthrough
+            if passthrough:
+                await send(message)
+                return
+            if message["type"] == "http.response.start":
+                headers = Headers(raw=message["headers"])
+                if not headers.get("content-type", "").startswith("application/json") or "content-encoding" in headers:
+                    passthrough = True
+                    await send(message)
+                else:
+                    start.append(message)
+                return
+            if message["type"] != "http.response.body":
+                await send(message)
+                return
+
+            body = message.get("body", b"")
+            start_message = start.pop()
+            passthrough = True
+            if message.get("more_body", False) or len(body) < self.min_size:
+                headers = MutableHeaders(scope=start_message)
+                headers.add_vary_header("Accept-Encoding")
+                await send(start_message)
+                await send(message)
+                return
+
+            compressed = _compress(body, encoding)
+            headers = MutableHeaders(scope=start_message)
+            headers["Content-Encoding"] = encoding
+            headers["Content-Length"] = str(len(compressed))
+            headers.add_vary_header("Accept-Encoding")
+            await send(start_message)
+            await send({"type": "http.response.body", "body": compressed, "more_body": False})
+
+        await self.app(scope, receive, send_compressed)
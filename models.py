@@ -1,8 +1,14 @@
-from sqlalchemy import Column, Integer, String, Text, DateTime, ForeignKey, Float, Boolean, Table
+from sqlalchemy import Column, Integer, String, Text, DateTime, Date, ForeignKey, Float, Boolean, Table, Index, UniqueConstraint, case, cast, func
+from sqlalchemy.ext.hybrid import hybrid_property
 from sqlalchemy.orm import relationship
 from datetime import datetime
 from database import Base
 
+def _checks_avance_expr(checks):
+    """Expresión SQL del % de checkboxes marcados (equivalente a la propiedad avance)"""
+    marked = sum(case((c == True, 1), else_=0) for c in checks)
+    return cast(func.round(marked * 100.0 / len(checks)), Integer)
+
 # Tabla de asociación para múltiples asignados por tarea
 task_assignees = Table(
     'task_assignees',
@@ -53,6 +59,7 @@ class User(Base):
     avatar_color = Column(String(20), default="#6366f1")
     is_admin = Column(Boolean, default=False)  # Es administrador
     is_approved = Column(Boolean, default=False)  # Aprobado por admin
+    auth_version = Column(Integer, default=0)  # Se incrementa al cambiar datos o permisos (invalida la sesión en caché)
     created_at = Column(DateTime, default=datetime.utcnow)
     
     projects = relationship("Project", back_populates="owner", foreign_keys="[Project.owner_id]")
@@ -83,6 +90,7 @@ class Project(Base):
     perm_variables_urbanas = Column(Boolean, default=False)
     created_at = Column(DateTime, default=datetime.utcnow)
     updated_at = Column(DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+    data_version = Column(Integer, default=0)  # Se incrementa con cada cambio en el proyecto o sus datos (ETag)
     
     owner = relationship("User", back_populates="projects", foreign_keys=[owner_id])
     coordinator = relationship("User", foreign_keys=[coordinator_id])
@@ -125,6 +133,10 @@ class ProjectMember(Base):
 
 class Task(Base):
     __tablename__ = "tasks"
+    __table_args__ = (
+        # Tablero: columnas por estado, orden por posición (paginación por cursor)
+        Index("ix_tasks_board", "project_id", "status", "position", "id"),
+    )
     
     id = Column(Integer, primary_key=True, index=True)
     title = Column(String(300), nullable=False)
@@ -402,11 +414,15 @@ class SupComprasItem(Base):
     extra_grupos = relationship("SupComprasGrupo", secondary="sup_compras_item_grupos", lazy="select")
     task = relationship("Task", foreign_keys=[task_id], lazy="select")
 
-    @property
+    @hybrid_property
     def avance(self) -> int:
         checks = [self.procura, self.contratado, self.fabricado, self.despacho, self.recepcion]
         return int(round(sum(1 for c in checks if c) / 5 * 100))
 
+    @avance.expression
+    def avance(cls):
+        return _checks_avance_expr([cls.procura, cls.contratado, cls.fabricado, cls.despacho, cls.recepcion])
+
 
 class SupServiciosGrupo(Base):
     """Grupos dentro de Contrataciones de Servicios"""
@@ -451,11 +467,15 @@ class SupServiciosItem(Base):
     extra_grupos = relationship("SupServiciosGrupo", secondary="sup_servicios_item_grupos", lazy="select")
     task = relationship("Task", foreign_keys=[task_id], lazy="select")
 
-    @property
+    @hybrid_property
     def avance(self) -> int:
         checks = [self.solicitud, self.contratado, self.fabricado, self.instalado]
         return int(round(sum(1 for c in checks if c) / 4 * 100))
 
+    @avance.expression
+    def avance(cls):
+        return _checks_avance_expr([cls.solicitud, cls.contratado, cls.fabricado, cls.instalado])
+
 
 
 class TaskTemplateItem(Base):
@@ -485,3 +505,55 @@ class AdminTeam(Base):
     
     admin = relationship("User", foreign_keys=[admin_id])
     member = relationship("User", foreign_keys=[member_id])
+
+
+# ==================== HISTÓRICO DE EFECTIVIDAD ====================
+class EffectivenessSnapshot(Base):
+    """Foto diaria de la efectividad de un proyecto (stage_id NULL) y de cada una de sus etapas"""
+    __tablename__ = "effectiveness_snapshots"
+    __table_args__ = (
+        Index("ix_effectiveness_snapshots_project_date", "project_id", "snapshot_date"),
+        # Una foto por día, proyecto y etapa aunque la tarea diaria corra en varios workers
+        UniqueConstraint("snapshot_date", "project_id", "stage_key", name="uq_effectiveness_snapshots_day"),
+    )
+    
+    id = Column(Integer, primary_key=True, index=True)
+    snapshot_date = Column(Date, nullable=False, index=True)
+    project_id = Column(Integer, ForeignKey("projects.id", ondelete="CASCADE"), nullable=False)
+    stage_id = Column(Integer, ForeignKey("stages.id", ondelete="CASCADE"), nullable=True)  # NULL = fila del proyecto
+    stage_key = Column(Integer, nullable=False, default=0)  # stage_id o 0 en la fila del proyecto (NULL no cuenta en la clave única)
+    scheduled_progress = Column(Float, default=0)
+    actual_progress = Column(Float, default=0)
+    effectiveness = Column(Float, default=0)
+    status = Column(String(20))  # adelantado, en_tiempo, atrasado (solo filas de proyecto)
+    total_tasks = Column(Integer, default=0)
+    completed_tasks = Column(Integer, default=0)
+    created_at = Column(DateTime, default=datetime.utcnow)
+
+
+class CatalogVersion(Base):
+    """Contador de cambios del catálogo de plantillas (una sola fila, id=1). Cada
+    worker compara su foto en memoria con este número para saber si está vigente."""
+    __tablename__ = "catalog_version"
+    
+    id = Column(Integer, primary_key=True)
+    version = Column(Integer, nullable=False, default=0)
+
+
+class ChangeLog(Base):
+    """Registro de cambios por proyecto para la sincronización incremental (/changes).
+    Solo guarda qué entidad cambió y en qué versión del proyecto; el contenido
+    actual se lee de su tabla. Las filas entity_type="floor" marcan hasta qué
+    versión se depuró el registro."""
+    __tablename__ = "change_log"
+    __table_args__ = (
+        Index("ix_change_log_project_version", "project_id", "version"),
+    )
+    
+    id = Column(Integer, primary_key=True, index=True)
+    project_id = Column(Integer, ForeignKey("projects.id", ondelete="CASCADE"), nullable=False)
+    version = Column(Integer, nullable=False)  # data_version del proyecto después del cambio
+    entity_type = Column(String(30), nullable=False)  # task, stage, milestone, sup_resumen, sup_compras_grupo, ...
+    entity_id = Column(Integer, nullable=False)
+    action = Column(String(10), nullable=False)  # upsert | delete
+    created_at = Column(DateTime, default=datetime.utcnow)
@@ -0,0 +1,516 @@
+# ===================== WEBSOCKET: DIFUSIÓN POR PROYECTO =====================
+# Cada conexión tiene su propia cola de salida acotada y una tarea que escribe
+# en el socket. broadcast() solo encola (no espera a ningún cliente), así un
+# celular lento en obra no demora a los demás suscriptores del proyecto.
+#
+# Si la cola de un cliente se llena se vacía y se le envía un único mensaje
+# {"type": "resync"} para que se ponga al día con /api/projects/{id}/changes;
+# si vuelve a desbordarse demasiadas veces se cierra la conexión. Un envío que
+# falla o tarda más de WS_SEND_TIMEOUT saca la conexión de inmediato.
+#
+# Los celulares en obra suelen dejar conexiones TCP medio abiertas: el servidor
+# envía {"type": "ping"} cada WS_PING_INTERVAL y el cliente responde "pong";
+# la conexión que no manda nada en WS_IDLE_TIMEOUT se cierra. También hay un
+# máximo de conexiones por proyecto y por usuario en cada worker.
+#
+# Los clientes no difunden nada: solo se autentican (JWT en el primer mensaje,
+# no en la URL, para que no quede en los logs de acceso), responden los ping y
+# quedan limitados a WS_RATE_LIMIT mensajes por segundo. Todos los eventos
+# salen del servidor, así el tráfico depende de las escrituras reales.
+#
+# Con varios workers (gunicorn) cada proceso tiene sus propias conexiones: la
+# difusión pasa por un BroadcastBackend que entrega el mensaje a los clientes
+# del proceso y lo reenvía a los demás workers (ver SQLiteBroadcastBackend).
+#
+# Los eventos de datos se agrupan por proyecto durante WS_COALESCE_WINDOW y
+# salen en un único mensaje {"type": "batch", "version", "versions", "events"}:
+# las actualizaciones llevan solo los campos que cambiaron y varias sobre la
+# misma entidad dentro de la ventana se funden en una (ver EventBatch).
+import asyncio
+import json
+import os
+import sqlite3
+import time
+import uuid
+from abc import ABC, abstractmethod
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Dict, Optional, Set, Tuple
+from fastapi import WebSocket
+from starlette.websockets import WebSocketState
+
+WS_QUEUE_SIZE = int(os.getenv("WS_QUEUE_SIZE", "100"))
+WS_SEND_TIMEOUT = float(os.getenv("WS_SEND_TIMEOUT", "10"))
+WS_MAX_OVERFLOWS = int(os.getenv("WS_MAX_OVERFLOWS", "3"))
+WS_PING_INTERVAL = float(os.getenv("WS_PING_INTERVAL", "25"))
+WS_IDLE_TIMEOUT = float(os.getenv("WS_IDLE_TIMEOUT", "60"))
+# Límites por worker: con N workers el máximo real es N veces estos valores
+WS_MAX_PER_PROJECT = int(os.getenv("WS_MAX_PER_PROJECT", "200"))
+WS_MAX_PER_USER = int(os.getenv("WS_MAX_PER_USER", "5"))
+WS_AUTH_TIMEOUT = float(os.getenv("WS_AUTH_TIMEOUT", "10"))  # segundos para recibir el mensaje de autenticación
+WS_RATE_LIMIT = float(os.getenv("WS_RATE_LIMIT", "2"))  # mensajes entrantes por segundo
+WS_RATE_BURST = float(os.getenv("WS_RATE_BURST", "10"))
+WS_COALESCE_WINDOW = float(os.getenv("WS_COALESCE_WINDOW", "0.05"))  # segundos
+
+# Códigos de cierre: 1001 inactiva (o sin autenticarse a tiempo), 1003 mensaje
+# inválido, 1008 límite de conexiones o de mensajes, 1013 cliente lento,
+# 4401 sin token válido, 4403 sin acceso al proyecto (el cliente no reintenta 4401/4403)
+CLOSE_IDLE = 1001
+CLOSE_INVALID = 1003
+CLOSE_LIMIT = 1008
+CLOSE_SLOW = 1013
+CLOSE_UNAUTHORIZED = 4401
+CLOSE_FORBIDDEN = 4403
+
+# "sqlite" (varios workers en el mismo host) o "memory" (un solo proceso)
+WS_BROADCAST_BACKEND = os.getenv("WS_BROADCAST_BACKEND", "sqlite")
+WS_BUS_PATH = os.getenv("WS_BUS_PATH", "ws_bus.db")
+WS_BUS_POLL_INTERVAL = float(os.getenv("WS_BUS_POLL_INTERVAL", "0.1"))
+WS_BUS_RETENTION = float(os.getenv("WS_BUS_RETENTION", "60"))  # segundos
+
+RESYNC_MESSAGE = json.dumps({"type": "resync"})
+PING_MESSAGE = json.dumps({"type": "ping"})
+PONG_MESSAGE = json.dumps({"type": "pong"})
+_CLOSE = object()
+
+
+class Connection:
+    """Un cliente conectado: cola de salida + tarea escritora"""
+
+    def __init__(self, websocket: WebSocket, project_id: str, manager: "ConnectionManager",
+                 user_id: Optional[int] = None):
+        self.websocket = websocket
+        self.project_id = project_id
+        self.user_id = user_id
+        self.manager = manager
+        self.last_seen = time.monotonic()
+        self._allowance = WS_RATE_BURST
+        self.queue: asyncio.Queue = asyncio.Queue(maxsize=WS_QUEUE_SIZE)
+        self.overflows = 0
+        self.resync_pending = False
+        self.closed = False
+        self.close_code: Optional[int] = None
+        self.writer: Optional[asyncio.Task] = None
+
+    def start(self):
+        self.writer = asyncio.create_task(self._write_loop())
+
+    def touch(self) -> bool:
+        """Registrar un mensaje recibido (incluido pong). Devuelve False si el
+        cliente superó WS_RATE_LIMIT (cubeta de fichas de WS_RATE_BURST)."""
+        now = time.monotonic()
+        self._allowance = min(WS_RATE_BURST, self._allowance + (now - self.last_seen) * WS_RATE_LIMIT)
+        self.last_seen = now
+        if self._allowance < 1:
+            return False
+        self._allowance -= 1
+        return True
+
+    def offer(self, text: str):
+        """Encola un mensaje sin esperar; si la cola está llena se degrada a resync"""
+        if self.closed or self.resync_pending:
+            return  # el cliente va a pedir /changes de todos modos
+        try:
+            self.queue.put_nowait(text)
+        except asyncio.QueueFull:
+            self._overflow()
+
+    def _overflow(self):
+        self.overflows += 1
+        while not self.queue.empty():
+            self.queue.get_nowait()
+        if self.overflows > WS_MAX_OVERFLOWS:
+            print(f"⚠️ WebSocket lento descartado (proyecto {self.project_id})")
+            self.manager.disconnect(self, code=CLOSE_SLOW)
+            return
+        self.resync_pending = True
+        self.queue.put_nowait(RESYNC_MESSAGE)
+
+    async def _write_loop(self):
+        try:
+            while True:
+                text = await self.queue.get()
+                if text is _CLOSE:
+                    if self.close_code:
+                        try:
+                            await asyncio.wait_for(self.websocket.close(code=self.close_code), timeout=WS_SEND_TIMEOUT)
+                        except Exception:
+                            pass
+                    break
+                if text is RESYNC_MESSAGE:
+                    self.resync_pending = False
+                await asyncio.wait_for(self.websocket.send_text(text), timeout=WS_SEND_TIMEOUT)
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            # Socket muerto o bloqueado: fuera de inmediato
+            self.manager.disconnect(self)
+            try:
+                await asyncio.wait_for(self.websocket.close(), timeout=WS_SEND_TIMEOUT)
+            except Exception:
+                pass
+
+    def close(self, code: Optional[int] = None):
+        """Detiene la tarea escritora (los mensajes pendientes se descartan).
+        Con ``code`` además cierra el socket desde el servidor."""
+        if self.closed:
+            return
+        self.closed = True
+        self.close_code = code
+        while not self.queue.empty():
+            self.queue.get_nowait()
+        self.queue.put_nowait(_CLOSE)
+
+
+async def receive_first_message(websocket: WebSocket) -> Optional[dict]:
+    """Acepta la conexión y espera el primer mensaje (la autenticación) hasta
+    WS_AUTH_TIMEOUT segundos. Devuelve el mensaje ASGI tal cual (puede ser
+    binario o una desconexión; el texto viene en "text") o None si no llega a tiempo."""
+    await websocket.accept()
+    try:
+        return await asyncio.wait_for(websocket.receive(), timeout=WS_AUTH_TIMEOUT)
+    except asyncio.TimeoutError:
+        return None
+
+
+async def reject(websocket: WebSocket, code: int):
+    """Rechaza una conexión con un código que el navegador puede leer en onclose"""
+    if websocket.client_state == WebSocketState.DISCONNECTED:
+        return  # el cliente ya se fue
+    if websocket.client_state == WebSocketState.CONNECTING:
+        await websocket.accept()
+    await websocket.close(code=code)
+
+
+# ===================== BACKENDS DE DIFUSIÓN =====================
+Deliver = Callable[[str, str], None]  # (canal = project_id, mensaje ya serializado)
+
+
+class BroadcastBackend(ABC):
+    """Reparte los mensajes de un canal entre los procesos que atienden WebSockets.
+
+    ``publish`` entrega siempre en el proceso actual (vía ``deliver``) y además
+    hace llegar el mensaje a los demás procesos, que lo entregan a sus clientes.
+    """
+
+    def __init__(self):
+        self.deliver: Optional[Deliver] = None
+
+    async def start(self, deliver: Deliver):
+        self.deliver = deliver
+
+    async def stop(self):
+        pass
+
+    @abstractmethod
+    async def publish(self, channel: str, text: str):
+        ...
+
+
+class InMemoryBroadcastBackend(BroadcastBackend):
+    """Un solo proceso: entrega directa"""
+
+    async def publish(self, channel: str, text: str):
+        if self.deliver:
+            self.deliver(channel, text)
+
+
+class SQLiteBroadcastBackend(BroadcastBackend):
+    """Bus entre workers del mismo host sobre un archivo SQLite (sin servicios externos).
+
+    Cada proceso inserta lo que publica en la tabla ``messages`` y consulta cada
+    WS_BUS_POLL_INTERVAL las filas nuevas de los otros procesos. Las consultas
+    corren en un hilo propio para no bloquear el event loop; las filas con más de
+    WS_BUS_RETENTION segundos se borran.
+    """
+
+    def __init__(self, path: str = WS_BUS_PATH, poll_interval: float = WS_BUS_POLL_INTERVAL,
+                 retention: float = WS_BUS_RETENTION):
+        super().__init__()
+        self.path = path
+        self.poll_interval = poll_interval
+        self.retention = retention
+        self.origin = uuid.uuid4().hex  # identifica a este proceso en el bus
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="ws-bus")
+        self._conn: Optional[sqlite3.Connection] = None
+        self._last_id = 0
+        self._last_prune = 0.0
+        self._task: Optional[asyncio.Task] = None
+
+    async def _run(self, fn, *args):
+        return await asyncio.get_running_loop().run_in_executor(self._executor, fn, *args)
+
+    def _open(self) -> int:
+        conn = sqlite3.connect(self.path, timeout=5, isolation_level=None, check_same_thread=False)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS messages ("
+            "id INTEGER PRIMARY KEY AUTOINCREMENT, origin TEXT NOT NULL, channel TEXT NOT NULL, "
+            "payload TEXT NOT NULL, created_at REAL NOT NULL)"
+        )
+        self._conn = conn
+        return conn.execute("SELECT COALESCE(MAX(id), 0) FROM messages").fetchone()[0]
+
+    def _insert(self, channel: str, text: str):
+        self._conn.execute(
+            "INSERT INTO messages (origin, channel, payload, created_at) VALUES (?, ?, ?, ?)",
+            (self.origin, channel, text, time.time()),
+        )
+
+    def _fetch(self, after_id: int):
+        now = time.time()
+        if now - self._last_prune > self.retention:
+            self._conn.execute("DELETE FROM messages WHERE created_at < ?", (now - self.retention,))
+            self._last_prune = now
+        return self._conn.execute(
+            "SELECT id, origin, channel, payload FROM messages WHERE id > ? ORDER BY id LIMIT 500",
+            (after_id,),
+        ).fetchall()
+
+    async def start(self, deliver: Deliver):
+        await super().start(deliver)
+        self._last_id = await self._run(self._open)
+        self._task = asyncio.create_task(self._poll_loop())
+
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
+            self._task = None
+        if self._conn is not None:
+            await self._run(self._conn.close)
+            self._conn = None
+
+    async def _poll_loop(self):
+        while True:
+            try:
+                rows = await self._run(self._fetch, self._last_id)
+                for row_id, origin, channel, text in rows:
+                    self._last_id = row_id
+                    if origin != self.origin:
+                        self.deliver(channel, text)
+                if len(rows) == 500:
+                    continue  # quedan más filas pendientes
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                print(f"⚠️ Error leyendo el bus de WebSocket: {e}")
+            await asyncio.sleep(self.poll_interval)
+
+    async def publish(self, channel: str, text: str):
+        if self.deliver:
+            self.deliver(channel, text)
+        if self._conn is None:
+            return  # no iniciado (un solo proceso, p. ej. en pruebas)
+        try:
+            await self._run(self._insert, channel, text)
+        except Exception as e:
+            print(f"⚠️ No se pudo publicar en el bus de WebSocket: {e}")
+
+
+def create_broadcast_backend(name: str = WS_BROADCAST_BACKEND) -> BroadcastBackend:
+    if name == "memory":
+        return InMemoryBroadcastBackend()
+    if name == "sqlite":
+        return SQLiteBroadcastBackend()
+    raise ValueError(f"WS_BROADCAST_BACKEND desconocido: {name}")
+
+
+# ===================== AGRUPACIÓN DE EVENTOS =====================
+class EventBatch:
+    """Eventos de un proyecto pendientes de envío, fundidos por entidad.
+
+    Los eventos son ``{"type": "<entidad>_created", "<entidad>": {...}}``,
+    ``{"type": "<entidad>_updated", "<entidad>_id": id, "changes": {...}}`` y
+    ``{"type": "<entidad>_deleted", "<entidad>_id": id}``. Dentro del lote:
+    created + updated -> created con los cambios aplicados; updated + updated ->
+    un updated con los cambios combinados; created + deleted -> nada.
+    """
+
+    def __init__(self, loop: Optional[asyncio.AbstractEventLoop] = None):
+        self.loop = loop
+        self.events: Dict[Tuple[str, int], dict] = {}
+        self.versions: Set[int] = set()
+
+    def add(self, event: dict, version: Optional[int] = None):
+        if version is not None:
+            self.versions.add(version)
+        entity, action = event["type"].rsplit("_", 1)
+        entity_id = event[entity]["id"] if action == "created" else event[f"{entity}_id"]
+        key = (entity, entity_id)
+        previous = self.events.get(key)
+        if previous is None or action == "created":
+            self.events[key] = {**event, "changes": dict(event["changes"])} if action == "updated" else dict(event)
+            return
+        previous_action = previous["type"].rsplit("_", 1)[1]
+        if action == "updated":
+            if previous_action == "created":
+                previous[entity] = {**previous[entity], **event["changes"]}
+            elif previous_action == "updated":
+                previous["changes"].update(event["changes"])
+        elif action == "deleted":
+            if previous_action == "created":
+                del self.events[key]  # nunca llegó a los clientes
+            else:
+                self.events[key] = event
+
+    def message(self) -> dict:
+        """``versions``: versiones del proyecto cubiertas por el lote (si son
+        consecutivas a la que tiene el cliente, no necesita pedir /changes)"""
+        versions = sorted(self.versions)
+        return {
+            "type": "batch",
+            "version": versions[-1] if versions else None,
+            "versions": versions,
+            "events": list(self.events.values()),
+        }
+
+
+# ===================== ADMINISTRADOR DE CONEXIONES =====================
+class ConnectionManager:
+    def __init__(self, backend: Optional[BroadcastBackend] = None):
+        self.active_connections: Dict[str, Set[Connection]] = {}
+        self.user_connections: Dict[int, int] = {}
+        self.backend = backend or InMemoryBroadcastBackend()
+        self.backend.deliver = self._deliver
+        self._heartbeat: Optional[asyncio.Task] = None
+        self._batches: Dict[str, EventBatch] = {}
+        self._flushes: Set[asyncio.Task] = set()
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+
+    async def start(self):
+        self._loop = asyncio.get_running_loop()
+        await self.backend.start(self._deliver)
+        self._heartbeat = asyncio.create_task(self._heartbeat_loop())
+
+    async def stop(self):
+        if self._heartbeat:
+            self._heartbeat.cancel()
+            self._heartbeat = None
+        for project_id in list(self._batches):
+            await self._flush(project_id)
+        await self.backend.stop()
+
+    async def connect(self, websocket: WebSocket, project_id: str,
+                      user_id: Optional[int] = None) -> Optional[Connection]:
+        """Acepta la conexión; si se supera un límite la cierra (1008) y devuelve None"""
+        if websocket.client_state == WebSocketState.CONNECTING:
+            await websocket.accept()
+        if len(self.active_connections.get(project_id, ())) >= WS_MAX_PER_PROJECT or (
+            user_id is not None and self.user_connections.get(user_id, 0) >= WS_MAX_PER_USER
+        ):
+            await websocket.close(code=CLOSE_LIMIT)
+            return None
+        connection = Connection(websocket, project_id, self, user_id)
+        self.active_connections.setdefault(project_id, set()).add(connection)
+        if user_id is not None:
+            self.user_connections[user_id] = self.user_connections.get(user_id, 0) + 1
+        connection.start()
+        return connection
+
+    def disconnect(self, connection: Connection, code: Optional[int] = None):
+        connections = self.active_connections.get(connection.project_id)
+        if connections is not None and connection in connections:
+            connections.discard(connection)
+            if not connections:
+                del self.active_connections[connection.project_id]
+            if connection.user_id is not None:
+                remaining = self.user_connections.get(connection.user_id, 1) - 1
+                if remaining > 0:
+                    self.user_connections[connection.user_id] = remaining
+                else:
+                    self.user_connections.pop(connection.user_id, None)
+        connection.close(code)
+
+    def reap_idle(self, now: Optional[float] = None) -> int:
+        """Cierra las conexiones sin actividad en WS_IDLE_TIMEOUT y hace ping al resto"""
+        now = time.monotonic() if now is None else now
+        reaped = 0
+        for connections in list(self.active_connections.values()):
+            for connection in list(connections):
+                if now - connection.last_seen > WS_IDLE_TIMEOUT:
+                    self.disconnect(connection, code=CLOSE_IDLE)
+                    reaped += 1
+                else:
+                    connection.offer(PING_MESSAGE)
+        return reaped
+
+    async def _heartbeat_loop(self):
+        while True:
+            await asyncio.sleep(WS_PING_INTERVAL)
+            try:
+                reaped = self.reap_idle()
+                if reaped:
+                    print(f"🔌 {reaped} WebSocket inactivos cerrados")
+            except Exception as e:
+                print(f"⚠️ Error en heartbeat de WebSocket: {e}")
+
+    def stats(self) -> dict:
+        """Conexiones y mensajes en cola por proyecto (solo de este worker).
+        Los límites por proyecto y por usuario también se cuentan por worker."""
+        now = time.monotonic()
+        projects = []
+        for project_id, connections in sorted(self.active_connections.items()):
+            depths = [c.queue.qsize() for c in connections]
+            projects.append({
+                "project_id": project_id,
+                "connections": len(connections),
+                "queued": sum(depths),
+                "max_queue": max(depths, default=0),
+                "resync_pending": sum(1 for c in connections if c.resync_pending),
+                "max_idle_seconds": round(max((now - c.last_seen for c in connections), default=0), 1),
+            })
+        return {
+            "worker": os.getpid(),
+            "backend": type(self.backend).__name__,
+            "total_connections": sum(p["connections"] for p in projects),
+            "users": len(self.user_connections),
+            # Por worker: con N workers un usuario puede llegar a N * per_user conexiones
+            "limits": {"scope": "worker", "per_project": WS_MAX_PER_PROJECT, "per_user": WS_MAX_PER_USER,
+                       "queue_size": WS_QUEUE_SIZE},
+            "projects": projects,
+        }
+
+    async def broadcast(self, message: dict, project_id: str):
+        """Serializa una vez y publica para los clientes del proyecto en todos los workers"""
+        await self.backend.publish(project_id, json.dumps(message))
+
+    def publish_event(self, project_id: str, event: dict, version: int):
+        """Agrega un evento al lote del proyecto; el lote sale a los WS_COALESCE_WINDOW
+        segundos del primer evento. ``version``: data_version del proyecto tras la
+        escritura (la que devuelve _on_project_write); sin ella los clientes piden /changes."""
+        loop = asyncio.get_running_loop()
+        batch = self._batches.get(project_id)
+        if batch is None or batch.loop is not loop:  # lote de un event loop que ya terminó
+            batch = self._batches[project_id] = EventBatch(loop)
+            loop.call_later(WS_COALESCE_WINDOW, self._schedule_flush, project_id)
+        batch.add(event, version)
+
+    def publish_event_threadsafe(self, project_id: str, event: dict, version: int):
+        """publish_event para los endpoints síncronos (``def``), que FastAPI corre en su
+        pool de hilos sin event loop: el evento se agrega desde el loop del worker"""
+        loop = self._loop
+        if loop is None or loop.is_closed():
+            return
+        loop.call_soon_threadsafe(self.publish_event, project_id, event, version)
+
+    def _schedule_flush(self, project_id: str):
+        task = asyncio.create_task(self._flush(project_id))
+        self._flushes.add(task)
+        task.add_done_callback(self._flushes.discard)
+
+    async def _flush(self, project_id: str):
+        batch = self._batches.pop(project_id, None)
+        if batch is None or not (batch.events or batch.versions):
+            return
+        try:
+            await self.broadcast(batch.message(), project_id)
+        except Exception as e:
+            print(f"⚠️ Error enviando eventos de WebSocket (proyecto {project_id}): {e}")
+
+    def _deliver(self, project_id: str, text: str):
+        """Encola para cada conexión local del proyecto (no bloquea)"""
+        connections = self.active_connections.get(project_id)
+        if not connections:
+            return
+        for connection in list(connections):
+            connection.offer(text)
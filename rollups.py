@@ -0,0 +1,98 @@
+# ===================== CONSULTAS AGREGADAS =====================
+# Cálculos de resumen que antes se hacían con una consulta por etapa/proyecto
+# y ahora se resuelven con un único GROUP BY.
+from typing import Dict, Iterable, List, Optional
+from sqlalchemy import func, case, distinct
+from sqlalchemy.orm import Session
+from models import Task, Stage, SupComprasGrupo, SupComprasItem, SupServiciosGrupo, SupServiciosItem
+
+
+def get_stage_rollups(db: Session, project_id: int, stage_ids: Optional[Iterable[int]] = None) -> Dict[int, dict]:
+    """Cantidad de tareas y progreso promedio por etapa de un proyecto.
+
+    Una sola consulta ``GROUP BY stage_id``. Las tareas en reinicio (y las sin estado) no cuentan.
+    Devuelve ``{stage_id: {"count": n, "avg_progress": x}}``; las etapas sin
+    tareas no aparecen (usar :func:`stage_progress` para leer con valor por defecto).
+    """
+    query = (
+        db.query(
+            Task.stage_id,
+            func.count(Task.id),
+            func.avg(func.coalesce(Task.progress, 0)),
+        )
+        .join(Stage, Stage.id == Task.stage_id)
+        .filter(
+            Stage.project_id == project_id,
+            Task.status != "restart",  # como antes: las tareas sin estado tampoco cuentan (NULL != x)
+        )
+    )
+    if stage_ids is not None:
+        query = query.filter(Task.stage_id.in_(list(stage_ids)))
+
+    return {
+        stage_id: {"count": count, "avg_progress": float(avg or 0)}
+        for stage_id, count, avg in query.group_by(Task.stage_id).all()
+    }
+
+
+def stage_progress(rollups: Dict[int, dict], stage_id: int) -> float:
+    """Progreso promedio de una etapa a partir del resultado de get_stage_rollups (0 si no tiene tareas)"""
+    rollup = rollups.get(stage_id)
+    return rollup["avg_progress"] if rollup else 0.0
+
+
+def count_if(condition):
+    """COUNT de las filas que cumplen la condición (0 si no hay filas)"""
+    return func.coalesce(func.sum(case((condition, 1), else_=0)), 0)
+
+
+def get_supervision_rollups(db: Session, project_ids: List[int]) -> Dict[int, dict]:
+    """Resumen de supervisión (compras + servicios) por proyecto.
+
+    Una consulta agrupada por tipo: grupos LEFT JOIN ítems ``GROUP BY project_id``.
+    Devuelve por proyecto: grupos de cada tipo, ítems, aprobados, pendientes,
+    suma del avance de checkboxes (para promediar) y la fecha límite más próxima.
+    Los proyectos sin grupos no aparecen.
+    """
+    if not project_ids:
+        return {}
+
+    sources = (
+        ("compras_grupos", SupComprasGrupo, SupComprasItem,
+         func.upper(SupComprasItem.status_compra) == "APROBADO",
+         func.upper(SupComprasItem.status_compra) == "PENDIENTE"),
+        ("servicios_grupos", SupServiciosGrupo, SupServiciosItem,
+         func.upper(SupServiciosItem.status) == "APROBADO",
+         func.upper(SupServiciosItem.status).in_(("PENDIENTE", "POR COTIZAR"))),
+    )
+
+    result: Dict[int, dict] = {}
+    for key, Grupo, Item, approved, pending in sources:
+        rows = (
+            db.query(
+                Grupo.project_id,
+                func.count(distinct(Grupo.id)),
+                func.count(Item.id),
+                count_if(approved),
+                count_if(pending),
+                func.coalesce(func.sum(Item.avance), 0),
+                func.min(func.nullif(Item.fecha_limite, "")),
+            )
+            .outerjoin(Item, Item.grupo_id == Grupo.id)
+            .filter(Grupo.project_id.in_(project_ids))
+            .group_by(Grupo.project_id)
+            .all()
+        )
+        for project_id, grupos, items, aprobados, pendientes, avance_sum, fecha in rows:
+            entry = result.setdefault(project_id, {
+                "compras_grupos": 0, "servicios_grupos": 0, "total_items": 0,
+                "aprobados": 0, "pendientes": 0, "avance_sum": 0.0, "fecha_proxima": None,
+            })
+            entry[key] = grupos
+            entry["total_items"] += items
+            entry["aprobados"] += int(aprobados)
+            entry["pendientes"] += int(pendientes)
+            entry["avance_sum"] += float(avance_sum)
+            if fecha and (entry["fecha_proxima"] is None or fecha < entry["fecha_proxima"]):
+                entry["fecha_proxima"] = fecha
+    return result
@@ -1,5 +1,5 @@
 from pydantic import BaseModel, EmailStr, model_validator
-from typing import Optional, List, Any
+from typing import Optional, List, Any, Literal
 from datetime import datetime
 
 # ===================== USER SCHEMAS =====================
@@ -305,6 +305,17 @@ class MilestoneResponse(BaseModel):
 
     class Config:
         from_attributes = True
+
+# ===================== WEBSOCKET SCHEMAS =====================
+class WSAuthMessage(BaseModel):
+    """Primer mensaje del cliente: el JWT (no va en la URL para que no quede en los logs de acceso)"""
+    type: Literal["auth"]
+    token: str
+
+class WSClientMessage(BaseModel):
+    """Mensajes que un cliente puede mandar por el WebSocket (los eventos los genera el servidor)"""
+    type: Literal["ping", "pong"]
+
 # ===================== SUPERVISIÓN SCHEMAS =====================
 
 class SupResumenItemBase(BaseModel):
@@ -0,0 +1,224 @@
+# ===================== HISTÓRICO DE EFECTIVIDAD =====================
+# Materializa una fila diaria por proyecto y por etapa en effectiveness_snapshots
+# usando el motor de efectividad, para que las tendencias se lean con un
+# rango de fechas en lugar de recalcular todo el historial.
+#
+# Uso por consola:
+#   python snapshots.py hoy                                  -> foto del día
+#   python snapshots.py backfill [--desde AAAA-MM-DD] [--hasta AAAA-MM-DD]
+import argparse
+import asyncio
+import bisect
+import os
+from datetime import date, datetime, timedelta
+from typing import Callable, Dict, List, Optional
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import Session
+from database import SessionLocal, engine
+from models import Project, Task, Stage, TaskProgress, EffectivenessSnapshot
+from effectiveness import TASK_COLUMNS, STAGE_COLUMNS, compute_effectiveness, load_effectiveness
+from versions import prune_change_log
+
+# Hora local (0-23) a la que corre la foto diaria; SNAPSHOT_JOB_ENABLED=0 la desactiva
+SNAPSHOT_HOUR = int(os.getenv("SNAPSHOT_HOUR", "23"))
+SNAPSHOT_JOB_ENABLED = os.getenv("SNAPSHOT_JOB_ENABLED", "1") != "0"
+
+INSERT_CHUNK = 1000
+
+
+def _snapshot_rows(results: Dict[int, dict], snapshot_date: date) -> List[dict]:
+    """Convierte el resultado del motor en filas para effectiveness_snapshots"""
+    rows = []
+    for project_id, result in results.items():
+        metrics = result["metrics"]
+        rows.append({
+            "snapshot_date": snapshot_date,
+            "project_id": project_id,
+            "stage_id": None,
+            "stage_key": 0,
+            "scheduled_progress": metrics["scheduled_progress"],
+            "actual_progress": metrics["actual_progress"],
+            "effectiveness": metrics["effectiveness"],
+            "status": metrics["status"],
+            "total_tasks": result["total_tasks"],
+            "completed_tasks": result["completed_tasks"],
+        })
+        for stage in result["stages"]:
+            scheduled = stage["scheduled_progress"]
+            actual = stage["actual_progress"]
+            rows.append({
+                "snapshot_date": snapshot_date,
+                "project_id": project_id,
+                "stage_id": stage["id"],
+                "stage_key": stage["id"],
+                "scheduled_progress": scheduled,
+                "actual_progress": actual,
+                "effectiveness": round(actual / scheduled * 100, 1) if scheduled > 0 else 0.0,
+                "status": None,
+                "total_tasks": 0,
+                "completed_tasks": 0,
+            })
+    return rows
+
+
+def _replace_snapshots(db: Session, start: date, end: date, rows: List[dict]):
+    """Reemplaza las fotos del rango [start, end] (idempotente: borrar + insertar).
+    Si otro worker escribe las mismas fechas a la vez, la clave única
+    uq_effectiveness_snapshots_day hace fallar a uno de los dos con IntegrityError."""
+    db.query(EffectivenessSnapshot).filter(
+        EffectivenessSnapshot.snapshot_date >= start,
+        EffectivenessSnapshot.snapshot_date <= end
+    ).delete(synchronize_session=False)
+    for i in range(0, len(rows), INSERT_CHUNK):
+        db.bulk_insert_mappings(EffectivenessSnapshot, rows[i:i + INSERT_CHUNK])
+    db.commit()
+
+
+def take_snapshot(db: Session, snapshot_date: Optional[date] = None) -> int:
+    """Guarda la foto de efectividad de todos los proyectos para una fecha. Devuelve filas escritas."""
+    snapshot_date = snapshot_date or date.today()
+    project_ids = [pid for (pid,) in db.query(Project.id).all()]
+    rows = _snapshot_rows(load_effectiveness(db, project_ids, today=snapshot_date), snapshot_date)
+    _replace_snapshots(db, snapshot_date, snapshot_date, rows)
+    return len(rows)
+
+
+def backfill(db: Session, start: Optional[date] = None, end: Optional[date] = None) -> int:
+    """Reconstruye el histórico a partir de los registros de TaskProgress.
+
+    Carga tareas, etapas y avances en tres consultas y reproduce día a día el
+    progreso que tenía cada tarea (último avance registrado hasta ese día).
+    Solo cuentan las tareas y etapas que ya existían en cada fecha. El estado
+    histórico de la tarea no se guarda, así que se deduce del progreso.
+    """
+    end = end or date.today() - timedelta(days=1)
+    task_rows = db.query(*TASK_COLUMNS, Task.created_at).order_by(Task.id).all()
+    stage_rows = db.query(*STAGE_COLUMNS, Stage.created_at).all()
+    progress_rows = db.query(
+        TaskProgress.task_id, TaskProgress.created_at, TaskProgress.previous_progress, TaskProgress.new_progress
+    ).order_by(TaskProgress.task_id, TaskProgress.created_at, TaskProgress.id).all()
+
+    if start is None:
+        dates = [r.created_at for r in progress_rows if r.created_at]
+        if not dates:
+            return 0
+        start = min(dates).date()
+    if start > end:
+        return 0
+
+    # Avances por tarea: fechas (ordenadas) y progreso resultante de cada registro
+    history: Dict[int, dict] = {}
+    for task_id, created_at, previous, new in progress_rows:
+        if created_at is None:
+            continue
+        h = history.setdefault(task_id, {"days": [], "values": [], "initial": float(previous or 0)})
+        h["days"].append(created_at.date())
+        h["values"].append(float(new or 0))
+
+    def progress_at(task_id: int, current: float, day: date) -> float:
+        h = history.get(task_id)
+        if h is None:
+            return current
+        i = bisect.bisect_right(h["days"], day)
+        return h["values"][i - 1] if i else h["initial"]
+
+    rows = []
+    day = start
+    while day <= end:
+        tasks_day = []
+        for r in task_rows:
+            if r.created_at and r.created_at.date() > day:
+                continue
+            progress = progress_at(r.id, float(r.progress or 0), day)
+            if r.status == "restart":
+                status = "restart"
+            else:
+                status = "done" if progress >= 100 else ("in_progress" if progress > 0 else "todo")
+            tasks_day.append((r.id, r.project_id, r.stage_id, r.title, status, progress, r.start_date, r.due_date))
+        stages_day = [tuple(r)[:len(STAGE_COLUMNS)] for r in stage_rows if not (r.created_at and r.created_at.date() > day)]
+        rows.extend(_snapshot_rows(compute_effectiveness(tasks_day, stages_day, today=day), day))
+        day += timedelta(days=1)
+
+    _replace_snapshots(db, start, end, rows)
+    return len(rows)
+
+
+def _seconds_until_next_run(now: datetime) -> float:
+    target = now.replace(hour=SNAPSHOT_HOUR, minute=0, second=0, microsecond=0)
+    if target <= now:
+        target += timedelta(days=1)
+    return (target - now).total_seconds()
+
+
+def _has_snapshot(db: Session, snapshot_date: date) -> bool:
+    return db.query(EffectivenessSnapshot.id).filter(EffectivenessSnapshot.snapshot_date == snapshot_date).first() is not None
+
+
+def _daily_snapshot(db: Session):
+    written = take_snapshot(db)
+    print(f"✅ Foto de efectividad guardada ({written} filas)")
+    # Mantenimiento diario: depurar el registro de cambios (/changes)
+    prune_change_log(db)
+
+
+def _catch_up(db: Session, now: Optional[datetime] = None):
+    """Al arrancar: completa las fotos que se perdieron con el servidor caído.
+    La de ayer se reconstruye desde TaskProgress; la de hoy se toma si ya pasó SNAPSHOT_HOUR."""
+    now = now or datetime.now()
+    today = now.date()
+    if db.query(Project.id).first() is None:
+        return
+    yesterday = today - timedelta(days=1)
+    if not _has_snapshot(db, yesterday):
+        written = backfill(db, yesterday, yesterday)
+        print(f"✅ Foto de efectividad de {yesterday} recuperada ({written} filas)")
+    if now.hour >= SNAPSHOT_HOUR and not _has_snapshot(db, today):
+        _daily_snapshot(db)
+
+
+def _run_snapshot_job(job: Callable[[Session], None]):
+    db = SessionLocal()
+    try:
+        job(db)
+    except IntegrityError:
+        db.rollback()
+        print("ℹ️ Otro worker ya guardó la foto de efectividad")
+    except Exception as e:
+        db.rollback()
+        print(f"⚠️ Error guardando foto de efectividad: {e}")
+    finally:
+        db.close()
+
+
+async def snapshot_loop():
+    """Tarea de fondo: al arrancar recupera las fotos que falten y luego guarda
+    la del día a la hora SNAPSHOT_HOUR. Corre en todos los workers; la clave
+    única por fecha, proyecto y etapa deja una sola foto por día."""
+    await asyncio.to_thread(_run_snapshot_job, _catch_up)
+    while True:
+        await asyncio.sleep(_seconds_until_next_run(datetime.now()))
+        await asyncio.to_thread(_run_snapshot_job, _daily_snapshot)
+
+
+def _parse_date(value: str) -> date:
+    return datetime.strptime(value, "%Y-%m-%d").date()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Histórico de efectividad")
+    sub = parser.add_subparsers(dest="command", required=True)
+    sub.add_parser("hoy", help="Guardar la foto de efectividad de hoy")
+    bf = sub.add_parser("backfill", help="Reconstruir el histórico desde TaskProgress")
+    bf.add_argument("--desde", type=_parse_date, default=None)
+    bf.add_argument("--hasta", type=_parse_date, default=None)
+    args = parser.parse_args()
+
+    EffectivenessSnapshot.__table__.create(bind=engine, checkfirst=True)
+    session = SessionLocal()
+    try:
+        if args.command == "hoy":
+            print(f"✅ {take_snapshot(session)} filas guardadas")
+        else:
+            print(f"✅ {backfill(session, args.desde, args.hasta)} filas reconstruidas")
+    finally:
+        session.close()
@@ -7,9 +7,11 @@ let users = [];
 let stages = [];  // Etapas del proyecto actual
 let milestones = [];  // Hitos del proyecto actual
 let ws = null;
+let projectVersion = null;  // data_version del proyecto actual (para /changes al reconectar)
 let draggedTask = null;
 let myTasksCache = [];
 let myTasksLoadedAt = 0;
+let teamSummaryPreload = null;  // Resumen de equipo recibido en /api/bootstrap
 const MY_TASKS_CACHE_TTL_MS = 60000;
 
 const API_BASE = '';
@@ -77,10 +79,11 @@ function clearStoredUser() {
 }
 
 async function apiRequest(endpoint, options = {}) {
+    const { onResponse, ...fetchOptions } = options;
     const token = getToken();
     const headers = {
         'Content-Type': 'application/json',
-        ...options.headers
+        ...fetchOptions.headers
     };
     
     if (token) {
@@ -88,9 +91,10 @@ async function apiRequest(endpoint, options = {}) {
     }
     
     const response = await fetch(`${API_BASE}${endpoint}`, {
-        ...options,
+        ...fetchOptions,
         headers
     });
+    if (onResponse) onResponse(response);
     
     if (response.status === 401) {
         clearToken();
@@ -107,6 +111,17 @@ async function apiRequest(endpoint, options = {}) {
     return response.json();
 }
 
+// GET paginado: registros de la página y cursor de la siguiente (cabecera X-Next-Cursor, null si no hay más)
+async function apiRequestPage(endpoint, cursor = null) {
+    let nextCursor = null;
+    const separator = endpoint.includes('?') ? '&' : '?';
+    const url = cursor ? `${endpoint}${separator}before=${encodeURIComponent(cursor)}` : endpoint;
+    const items = await apiRequest(url, {
+        onResponse: response => { nextCursor = response.headers.get('X-Next-Cursor'); }
+    });
+    return { items, nextCursor };
+}
+
 function showToast(message, type = 'info') {
     const container = document.getElementById('toast-container');
     const icons = {
@@ -238,18 +253,28 @@ document.getElementById('logout-btn').addEventListener('click', () => {
 });
 
 // ===================== INIT =====================
-async function initApp() {
+async function initApp(bootstrap = null) {
     showMainApp();
     updateUserInfo();
     setupAdminUI();
     initSidebarToggle();
     
     try {
-        await Promise.all([
-            loadProjects(),
-            loadUsers(),
-            loadDashboard()
-        ]);
+        // Una sola petición con todo lo necesario para la primera pantalla
+        const data = bootstrap || await apiRequest('/api/bootstrap');
+        currentUser = data.me;
+        setStoredUser(currentUser);
+        updateUserInfo();
+        setupAdminUI();
+        
+        projects = data.projects;
+        renderProjectList();
+        updateProjectSelects();
+        users = data.users;
+        renderStats(data.dashboard);
+        renderActivities(data.activities);
+        renderEffectivenessProjectSelect();
+        teamSummaryPreload = data.team_summary;
         
         // Si es admin, cargar usuarios pendientes
         if (currentUser && currentUser.is_admin) {
@@ -495,9 +520,11 @@ async function selectProject(projectId) {
         document.getElementById(id).value = projectId;
     });
     
-    // Cargar etapas del proyecto
+    // Etapas, tareas e hitos del proyecto en una sola petición
+    const snapshot = currentProject ? await loadProjectSnapshot(projectId) : null;
+    projectVersion = snapshot ? snapshot.version : null;
     if (currentProject) {
-        stages = await loadProjectStages(projectId);
+        stages = snapshot ? snapshot.stages : await loadProjectStages(projectId);
         updateStageSelect();
     } else {
         stages = [];
@@ -506,10 +533,26 @@ async function selectProject(projectId) {
     // Actualizar botón de reporte de proyecto
     updateProjectReportButton();
     
-    await loadTasks();
+    if (snapshot) {
+        tasks = snapshot.tasks;
+        milestones = snapshot.milestones;
+        renderKanban();
+        renderGantt();
+    } else {
+        await loadTasks();
+    }
     connectWebSocket();
 }
 
+async function loadProjectSnapshot(projectId) {
+    try {
+        return await apiRequest(`/api/projects/${projectId}/snapshot`);
+    } catch (error) {
+        console.error('Error loading project snapshot:', error);
+        return null;
+    }
+}
+
 function updateStageSelect() {
     const select = document.getElementById('task-stage');
     if (!select) return;
@@ -1721,6 +1764,10 @@ document.getElementById('view-history-btn').addEventListener('click', async () =
     openHistoryModal(taskId);
 });
 
+// Historial de cambios paginado: primera página y "Cargar más" con el cursor
+let taskHistoryEntries = [];
+let taskHistoryCursor = null;
+
 async function openHistoryModal(taskId) {
     const modal = document.getElementById('history-modal');
     const container = document.getElementById('history-container');
@@ -1737,9 +1784,11 @@ async function openHistoryModal(taskId) {
     modal.classList.add('active');
     
     try {
-        const history = await apiRequest(`/api/tasks/${taskId}/history`);
+        const page = await apiRequestPage(`/api/tasks/${taskId}/history`);
+        taskHistoryEntries = page.items;
+        taskHistoryCursor = page.nextCursor;
         
-        if (history.length === 0) {
+        if (taskHistoryEntries.length === 0) {
             container.innerHTML = `
                 <div class="history-empty">
                     <i class="fas fa-clipboard-list"></i>
@@ -1750,47 +1799,7 @@ async function openHistoryModal(taskId) {
             return;
         }
         
-        // Agrupar por fecha
-        const groupedHistory = {};
-        history.forEach(entry => {
-            const date = new Date(entry.created_at);
-            const dateKey = date.toLocaleDateString('es-ES', { weekday: 'long', year: 'numeric', month: 'long', day: 'numeric' });
-            if (!groupedHistory[dateKey]) {
-                groupedHistory[dateKey] = [];
-            }
-            groupedHistory[dateKey].push(entry);
-        });
-        
-        container.innerHTML = Object.entries(groupedHistory).map(([date, entries]) => `
-            <div class="history-date-group">
-                <div class="history-date">${date}</div>
-                ${entries.map(entry => {
-                    const time = new Date(entry.created_at).toLocaleTimeString('es-ES', { hour: '2-digit', minute: '2-digit' });
-                    return `
-                        <div class="history-entry">
-                            <div class="history-user">
-                                <div class="history-avatar" style="background: ${entry.user_avatar_color || '#6366f1'}">
-                                    ${entry.user_name.charAt(0).toUpperCase()}
-                                </div>
-                                <div class="history-user-info">
-                                    <span class="history-user-name">${entry.user_name}</span>
-                                    <span class="history-time">${time}</span>
-                                </div>
-                            </div>
-                            <div class="history-change">
-                                <span class="history-field">${entry.field_name}</span>
-                                <div class="history-values">
-                                    ${entry.old_value ? `<span class="history-old">${entry.old_value}</span>` : '<span class="history-old empty">Sin valor</span>'}
-                                    <i class="fas fa-arrow-right"></i>
-                                    <span class="history-new">${entry.new_value || 'Sin valor'}</span>
-                                </div>
-                            </div>
-                        </div>
-                    `;
-                }).join('')}
-            </div>
-        `).join('');
-        
+        renderTaskHistory(taskId);
     } catch (error) {
         container.innerHTML = `
             <div class="history-error">
@@ -1802,6 +1811,66 @@ async function openHistoryModal(taskId) {
     }
 }
 
+async function loadMoreTaskHistory(taskId) {
+    try {
+        const page = await apiRequestPage(`/api/tasks/${taskId}/history`, taskHistoryCursor);
+        taskHistoryEntries = taskHistoryEntries.concat(page.items);
+        taskHistoryCursor = page.nextCursor;
+        renderTaskHistory(taskId);
+    } catch (error) {
+        showToast('Error cargando historial: ' + (error.message || 'Error desconocido'), 'error');
+    }
+}
+
+function renderTaskHistory(taskId) {
+    const container = document.getElementById('history-container');
+    
+    // Agrupar por fecha
+    const groupedHistory = {};
+    taskHistoryEntries.forEach(entry => {
+        const date = new Date(entry.created_at);
+        const dateKey = date.toLocaleDateString('es-ES', { weekday: 'long', year: 'numeric', month: 'long', day: 'numeric' });
+        if (!groupedHistory[dateKey]) {
+            groupedHistory[dateKey] = [];
+        }
+        groupedHistory[dateKey].push(entry);
+    });
+    
+    container.innerHTML = Object.entries(groupedHistory).map(([date, entries]) => `
+        <div class="history-date-group">
+            <div class="history-date">${date}</div>
+            ${entries.map(entry => {
+                const time = new Date(entry.created_at).toLocaleTimeString('es-ES', { hour: '2-digit', minute: '2-digit' });
+                return `
+                    <div class="history-entry">
+                        <div class="history-user">
+                            <div class="history-avatar" style="background: ${entry.user_avatar_color || '#6366f1'}">
+                                ${entry.user_name.charAt(0).toUpperCase()}
+                            </div>
+                            <div class="history-user-info">
+                                <span class="history-user-name">${entry.user_name}</span>
+                                <span class="history-time">${time}</span>
+                            </div>
+                        </div>
+                        <div class="history-change">
+                            <span class="history-field">${entry.field_name}</span>
+                            <div class="history-values">
+                                ${entry.old_value ? `<span class="history-old">${entry.old_value}</span>` : '<span class="history-old empty">Sin valor</span>'}
+                                <i class="fas fa-arrow-right"></i>
+                                <span class="history-new">${entry.new_value || 'Sin valor'}</span>
+                            </div>
+                        </div>
+                    </div>
+                `;
+            }).join('')}
+        </div>
+    `).join('') + (taskHistoryCursor ? `
+        <button class="btn btn-sm btn-secondary history-load-more" onclick="loadMoreTaskHistory(${taskId})">
+            <i class="fas fa-chevron-down"></i> Cargar más
+        </button>
+    ` : '');
+}
+
 // Botón "Volver a Tarea" del historial de cambios
 document.getElementById('history-back-btn')?.addEventListener('click', () => {
     closeModal('history-modal');
@@ -2753,7 +2822,12 @@ async function loadTeam() {
     // Una sola petición al backend con todo el resumen
     let teamData;
     try {
-        teamData = await apiRequest(`/api/team-summary?include_inactive=${showInactiveTeam}`);
+        if (teamSummaryPreload && !showInactiveTeam) {
+            teamData = teamSummaryPreload;
+        } else {
+            teamData = await apiRequest(`/api/team-summary?include_inactive=${showInactiveTeam}`);
+        }
+        teamSummaryPreload = null;
     } catch (e) {
         console.error('Error loading team summary:', e);
         grid.innerHTML = '<p style="color:var(--text-muted);text-align:center">Error al cargar equipo</p>';
@@ -3019,7 +3093,7 @@ async function loadProjectsView() {
 }
 
 // ===================== WEBSOCKET =====================
-function connectWebSocket() {
+function connectWebSocket(isReconnect = false) {
     if (!currentProject) return;
     
     if (ws) ws.close();
@@ -3028,32 +3102,133 @@ function connectWebSocket() {
     ws = new WebSocket(`${protocol}//${window.location.host}/ws/${currentProject.id}`);
     
     ws.onopen = () => {
+        // El token va en el primer mensaje (en la URL quedaría en los logs de acceso)
+        ws.send(JSON.stringify({ type: 'auth', token: getToken() || '' }));
         document.getElementById('connection-status').classList.remove('disconnected');
         document.getElementById('connection-status').innerHTML = '<i class="fas fa-wifi"></i><span>Conectado</span>';
+        // Ponerse al día con lo que cambió mientras estuvo desconectado
+        if (isReconnect) syncProjectChanges();
     };
     
-    ws.onclose = () => {
+    ws.onclose = (event) => {
         document.getElementById('connection-status').classList.add('disconnected');
         document.getElementById('connection-status').innerHTML = '<i class="fas fa-wifi"></i><span>Desconectado</span>';
         
-        // Reconnect after 3 seconds
+        // Sin token válido (4401) o sin acceso al proyecto (4403): no reintentar
+        if (event.code === 4401 || event.code === 4403) return;
+        
+        // Reconnect after 3 seconds (30 si el servidor rechazó por límite de conexiones)
         setTimeout(() => {
-            if (currentProject) connectWebSocket();
-        }, 3000);
+            if (currentProject) connectWebSocket(true);
+        }, event.code === 1008 ? 30000 : 3000);
     };
     
     ws.onmessage = (event) => {
         const data = JSON.parse(event.data);
         
         switch (data.type) {
+            case 'ping':
+                // Heartbeat del servidor: sin respuesta la conexión se cierra por inactiva
+                ws.send(JSON.stringify({ type: 'pong' }));
+                break;
+            case 'batch':
+                applyEventBatch(data);
+                break;
+            case 'resync':
+                // El servidor descartó mensajes (cola llena): pedir lo que cambió
+                syncProjectChanges();
+                break;
+        }
+    };
+}
+
+// Trae solo las tareas, etapas e hitos que cambiaron desde projectVersion
+async function syncProjectChanges() {
+    if (!currentProject || projectVersion === null) return;
+    const projectId = currentProject.id;
+    let changes;
+    try {
+        changes = await apiRequest(`/api/projects/${projectId}/changes?since=${projectVersion}`);
+    } catch (error) {
+        console.error('Error sincronizando cambios:', error);
+        return;
+    }
+    if (!currentProject || currentProject.id !== projectId) return;
+    
+    if (changes.full_reload) {
+        const snapshot = await loadProjectSnapshot(projectId);
+        if (!snapshot) return;
+        stages = snapshot.stages;
+        tasks = snapshot.tasks;
+        milestones = snapshot.milestones;
+        projectVersion = snapshot.version;
+        updateStageSelect();
+    } else {
+        const deleted = new Set(changes.deleted.map(d => `${d.type}:${d.id}`));
+        tasks = mergeById(tasks, changes.tasks, 'task', deleted).sort((a, b) => (a.position || 0) - (b.position || 0));
+        milestones = mergeById(milestones, changes.milestones, 'milestone', deleted);
+        if (changes.stages) {
+            stages = changes.stages;
+            updateStageSelect();
+        }
+        projectVersion = changes.version;
+    }
+    renderKanban();
+    renderGantt();
+}
+
+// Lote de eventos del servidor: tareas nuevas completas, actualizaciones con
+// solo los campos que cambiaron y borrados. Si las versiones del lote siguen a
+// projectVersion no falta nada; si no, se pide /changes para cubrir el hueco.
+// Los eventos sup_* (resumen, grupos e ítems de supervisión) recargan la vista
+// de supervisión si está abierta en este proyecto.
+function applyEventBatch(batch) {
+    const current = new Map(tasks.map(task => [task.id, task]));
+    const updates = [];
+    const deleted = new Set();
+    let missing = false;
+    let supChanged = false;
+    batch.events.forEach(event => {
+        switch (event.type) {
             case 'task_created':
+                updates.push(event.task);
+                break;
             case 'task_updated':
+                if (current.has(event.task_id)) {
+                    updates.push({ ...current.get(event.task_id), ...event.changes });
+                } else {
+                    missing = true;
+                }
+                break;
             case 'task_deleted':
-                loadTasks();
-                loadDashboard();
+                deleted.add(`task:${event.task_id}`);
                 break;
+            default:
+                if (event.type.startsWith('sup_')) supChanged = true;
         }
-    };
+    });
+    tasks = mergeById(tasks, updates, 'task', deleted).sort((a, b) => (a.position || 0) - (b.position || 0));
+    renderKanban();
+    renderGantt();
+    loadDashboard();
+    if (supChanged && currentProject && supCurrentProject === currentProject.id &&
+        document.getElementById('supervision-view').classList.contains('active')) {
+        supLoadProject(supCurrentProject);
+    }
+    
+    const contiguous = projectVersion !== null && batch.versions.length > 0 &&
+        batch.versions.every((version, i) => version === projectVersion + 1 + i);
+    if (contiguous && !missing) {
+        projectVersion = batch.version;
+    } else if (missing || batch.version === null || batch.version > projectVersion) {
+        syncProjectChanges();
+    }
+}
+
+function mergeById(list, updates, type, deleted) {
+    const byId = new Map(list.filter(item => !deleted.has(`${type}:${item.id}`)).map(item => [item.id, item]));
+    updates.forEach(item => byId.set(item.id, item));
+    return [...byId.values()];
 }
 
 // ===================== MODALS =====================
@@ -3439,6 +3614,10 @@ async function submitProgress() {
     }
 }
 
+// Historial de avances paginado (igual que el de cambios)
+let progressHistoryEntries = [];
+let progressHistoryCursor = null;
+
 async function openProgressHistory() {
     if (!currentProgressTaskId) {
         showToast('No se pudo identificar la tarea', 'warning');
@@ -3447,9 +3626,11 @@ async function openProgressHistory() {
     
     try {
         console.log('Cargando historial de progreso para tarea:', currentProgressTaskId);
-        const history = await apiRequest(`/api/tasks/${currentProgressTaskId}/progress`);
-        console.log('Historial recibido:', history.length, 'registros');
-        renderProgressHistory(history);
+        const page = await apiRequestPage(`/api/tasks/${currentProgressTaskId}/progress`);
+        progressHistoryEntries = page.items;
+        progressHistoryCursor = page.nextCursor;
+        console.log('Historial recibido:', progressHistoryEntries.length, 'registros');
+        renderProgressHistory(progressHistoryEntries);
         closeModal('progress-modal');
         openModal('progress-history-modal');
     } catch (error) {
@@ -3458,6 +3639,17 @@ async function openProgressHistory() {
     }
 }
 
+async function loadMoreProgressHistory() {
+    try {
+        const page = await apiRequestPage(`/api/tasks/${currentProgressTaskId}/progress`, progressHistoryCursor);
+        progressHistoryEntries = progressHistoryEntries.concat(page.items);
+        progressHistoryCursor = page.nextCursor;
+        renderProgressHistory(progressHistoryEntries);
+    } catch (error) {
+        showToast('Error cargando historial: ' + (error.message || 'Error desconocido'), 'error');
+    }
+}
+
 function renderProgressHistory(history) {
     const container = document.getElementById('progress-history-content');
     
@@ -3491,7 +3683,11 @@ function renderProgressHistory(history) {
                 ${item.comment ? `<div class="history-comment">"${item.comment}"</div>` : ''}
             </div>
         </div>
-    `).join('');
+    `).join('') + (progressHistoryCursor ? `
+        <button class="btn btn-sm btn-secondary history-load-more" onclick="loadMoreProgressHistory()">
+            <i class="fas fa-chevron-down"></i> Cargar más
+        </button>
+    ` : '');
 }
 
 function getRandomColor(name) {
@@ -4501,7 +4697,7 @@ async function openApplySupTemplateModal(preSelectId = null) {
     // Poblar selector de proyectos
     const sel = document.getElementById('apply-sup-project');
     try {
-        const projs = await apiRequest('/api/projects');
+        const projs = await apiRequest('/api/projects?fields=id,name,color,is_active');
         sel.innerHTML = '<option value="">Seleccionar proyecto…</option>' +
             projs.map(p => `<option value="${p.id}">${escapeHtml(p.name)}</option>`).join('');
         // Pre-seleccionar proyecto actual de supervisión
@@ -4606,7 +4802,7 @@ async function loadReportsPanel() {
     const selUser = document.getElementById('report-user-filter');
     try {
         if (sel) {
-            const projs = await apiRequest('/api/projects');
+            const projs = await apiRequest('/api/projects?fields=id,name,color,is_active');
             sel.innerHTML = '<option value="">Todas las obras</option>' +
                 projs.map(p => `<option value="${p.id}">${escapeHtml(p.name)}</option>`).join('');
         }
@@ -4672,9 +4868,11 @@ document.addEventListener('DOMContentLoaded', async () => {
             setupAdminUI();
         }
         try {
-            currentUser = await apiRequest('/api/auth/me');
+            // /api/bootstrap valida la sesión y trae los datos iniciales en una sola petición
+            const bootstrap = await apiRequest('/api/bootstrap');
+            currentUser = bootstrap.me;
             setStoredUser(currentUser);
-            initApp();
+            initApp(bootstrap);
         } catch (error) {
             if (error.message === 'No autorizado') {
                 showAuthScreen();
@@ -5122,7 +5320,7 @@ async function supLoadProject(projectId) {
 async function renderSupervisionView() {
   // Populate project selector
   try {
-    const projectsList = await apiRequest('/api/projects');
+    const projectsList = await apiRequest('/api/projects?fields=id,name,color,is_active');
     const select = document.getElementById('sup-project-select');
     select.innerHTML = '<option value="">Todas las obras</option>' +
       projectsList.map(p => `<option value="${p.id}">${p.name}</option>`).join('');
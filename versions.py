@@ -0,0 +1,216 @@
+# ===================== VERSIÓN DE DATOS POR PROYECTO =====================
+# Cada proyecto tiene un contador data_version que se incrementa con cualquier
+# escritura sobre el proyecto o sus datos (tareas, etapas, hitos, supervisión).
+# Los GET derivan su ETag de ese número y responden 304 sin consultar nada más
+# cuando el cliente ya tiene la versión actual.
+#
+# Además, cada incremento deja en change_log qué entidades cambiaron en esa
+# versión (ver /api/projects/{id}/changes). Los cambios se recogen solos al
+# hacer flush de la sesión; las actualizaciones masivas (query.update) hay que
+# anotarlas con note_change. El incremento y el change_log se escriben justo
+# antes del commit, en la misma transacción que los datos.
+import hashlib
+import os
+from datetime import datetime, timedelta
+from typing import Dict, Iterable, List, Optional
+from fastapi import Request
+from sqlalchemy import event, func, inspect
+from sqlalchemy.orm import Session
+from models import (
+    User, Project, ProjectMember, Task, Stage, Milestone, MilestoneAttachment, SupResumenItem,
+    SupComprasGrupo, SupComprasItem, SupServiciosGrupo, SupServiciosItem, ChangeLog
+)
+
+CHANGE_LOG_RETENTION_DAYS = int(os.getenv("CHANGE_LOG_RETENTION_DAYS", "30"))
+FLOOR = "floor"
+
+# Entidades registradas: modelo -> (tipo, columna con el proyecto o None si se deduce de sus grupos)
+TRACKED_ENTITIES = {
+    Task: ("task", "project_id"),
+    Stage: ("stage", "project_id"),
+    Milestone: ("milestone", "project_id"),
+    SupResumenItem: ("sup_resumen", "project_id"),
+    SupComprasGrupo: ("sup_compras_grupo", "project_id"),
+    SupServiciosGrupo: ("sup_servicios_grupo", "project_id"),
+    SupComprasItem: ("sup_compras_item", None),
+    SupServiciosItem: ("sup_servicios_item", None),
+}
+# Ítems de supervisión: el proyecto sale del grupo principal y de los adicionales
+SUP_ITEM_GRUPOS = {SupComprasItem: SupComprasGrupo, SupServiciosItem: SupServiciosGrupo}
+# Cambios que solo incrementan la versión (no tienen tipo en change_log): modelo -> columna con el proyecto
+VERSIONED_ONLY = {Project: "id", ProjectMember: "project_id"}
+# Campos de usuario que aparecen en las respuestas de cualquier proyecto
+USER_FIELDS = ("name", "email", "avatar_color")
+
+
+def note_change(db: Session, entity_type: str, entity_id: int, project_id: Optional[int] = None, action: str = "upsert"):
+    """Anota un cambio pendiente; se guarda en change_log con el próximo incremento de versión"""
+    pending = db.info.setdefault("pending_changes", {})
+    key = (entity_type, entity_id)
+    if pending.get(key, ("",))[0] != "delete":
+        pending[key] = (action, project_id)
+
+
+def _history_values(state, name: str) -> list:
+    """Valores actuales y anteriores de un atributo, sin cargarlo si no estaba cargado"""
+    history = state.attrs[name].history
+    return [*history.added, *history.unchanged, *history.deleted]
+
+
+def _sup_item_grupo_ids(state) -> set:
+    """Grupos (actuales y anteriores) de un ítem de supervisión"""
+    ids = {state.dict.get("grupo_id"), *_history_values(state, "grupo_id")}
+    ids.update(inspect(grupo).dict.get("id") for grupo in _history_values(state, "extra_grupos"))
+    ids.discard(None)
+    return ids
+
+
+@event.listens_for(Session, "after_flush")
+def _collect_changes(session: Session, flush_context):
+    for objects, action, only_modified in ((session.new, "upsert", False), (session.dirty, "upsert", True), (session.deleted, "delete", False)):
+        for obj in objects:
+            if only_modified and not session.is_modified(obj):
+                continue
+            state = inspect(obj)
+            values = state.dict  # sin cargar atributos expirados dentro del flush
+            if isinstance(obj, MilestoneAttachment):
+                # Los adjuntos viajan dentro del hito
+                if values.get("milestone_id"):
+                    note_change(session, "milestone", values["milestone_id"])
+                continue
+            if isinstance(obj, User):
+                if action == "delete" or (only_modified and any(state.attrs[f].history.has_changes() for f in USER_FIELDS)):
+                    session.info["pending_all_projects"] = True
+                continue
+            if type(obj) in VERSIONED_ONLY:
+                if values.get(VERSIONED_ONLY[type(obj)]) is not None:
+                    session.info.setdefault("pending_projects", set()).add(values[VERSIONED_ONLY[type(obj)]])
+                continue
+            tracked = TRACKED_ENTITIES.get(type(obj))
+            if tracked is None or values.get("id") is None:
+                continue
+            entity_type, project_column = tracked
+            if type(obj) in SUP_ITEM_GRUPOS:
+                session.info.setdefault("pending_grupos", {}).setdefault((entity_type, values["id"]), set()).update(
+                    _sup_item_grupo_ids(state))
+            note_change(session, entity_type, values["id"], values.get(project_column) if project_column else None, action)
+
+
+@event.listens_for(Session, "before_commit")
+def _write_versions(session: Session):
+    """Incrementa data_version de los proyectos tocados en esta transacción y
+    registra los cambios en change_log antes de confirmar, para que datos,
+    versión y registro queden en el mismo commit.
+    No modifica updated_at (la versión cambia aunque el proyecto en sí no)."""
+    session.flush()
+    pending = session.info.pop("pending_changes", {})
+    pending_grupos = session.info.pop("pending_grupos", {})
+    ids = session.info.pop("pending_projects", set())
+    if session.info.pop("pending_all_projects", False):
+        ids.update(pid for (pid,) in session.query(Project.id).all())
+    # Proyecto de cada cambio; los ítems de supervisión se resuelven por sus grupos
+    targets = {}
+    for key, (action, project_id) in pending.items():
+        targets[key] = {project_id} if project_id is not None else set()
+    for item_model, grupo_model in SUP_ITEM_GRUPOS.items():
+        entity_type = TRACKED_ENTITIES[item_model][0]
+        grupo_ids = set().union(*(g for (t, _), g in pending_grupos.items() if t == entity_type))
+        if not grupo_ids:
+            continue
+        grupo_projects = dict(session.query(grupo_model.id, grupo_model.project_id).filter(grupo_model.id.in_(grupo_ids)).all())
+        for (t, entity_id), grupos in pending_grupos.items():
+            if t == entity_type and (t, entity_id) in targets:
+                targets[(t, entity_id)].update(grupo_projects[g] for g in grupos if g in grupo_projects)
+    ids.update(*targets.values())
+    ids = sorted(ids)
+    if not ids:
+        return
+    session.query(Project).filter(Project.id.in_(ids)).update(
+        {
+            Project.data_version: func.coalesce(Project.data_version, 0) + 1,
+            Project.updated_at: Project.updated_at,
+        },
+        synchronize_session=False,
+    )
+    versions = dict(session.query(Project.id, Project.data_version).filter(Project.id.in_(ids)).all())
+    rows = [
+        {"project_id": target, "version": versions[target], "entity_type": entity_type,
+         "entity_id": entity_id, "action": action, "created_at": datetime.utcnow()}
+        for (entity_type, entity_id), (action, _) in pending.items()
+        for target in sorted(targets[(entity_type, entity_id)]) if target in versions
+    ]
+    if rows:
+        session.bulk_insert_mappings(ChangeLog, rows)
+    session.info.setdefault("bumped_versions", {}).update(versions)
+
+
+@event.listens_for(Session, "after_rollback")
+def _discard_changes(session: Session):
+    for key in ("pending_changes", "pending_grupos", "pending_projects", "pending_all_projects", "bumped_versions"):
+        session.info.pop(key, None)
+
+
+def bump_project_versions(db: Session, project_ids: Iterable[Optional[int]]) -> Dict[int, int]:
+    """Llamar después del commit: devuelve {project_id: versión nueva} de los
+    proyectos que incrementó ese commit. Los proyectos indicados que el commit
+    no tocó (cambios que no pasan por el flush o escrituras sin cambios) se
+    incrementan en un commit aparte, así que siempre están en el resultado."""
+    versions = db.info.pop("bumped_versions", {})
+    missing = {pid for pid in project_ids if pid is not None} - versions.keys()
+    if missing:
+        db.info.setdefault("pending_projects", set()).update(missing)
+        db.commit()
+        versions.update(db.info.pop("bumped_versions", {}))
+    return versions
+
+
+def changes_since(db: Session, project_id: int, version: Optional[int] = None, since: Optional[datetime] = None) -> Optional[List[ChangeLog]]:
+    """Entradas de change_log posteriores a una versión o a una fecha, en orden.
+    Devuelve None si el registro ya se depuró más allá de ese punto (hay que recargar todo)."""
+    query = db.query(ChangeLog).filter(ChangeLog.project_id == project_id)
+    if version is not None:
+        query = query.filter(ChangeLog.version > version)
+    else:
+        query = query.filter(ChangeLog.created_at > since)
+    entries = query.order_by(ChangeLog.version, ChangeLog.id).all()
+    if any(e.entity_type == FLOOR for e in entries):
+        return None
+    return entries
+
+
+def prune_change_log(db: Session, retention_days: int = CHANGE_LOG_RETENTION_DAYS) -> int:
+    """Borra las entradas más viejas que ``retention_days`` dejando por proyecto
+    una marca "floor" con la última versión borrada. Devuelve las filas borradas."""
+    cutoff = datetime.utcnow() - timedelta(days=retention_days)
+    removed = 0
+    for project_id, version, created_at in db.query(
+        ChangeLog.project_id, func.max(ChangeLog.version), func.max(ChangeLog.created_at)
+    ).filter(ChangeLog.created_at < cutoff, ChangeLog.entity_type != FLOOR).group_by(ChangeLog.project_id).all():
+        removed += db.query(ChangeLog).filter(
+            ChangeLog.project_id == project_id, ChangeLog.version <= version
+        ).delete(synchronize_session=False)
+        db.add(ChangeLog(project_id=project_id, version=version, entity_type=FLOOR, entity_id=0,
+                         action="delete", created_at=created_at))
+    db.commit()
+    return removed
+
+
+def get_project_version(db: Session, project_id: int) -> Optional[int]:
+    """data_version actual del proyecto (None si no existe)"""
+    row = db.query(Project.data_version).filter(Project.id == project_id).first()
+    return (row[0] or 0) if row else None
+
+
+def make_etag(*parts) -> str:
+    """ETag débil a partir de las partes que determinan la respuesta"""
+    digest = hashlib.sha1("|".join(str(p) for p in parts).encode("utf-8")).hexdigest()[:20]
+    return f'W/"{digest}"'
+
+
+def etag_matches(request: Request, etag: str) -> bool:
+    """True si el cliente envió If-None-Match con este ETag (o "*")"""
+    header = request.headers.get("if-none-match")
+    if not header:
+        return False
+    candidates = [c.strip() for c in header.split(",")]
+    return "*" in candidates or etag in candidates